@@ -2,20 +2,29 @@
 
 from contextlib import asynccontextmanager
 from io import BytesIO
+import os
+import struct
+import tempfile
 import time
 import asyncio
+import threading
 from concurrent.futures import ThreadPoolExecutor
+from typing import List, Literal, Optional, Tuple, Union
 
 import torchaudio
 import torch
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.responses import StreamingResponse
 from g2pw import G2PWConverter
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 
 from cosyvoice.utils.file_utils import load_wav
-from single_inference import CustomCosyVoice, get_bopomofo_rare
+from single_inference import CustomCosyVoice
+from voice_registry import VoiceRegistry
+from batch_scheduler import BatchScheduler
+from bopomofo_annotator import BopomofoAnnotator, join_sentences, split_sentences
+from text_normalizer import NormalizerPool
 
 
 class Settings(BaseSettings):
@@ -35,40 +44,320 @@ class Settings(BaseSettings):
         default="親愛的，累了一天辛苦了。讓我們一起深呼吸，慢慢放鬆身心。",
         description="Specifies the transcription of the speaker prompt audio.",
     )
+    precision: Literal["", "fp32", "bf16", "fp16"] = Field(
+        default="",
+        description="Specifies the numeric precision of the models. Defaults to fp16 on GPU and fp32 on CPU, see benchmarks/cpu_precision.py.",
+    )
+    hift_onnx_path: str = Field(
+        default="",
+        description="Specifies a vocoder exported by cosyvoice/bin/export_hift_onnx.py to run with onnxruntime instead of torch.",
+    )
+    converted_cache_dir: str = Field(
+        default="",
+        description="Specifies where the weights converted below fp32 are cached. Defaults to ~/.cache/breezyvoice/converted.",
+    )
+    attention_backend: Literal["", "math", "sdpa"] = Field(
+        default="",
+        description="Specifies the attention implementation of the llm and the flow encoder. Defaults to that of the model config, see benchmarks/attention_backend_report.py.",
+    )
+    llm_cuda_graph: bool = Field(
+        default=False,
+        description="Replays the speech token decode steps as a CUDA graph on GPU. Each batch captures its graph first, which pays off for long replies.",
+    )
+    runaway_guard: bool = Field(
+        default=True,
+        description="Stops speech token decoding that loops or runs past the speaking rate of the prompt instead of reaching its end, see cosyvoice/llm/runaway.py.",
+    )
+    runaway_resamples: int = Field(
+        default=1,
+        ge=0,
+        description="Specifies how many times a sentence stopped by the runaway guard is decoded again.",
+    )
+    max_token_text_ratio: Optional[float] = Field(
+        default=None,
+        gt=0,
+        description="Specifies a cap on speech tokens per text token, tighter than the default of 30.",
+    )
+    voice_store_dir: str = Field(
+        default="./voices",
+        description="Specifies the directory where enrolled voices are persisted.",
+    )
+    default_voice: str = Field(
+        default="default",
+        description="Specifies the voice used when a request does not name one. It is enrolled from the speaker prompt settings if missing.",
+    )
+    max_device_voices: int = Field(
+        default=32,
+        description="Specifies how many recently used voices keep their prompt tensors on the device.",
+    )
+    max_batch_size: int = Field(
+        default=8,
+        description="Specifies the maximum number of sentences, across concurrent requests, synthesized in one batch.",
+    )
+    text_normalize_workers: int = Field(
+        default=4,
+        ge=0,
+        description="Specifies the number of processes that normalize text, 0 to normalize in the API process.",
+    )
+    text_normalize_cache_size: int = Field(
+        default=4096,
+        description="Specifies how many normalized text segments are cached.",
+    )
+    g2p_max_batch_size: int = Field(
+        default=64,
+        description="Specifies the maximum number of sentences, across concurrent requests, annotated in one G2PW call.",
+    )
+    g2p_cache_size: int = Field(
+        default=4096,
+        description="Specifies how many annotated sentences are cached.",
+    )
+    max_batch_wait_ms: float = Field(
+        default=10,
+        description="Specifies how long the scheduler waits for more sentences before running a batch.",
+    )
+    stream_chunked: bool = Field(
+        default=True,
+        description="Streams the first segment of a reply in chunks, vocoded while its speech tokens are still being decoded, instead of once it is done.",
+    )
+    segment_first_max_tokens: int = Field(
+        default=15,
+        ge=0,
+        description="Specifies the text token budget of the first segment of a streamed reply, kept short and synthesized ahead of the others so that the first audio is ready sooner.",
+    )
+    segment_max_tokens: int = Field(
+        default=60,
+        ge=0,
+        description="Specifies the text token budget of the later segments. Sentences and clauses are merged up to it, 0 synthesizes each on its own.",
+    )
+    segment_merge_tokens: int = Field(
+        default=6,
+        ge=0,
+        description="Specifies the shortest segment, shorter fragments are merged with their neighbours whatever the budget.",
+    )
+    segment_comma_split: bool = Field(
+        default=True,
+        description="Also cuts segments at commas and other clause marks, not only at sentence ends.",
+    )
+    flow_steps: int = Field(
+        default=10,
+        ge=1,
+        description="Specifies the number of ODE steps of the flow decoder. Fewer steps are faster, see benchmarks/flow_solver_report.py for the quality cost.",
+    )
+    flow_solver: Literal["euler", "midpoint", "heun", "ab2"] = Field(
+        default="euler",
+        description="Specifies the ODE solver of the flow decoder. midpoint and heun call the estimator twice per step.",
+    )
+    flow_schedule: Literal["cosine", "linear"] = Field(
+        default="cosine",
+        description="Specifies how the flow decoder steps are spaced in time.",
+    )
+    flow_cfg_rate: Optional[float] = Field(
+        default=None,
+        ge=0,
+        description="Specifies the classifier-free guidance rate of the flow decoder. Defaults to that of the model.",
+    )
+    flow_cfg_interval: Tuple[float, float] = Field(
+        default=(0.0, 1.0),
+        description="Specifies the flow time interval [start, end) in which guidance is applied, an end of 1 includes t = 1. The other steps skip the unconditional pass, see benchmarks/flow_guidance_report.py.",
+    )
+    flow_cfg_schedule: Literal["constant", "linear", "cosine"] = Field(
+        default="constant",
+        description="Specifies the guidance rate curve over the flow time.",
+    )
 
 
 class SpeechRequest(BaseModel):
     model: str = ""
-    input: str = Field(
-        description="The content that will be synthesized into speech. You can include phonetic symbols if needed, though they should be used sparingly.",
-        examples=["今天天氣真好"],
+    input: Union[str, List[str]] = Field(
+        description="The content that will be synthesized into speech, or a list of segments that are normalized in parallel and each start a new sentence. You can include phonetic symbols if needed, though they should be used sparingly.",
+        examples=["今天天氣真好", ["今天天氣真好", "明天會下雨"]],
+    )
+    voice: str = Field(
+        default="",
+        description="The enrolled voice to speak with. Uses the default voice when empty or not enrolled, like the OpenAI voice names.",
     )
     response_format: str = ""
     speed: float = 1.0
+    stream: bool = Field(
+        default=False,
+        description="Send each sentence's audio as soon as it is synthesized instead of waiting for the whole input.",
+    )
+    segment_first_max_tokens: Optional[int] = Field(
+        default=None,
+        ge=0,
+        description="Overrides the text token budget of the first segment for this request.",
+    )
+    segment_max_tokens: Optional[int] = Field(
+        default=None,
+        ge=0,
+        description="Overrides the text token budget of the later segments for this request.",
+    )
+    segment_merge_tokens: Optional[int] = Field(
+        default=None,
+        ge=0,
+        description="Overrides the shortest segment for this request.",
+    )
+    segment_comma_split: Optional[bool] = Field(
+        default=None,
+        description="Overrides whether segments are cut at commas for this request.",
+    )
+    flow_steps: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Overrides the number of ODE steps of the flow decoder for this request.",
+    )
+    flow_solver: Optional[Literal["euler", "midpoint", "heun", "ab2"]] = Field(
+        default=None,
+        description="Overrides the ODE solver of the flow decoder for this request.",
+    )
+    flow_schedule: Optional[Literal["cosine", "linear"]] = Field(
+        default=None,
+        description="Overrides the time step schedule of the flow decoder for this request.",
+    )
+    flow_cfg_rate: Optional[float] = Field(
+        default=None,
+        ge=0,
+        description="Overrides the classifier-free guidance rate of the flow decoder for this request.",
+    )
+    flow_cfg_interval: Optional[Tuple[float, float]] = Field(
+        default=None,
+        description="Overrides the flow time interval in which guidance is applied for this request.",
+    )
+    flow_cfg_schedule: Optional[Literal["constant", "linear", "cosine"]] = Field(
+        default=None,
+        description="Overrides the guidance rate curve of the flow decoder for this request.",
+    )
+
+
+def wav_stream_header(sample_rate, num_channels=1, bits_per_sample=16):
+    # The total length is unknown while streaming, so both the RIFF and data
+    # chunk sizes are set to the maximum value, as most players accept.
+    byte_rate = sample_rate * num_channels * bits_per_sample // 8
+    block_align = num_channels * bits_per_sample // 8
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 0xFFFFFFFF, b"WAVE",
+        b"fmt ", 16, 1, num_channels, sample_rate, byte_rate, block_align, bits_per_sample,
+        b"data", 0xFFFFFFFF,
+    )
+
+
+def to_pcm16(speech):
+    return (speech.clamp(-1, 1) * 32767).to(torch.int16).numpy().tobytes()
+
+
+async def enroll_voice(state, voice_id, prompt_speech_16k, prompt_text):
+    loop = asyncio.get_running_loop()
+    prompt_text_normalized, = await loop.run_in_executor(state.thread_pool, state.text_normalizer.normalize, [prompt_text])
+    prompt_text_bopomo = await loop.run_in_executor(state.thread_pool, state.bopomofo_annotator.annotate, prompt_text_normalized)
+
+    def precompute_and_enroll():
+        prompt_input = state.cosyvoice.precompute_prompt(prompt_text_bopomo, prompt_speech_16k)
+        return state.voice_registry.enroll(voice_id, prompt_text, prompt_text_normalized, prompt_text_bopomo, prompt_input)
+
+    # The prompt features are extracted and prefilled on the device, so this
+    # runs on the scheduler executor, between two batches
+    return await loop.run_in_executor(state.scheduler.executor, precompute_and_enroll)
+
+
+def load_upload(audio_file):
+    # Not every audio backend can sniff the format of a file object, so keep the original extension
+    suffix = os.path.splitext(audio_file.filename or "")[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+        f.write(audio_file.file.read())
+        f.flush()
+        return load_wav(f.name, 16000)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.state.settings = Settings()
-    app.state.cosyvoice = CustomCosyVoice(app.state.settings.model_path)
-    app.state.bopomofo_converter = G2PWConverter()
-    app.state.prompt_speech_16k = load_wav(
-        app.state.settings.speaker_prompt_audio_path, 16000
+    app.state.cosyvoice = CustomCosyVoice(
+        app.state.settings.model_path,
+        app.state.settings.precision or None,
+        app.state.settings.hift_onnx_path or None,
+        app.state.settings.attention_backend or None,
+        converted_cache_dir=app.state.settings.converted_cache_dir or None,
+    )
+    app.state.cosyvoice.segment_config = {
+        "first_max_n": app.state.settings.segment_first_max_tokens,
+        "token_max_n": app.state.settings.segment_max_tokens,
+        "merge_len": app.state.settings.segment_merge_tokens,
+        "comma_split": app.state.settings.segment_comma_split,
+    }
+    app.state.cosyvoice.model.flow_config = {
+        "n_timesteps": app.state.settings.flow_steps,
+        "solver": app.state.settings.flow_solver,
+        "t_scheduler": app.state.settings.flow_schedule,
+        "cfg_rate": app.state.settings.flow_cfg_rate,
+        "cfg_interval": app.state.settings.flow_cfg_interval,
+        "cfg_schedule": app.state.settings.flow_cfg_schedule,
+    }
+    if app.state.settings.runaway_guard:
+        app.state.cosyvoice.model.runaway_guard.max_token_text_ratio = app.state.settings.max_token_text_ratio
+    else:
+        app.state.cosyvoice.model.runaway_guard = None
+    app.state.cosyvoice.model.max_resamples = app.state.settings.runaway_resamples
+    app.state.cosyvoice.model.use_cuda_graph = app.state.settings.llm_cuda_graph
+    # Normalization runs in worker processes started from a forkserver, they
+    # inherit nothing of the models, threads or CUDA state loaded above
+    app.state.text_normalizer = NormalizerPool(
+        app.state.cosyvoice.model_dir,
+        app.state.settings.text_normalize_workers,
+        app.state.settings.text_normalize_cache_size,
+        app.state.cosyvoice.frontend,
     )
+    app.state.bopomofo_annotator = BopomofoAnnotator(G2PWConverter(), app.state.settings.g2p_cache_size)
     app.state.thread_pool = ThreadPoolExecutor()
-    # GPU semaphore to control concurrent GPU access
-    app.state.gpu_semaphore = asyncio.Semaphore(1)
-    # Precompute and cache prompt embeddings
-    print("Precomputing prompt embeddings...")
-    app.state.cached_prompt_data = app.state.cosyvoice.precompute_prompt_embeddings(app.state.prompt_speech_16k)
-    print("Prompt embeddings cached successfully")
+    # All model work goes through the scheduler, which batches sentences of
+    # concurrent requests and serializes access to the GPU
+    app.state.scheduler = BatchScheduler(
+        app.state.cosyvoice.model.inference_batch,
+        ThreadPoolExecutor(max_workers=1),
+        app.state.settings.max_batch_size,
+        app.state.settings.max_batch_wait_ms,
+    )
+    app.state.scheduler.start()
+    # The sentences of concurrent requests are annotated in one G2PW call
+    app.state.g2p_scheduler = BatchScheduler(
+        app.state.bopomofo_annotator.annotate_batch,
+        ThreadPoolExecutor(max_workers=1),
+        app.state.settings.g2p_max_batch_size,
+        app.state.settings.max_batch_wait_ms,
+    )
+    app.state.g2p_scheduler.start()
+    # Enrolled voices keep their normalized prompt text and prompt conditioning
+    # (tokens, mel feat, embedding) on disk, so nothing is recomputed per request.
+    # Voices on the device also keep the llm state of their prompt prefix
+    app.state.voice_registry = VoiceRegistry(
+        app.state.settings.voice_store_dir,
+        app.state.cosyvoice.frontend.device,
+        app.state.settings.max_device_voices,
+        prefill_prompt=app.state.cosyvoice.model.prefill_prompt,
+    )
+    print("Loaded voices:", app.state.voice_registry.load_all())
+    if app.state.settings.default_voice not in app.state.voice_registry:
+        print("Enrolling default voice...")
+        await enroll_voice(
+            app.state,
+            app.state.settings.default_voice,
+            load_wav(app.state.settings.speaker_prompt_audio_path, 16000),
+            app.state.settings.speaker_prompt_text_transcription,
+        )
     yield
+    await app.state.scheduler.stop()
+    app.state.scheduler.executor.shutdown()
+    await app.state.g2p_scheduler.stop()
+    app.state.g2p_scheduler.executor.shutdown()
     app.state.thread_pool.shutdown()
+    app.state.text_normalizer.shutdown()
     del app.state.cosyvoice
-    del app.state.bopomofo_converter
-    del app.state.cached_prompt_data
+    del app.state.text_normalizer
+    del app.state.bopomofo_annotator
+    del app.state.voice_registry
     del app.state.thread_pool
-    del app.state.gpu_semaphore
+    del app.state.scheduler
+    del app.state.g2p_scheduler
 
 
 app = FastAPI(lifespan=lifespan, root_path="/v1")
@@ -89,71 +378,206 @@ async def get_models(request: Request):
     }
 
 
+@app.get("/stats")
+async def get_stats(request: Request):
+    guard = request.app.state.cosyvoice.model.runaway_guard
+    # Sentences by how their speech token decoding stopped, how many were
+    # resampled, and the speech tokens per text token they were decoded at
+    if guard is None:
+        return {"runaway_guard": None}
+    return {"runaway_guard": dict(guard.counters), "token_text_ratio": guard.token_text_ratio()}
+
+
+@app.get("/audio/voices")
+async def list_voices(request: Request):
+    return {
+        "object": "list",
+        "data": [
+            {"id": voice_id, "object": "voice"}
+            for voice_id in request.app.state.voice_registry.list_voices()
+        ],
+    }
+
+
+@app.post("/audio/voices")
+async def enroll_voice_endpoint(
+    request: Request,
+    voice_id: str = Form(),
+    text_input: str = Form(description="The transcription of the reference audio."),
+    audio_file: UploadFile = File(description="The reference audio of the voice."),
+):
+    loop = asyncio.get_event_loop()
+    prompt_speech_16k = await loop.run_in_executor(
+        request.app.state.thread_pool, load_upload, audio_file
+    )
+    try:
+        meta = await enroll_voice(request.app.state, voice_id, prompt_speech_16k, text_input)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "message": f"Voice {voice_id} enrolled", "voice": meta}
+
+
+@app.post("/audio/set_reference")
+async def set_reference(
+    request: Request,
+    text_input: str = Form(description="The transcription of the reference audio."),
+    audio_file: UploadFile = File(description="The reference audio of the voice."),
+):
+    # Used by the app's voice setup page, replaces the default voice
+    return await enroll_voice_endpoint(
+        request, request.app.state.settings.default_voice, text_input, audio_file
+    )
+
+
 @app.post("/audio/speech")
 async def speach_endpoint(request: Request, payload: SpeechRequest):
     start_time = time.time()
+    # OpenAI clients always name a voice, "alloy" or "nova" speak with the default one
+    voice_id = payload.voice
+    if voice_id not in request.app.state.voice_registry:
+        voice_id = request.app.state.settings.default_voice
     
     # Run CPU-intensive operations in thread pool
     loop = asyncio.get_event_loop()
     
-    async def process_tts():
-        # CPU operations can run in parallel
-        speaker_prompt_text_transcription = await loop.run_in_executor(
-            request.app.state.thread_pool,
-            request.app.state.cosyvoice.frontend.text_normalize_new,
-            request.app.state.settings.speaker_prompt_text_transcription,
-            False
-        )
-        
-        content_to_synthesize = await loop.run_in_executor(
-            request.app.state.thread_pool,
-            request.app.state.cosyvoice.frontend.text_normalize_new,
-            payload.input,
-            False
-        )
-        
-        speaker_prompt_text_transcription_bopomo = await loop.run_in_executor(
+    async def prepare_inputs():
+        # Segments are normalized in parallel by the worker processes of the normalizer
+        segments = [payload.input] if isinstance(payload.input, str) else payload.input
+        contents_to_synthesize = await loop.run_in_executor(
             request.app.state.thread_pool,
-            get_bopomofo_rare,
-            speaker_prompt_text_transcription,
-            request.app.state.bopomofo_converter
+            request.app.state.text_normalizer.normalize,
+            segments
         )
 
-        content_to_synthesize_bopomo = await loop.run_in_executor(
-            request.app.state.thread_pool,
-            get_bopomofo_rare,
-            content_to_synthesize,
-            request.app.state.bopomofo_converter
-        )
-        
-        # GPU operations need to be serialized
-        async with request.app.state.gpu_semaphore:
-            # Clear CUDA cache before inference
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            output = await loop.run_in_executor(
-                request.app.state.thread_pool,
-                request.app.state.cosyvoice.inference_zero_shot_no_normalize,
-                content_to_synthesize_bopomo,
-                speaker_prompt_text_transcription_bopomo,
-                request.app.state.prompt_speech_16k,
+        parts = [split_sentences(content) for content in contents_to_synthesize]
+        annotated = iter(await asyncio.gather(
+            *[request.app.state.g2p_scheduler.submit(sentence) for p in parts for sentence in p[::2] if sentence]
+        ))
+        contents_to_synthesize_bopomo = [join_sentences(p, annotated) for p in parts]
+
+        # A voice that is not on the device yet is copied there and prefilled
+        # on the scheduler executor, which owns the device
+        cached = request.app.state.voice_registry.get_cached(voice_id)
+        if cached is None:
+            cached = await loop.run_in_executor(
+                request.app.state.scheduler.executor,
+                request.app.state.voice_registry.get,
+                voice_id
             )
-            
-            # Move output to CPU immediately to free GPU memory
-            if torch.cuda.is_available():
-                output["tts_speech"] = output["tts_speech"].cpu()
-                torch.cuda.empty_cache()
+        prompt_text_bopomo, prompt_input = cached
+
+        # One model input per segment of split_segments, each one is scheduled
+        # on its own. Every item of a list input is split separately
+        segment_config = {
+            "first_max_n": payload.segment_first_max_tokens,
+            "token_max_n": payload.segment_max_tokens,
+            "merge_len": payload.segment_merge_tokens,
+            "comma_split": payload.segment_comma_split,
+        }
+
+        def build_model_inputs():
+            cosyvoice = request.app.state.cosyvoice
+            config = cosyvoice.get_segment_config(segment_config)
+            if not payload.stream and payload.segment_first_max_tokens is None:
+                # Nothing is heard before the whole reply, a short first segment only adds a model input
+                config["first_max_n"] = config["token_max_n"]
+            model_inputs = []
+            for content in contents_to_synthesize_bopomo:
+                model_inputs += cosyvoice.frontend_zero_shot_no_normalize(
+                    content, prompt_text_bopomo, None, prompt_input, config
+                )
+                # Only the first segment of the request is kept short
+                config = dict(config, first_max_n=config["token_max_n"])
+            return model_inputs
+
+        model_inputs = await loop.run_in_executor(request.app.state.thread_pool, build_model_inputs)
+        # Unset fields fall back to the deployment default of the model
+        flow_config = {
+            "n_timesteps": payload.flow_steps,
+            "solver": payload.flow_solver,
+            "t_scheduler": payload.flow_schedule,
+            "cfg_rate": payload.flow_cfg_rate,
+            "cfg_interval": payload.flow_cfg_interval,
+            "cfg_schedule": payload.flow_cfg_schedule,
+        }
+        for model_input in model_inputs:
+            model_input["flow_config"] = flow_config
+        return model_inputs
+
+    async def process_tts(model_inputs):
+        outputs = await asyncio.gather(
+            *[request.app.state.scheduler.submit(model_input) for model_input in model_inputs]
+        )
+        tts_speech = torch.concat([output["tts_speech"] for output in outputs], dim=1)
         
         audio_buffer = BytesIO()
         await loop.run_in_executor(
             request.app.state.thread_pool,
-            lambda: torchaudio.save(audio_buffer, output["tts_speech"], 22050, format="wav")
+            lambda: torchaudio.save(audio_buffer, tts_speech, 22050, format="wav")
         )
         audio_buffer.seek(0)
         return audio_buffer
-    
-    audio_buffer = await process_tts()
+
+    def stream_segment(model_input, started, chunks, stop):
+        # Runs on the scheduler executor, so the segment still has the device
+        # to itself, and hands over each chunk of audio as soon as it is vocoded
+        loop.call_soon_threadsafe(started.set)
+        try:
+            for output in request.app.state.cosyvoice.model.inference_stream(**model_input):
+                loop.call_soon_threadsafe(chunks.put_nowait, output["tts_speech"])
+                if stop.is_set():
+                    break
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    async def stream_tts(model_inputs):
+        # Send the header right away so the client can set up playback while
+        # the first sentence is being synthesized
+        if payload.response_format != "pcm":
+            yield wav_stream_header(22050)
+        if not model_inputs:
+            return
+        # The first segment runs on its own, batched with the rest its audio
+        # would only be ready once the whole reply is
+        scheduler = request.app.state.scheduler
+        chunked = request.app.state.settings.stream_chunked
+        first_started, chunks, stop = asyncio.Event(), asyncio.Queue(), threading.Event()
+        if chunked:
+            first = loop.run_in_executor(scheduler.executor, stream_segment, model_inputs[0], first_started, chunks, stop)
+        else:
+            first = asyncio.ensure_future(scheduler.submit(model_inputs[0], first_started))
+        tasks = []
+        try:
+            await first_started.wait()
+            tasks = [asyncio.ensure_future(scheduler.submit(model_input)) for model_input in model_inputs[1:]]
+            if chunked:
+                chunk = await chunks.get()
+                while chunk is not None:
+                    yield to_pcm16(chunk)
+                    chunk = await chunks.get()
+                await first
+            else:
+                yield to_pcm16((await first)["tts_speech"])
+            for task in tasks:
+                output = await task
+                yield to_pcm16(output["tts_speech"])
+        finally:
+            # The client may have gone away, drop the sentences not synthesized yet
+            stop.set()
+            first.cancel()
+            for task in tasks:
+                task.cancel()
+
+    model_inputs = await prepare_inputs()
+
+    if payload.stream:
+        return StreamingResponse(
+            stream_tts(model_inputs),
+            media_type="audio/pcm" if payload.response_format == "pcm" else "audio/wav",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    audio_buffer = await process_tts(model_inputs)
     
     # Calculate processing time and wait for double that time
     processing_time = time.time() - start_time
@@ -6,6 +6,7 @@ import pandas as pd
 from datasets import Dataset
 from single_inference import single_inference, CustomCosyVoice
 from g2pw import G2PWConverter
+from bopomofo_annotator import BopomofoAnnotator
 
 
 def process_batch(csv_file, speaker_prompt_audio_folder, output_audio_folder, model):
@@ -60,7 +61,7 @@ def main():
     args = parser.parse_args()
 
     cosyvoice = CustomCosyVoice(args.model_path)
-    bopomofo_converter = G2PWConverter()
+    bopomofo_converter = BopomofoAnnotator(G2PWConverter())
 
     os.makedirs(args.output_audio_folder, exist_ok=True)
 
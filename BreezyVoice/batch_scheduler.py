@@ -0,0 +1,99 @@
+import asyncio
+
+
+class BatchScheduler:
+    """Dynamic batching of model work submitted by concurrent requests.
+
+    Items passed to `submit` are queued. A single worker takes the first
+    pending item, waits at most `max_wait_ms` for more to arrive (or until
+    `max_batch_size` items are pending), runs them all through
+    `batch_fn(items) -> outputs` on `executor` and routes each output back
+    to its caller. While a batch runs, new items keep queueing up and form
+    the next batch, so throughput grows with concurrency. Having one worker
+    also serializes access to the device.
+
+    A batch only returns once all its items are done, so a caller that
+    needs one item early passes a `started` event and submits the rest of
+    its items once it is set, they then form a later batch.
+
+    When `batch_fn` raises on a batch of several items, they are run again
+    one at a time, so only the items that fail on their own get the error.
+    """
+
+    def __init__(self, batch_fn, executor, max_batch_size=8, max_wait_ms=10):
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.item_added = None
+        self.worker = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.item_added = asyncio.Event()
+        self.worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+
+    async def submit(self, item, started=None):
+        """The output of item, started is set when the batch of item starts running"""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((item, future, started))
+        self.item_added.set()
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self.item_added.clear()
+            try:
+                await asyncio.wait_for(self.item_added.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        # Callers that went away (e.g. a closed stream) no longer need their item
+        return [(item, future, started) for item, future, started in batch if not future.done()]
+
+    async def _run_one(self, item):
+        """The output of item run as a batch of its own, or the exception it raised"""
+        try:
+            return (await asyncio.get_running_loop().run_in_executor(self.executor, self.batch_fn, [item]))[0]
+        except Exception as e:
+            return e
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            for _, _, started in batch:
+                if started is not None:
+                    started.set()
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.batch_fn, [item for item, _, _ in batch])
+            except Exception as e:
+                outputs = [e]
+                if len(batch) > 1:
+                    # One bad item must not fail the others, run them one by one
+                    outputs = [await self._run_one(item) for item, _, _ in batch]
+            for (_, future, _), output in zip(batch, outputs):
+                if future.done():
+                    continue
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
@@ -0,0 +1,85 @@
+"""Numerics and latency of the attention backends of the transformer stack.
+
+Builds the encoders of CosyVoice-300M (the llm text encoder, the llm and the
+flow encoder) with random weights and runs a padded batch through each one
+with the "math" and the "sdpa" attention backend. Reports the largest
+absolute difference of the outputs over the valid frames and the forward
+time of each backend.
+
+    python benchmarks/attention_backend_report.py --lengths 100 300 600 --device cuda --dtype fp16
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import torch
+
+from cosyvoice.transformer.attention import ATTENTION_BACKENDS, set_attention_backend
+from cosyvoice.transformer.encoder import ConformerEncoder, TransformerEncoder
+
+DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def build_encoders():
+    """name -> (input size, encoder)"""
+    common = dict(dropout_rate=0.1, positional_dropout_rate=0.1, attention_dropout_rate=0.0, normalize_before=True,
+                  pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn', static_chunk_size=1)
+    return {
+        'llm text_encoder': (1024, ConformerEncoder(input_size=1024, output_size=1024, attention_heads=16, linear_units=4096, num_blocks=6,
+                                                    input_layer='linear', use_cnn_module=False, macaron_style=False, **common)),
+        'llm': (1024, TransformerEncoder(input_size=1024, output_size=1024, attention_heads=16, linear_units=4096, num_blocks=14,
+                                         input_layer='linear_legacy', **common)),
+        'flow encoder': (512, ConformerEncoder(input_size=512, output_size=512, attention_heads=8, linear_units=2048, num_blocks=6,
+                                               input_layer='linear', use_cnn_module=False, macaron_style=False, **common)),
+    }
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def run(encoder, x, x_len, device, repeats):
+    encoder(x, x_len)
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out, mask = encoder(x, x_len)
+    synchronize(device)
+    return out, mask, (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the math and sdpa attention backends")
+    parser.add_argument("--lengths", type=int, nargs='+', default=[100, 300, 600], help="Longest input of the batch, in frames.")
+    parser.add_argument("--batch_size", type=int, default=2, help="Rows of the batch, each one shorter than the previous.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--dtype", type=str, default='fp32', choices=list(DTYPES))
+    args = parser.parse_args()
+
+    device, dtype = torch.device(args.device), DTYPES[args.dtype]
+    torch.manual_seed(0)
+    print('{:>17} {:>7} {:>10} {:>10} {:>10} {:>8}'.format('encoder', 'frames', 'max diff', 'math ms', 'sdpa ms', 'speedup'))
+    for name, (input_size, encoder) in build_encoders().items():
+        encoder.to(device, dtype).eval()
+        for length in args.lengths:
+            x = torch.randn(args.batch_size, length, input_size, device=device, dtype=dtype)
+            x_len = torch.tensor([length - i * length // (2 * args.batch_size) for i in range(args.batch_size)], device=device)
+            outputs = {}
+            for backend in ATTENTION_BACKENDS:
+                set_attention_backend(encoder, backend)
+                outputs[backend] = run(encoder, x, x_len, device, args.repeats)
+            (math_out, mask, math_ms), (sdpa_out, _, sdpa_ms) = outputs['math'], outputs['sdpa']
+            diff = ((math_out - sdpa_out).float().abs() * mask.transpose(1, 2)).max().item()
+            print('{:>17} {:>7} {:>10.2e} {:>10.1f} {:>10.1f} {:>7.2f}x'.format(name, length, diff, math_ms, sdpa_ms, math_ms / sdpa_ms))
+        encoder.cpu()
+
+
+if __name__ == "__main__":
+    main()
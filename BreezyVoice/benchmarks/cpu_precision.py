@@ -0,0 +1,85 @@
+"""Latency of each precision policy on the CPU.
+
+Loads the model once per precision (fp32, bf16, fp16) and synthesizes the
+same sentences with each one, reporting the mean latency, the real time
+factor and the mean absolute difference of the audio from the fp32
+output. Run it on the CPU nodes themselves, the fastest precision depends
+on whether the CPU has native bf16 (AVX512-BF16, AMX) or fp16 support.
+Hide the GPUs to benchmark the CPU path on a GPU machine:
+
+    CUDA_VISIBLE_DEVICES= python benchmarks/cpu_precision.py --threads 8
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+
+import torch
+
+from cosyvoice.utils.file_utils import load_wav
+from single_inference import PRECISIONS, CustomCosyVoice
+
+DEFAULT_SENTENCES = [
+    '今天天氣真好，我們一起去公園散步吧。',
+    '請在下一個路口右轉，然後直走三百公尺就會看到車站。',
+]
+
+
+def synthesize(cosyvoice, model_inputs, seed):
+    speeches, elapsed = [], 0
+    for model_input in model_inputs:
+        torch.manual_seed(seed)
+        start = time.perf_counter()
+        speeches.append(cosyvoice.model.inference(**model_input)['tts_speech'])
+        elapsed += time.perf_counter() - start
+    return speeches, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the precision policies on the CPU")
+    parser.add_argument("--model_path", type=str, default="MediaTek-Research/BreezyVoice-300M", help="Model directory or huggingface repo id.")
+    parser.add_argument("--speaker_prompt_audio_path", type=str, default=os.path.join(ROOT_DIR, 'data/example.wav'))
+    parser.add_argument("--speaker_prompt_text_transcription", type=str, default="親愛的，累了一天辛苦了。讓我們一起深呼吸，慢慢放鬆身心。")
+    parser.add_argument("--sentences", type=str, nargs='+', default=DEFAULT_SENTENCES, help="Sentences to synthesize.")
+    parser.add_argument("--precisions", type=str, nargs='+', default=list(PRECISIONS), choices=list(PRECISIONS))
+    parser.add_argument("--threads", type=int, default=None, help="Number of intra-op threads, defaults to torch's choice.")
+    parser.add_argument("--repeats", type=int, default=2, help="Number of timed passes over the sentences.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sampling, shared by all precisions.")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    prompt_speech_16k = load_wav(args.speaker_prompt_audio_path, 16000)
+
+    results = {}
+    for precision in args.precisions:
+        cosyvoice = CustomCosyVoice(args.model_path, precision)
+        prompt_input = cosyvoice.precompute_prompt(args.speaker_prompt_text_transcription, prompt_speech_16k)
+        model_inputs = [cosyvoice.frontend.frontend_zero_shot(sentence, args.speaker_prompt_text_transcription, None, prompt_input)
+                        for sentence in args.sentences]
+        # warmup, the first pass pays for allocations and kernel selection
+        synthesize(cosyvoice, model_inputs[:1], args.seed)
+        elapsed = 0
+        for _ in range(args.repeats):
+            speeches, pass_elapsed = synthesize(cosyvoice, model_inputs, args.seed)
+            elapsed += pass_elapsed
+        results[precision] = (speeches, elapsed / args.repeats)
+        del cosyvoice
+
+    reference = results.get('fp32', (None, None))[0]
+    print('{:>9} {:>12} {:>8} {:>12}'.format('precision', 'ms/sentence', 'RTF', 'diff fp32'))
+    for precision, (speeches, elapsed) in results.items():
+        audio_seconds = sum(s.size(1) for s in speeches) / 22050
+        diff = '-'
+        # sampling diverges across precisions once a token differs, then only the lengths are comparable
+        if reference is not None and all(s.shape == r.shape for s, r in zip(speeches, reference)):
+            diff = '{:.4f}'.format(sum((s - r).abs().mean().item() for s, r in zip(speeches, reference)) / len(speeches))
+        print('{:>9} {:>12.1f} {:>8.3f} {:>12}'.format(precision, elapsed / len(speeches) * 1000, elapsed / audio_seconds, diff))
+
+
+if __name__ == "__main__":
+    main()
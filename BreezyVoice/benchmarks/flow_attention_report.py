@@ -0,0 +1,89 @@
+"""Latency and peak memory of the flow U-Net attention against mel length.
+
+Builds the estimator of CosyVoice-300M with random weights and runs one
+guidance batch of two rows through it, either with KeyPaddingAttnProcessor
+(no mask for an unpadded batch, a key padding mask otherwise) or with the
+diffusers processor and the dense T x T mask the decoder used to build.
+Peak memory is only reported on cuda.
+
+    python benchmarks/flow_attention_report.py --frames 500 1000 2000 4000 --device cuda --dtype fp16
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+
+import torch
+from diffusers.models.attention_processor import AttnProcessor2_0
+from matcha.models.components.transformer import BasicTransformerBlock
+
+from cosyvoice.flow.decoder import ConditionalDecoder, KeyPaddingAttnProcessor
+
+DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class DenseMaskAttnProcessor(AttnProcessor2_0):
+    """The attention before KeyPaddingAttnProcessor, on the mask matrix of the frames"""
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None):
+        mask = torch.ones(hidden_states.size(0), 1, hidden_states.size(1), device=hidden_states.device, dtype=hidden_states.dtype)
+        if attention_mask is not None:
+            mask = attention_mask.to(hidden_states.dtype)
+        attention_mask = (1.0 - torch.matmul(mask.transpose(1, 2), mask)) * -1.0e4
+        return super().__call__(attn, hidden_states, encoder_hidden_states, attention_mask, temb)
+
+
+def set_processor(estimator, processor):
+    for m in estimator.modules():
+        if isinstance(m, BasicTransformerBlock):
+            m.attn1.set_processor(processor)
+
+
+@torch.inference_mode()
+def run(estimator, inputs, device, repeats):
+    estimator(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        estimator(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return (time.perf_counter() - start) / repeats * 1000, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the flow U-Net attention processors")
+    parser.add_argument("--frames", type=int, nargs='+', default=[500, 1000, 2000], help="Mel frames of the batch, 86 per second.")
+    parser.add_argument("--padded", action='store_true', help="Make the second row half as long as the first.")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--dtype", type=str, default='fp32', choices=list(DTYPES))
+    args = parser.parse_args()
+
+    device, dtype = torch.device(args.device), DTYPES[args.dtype]
+    torch.manual_seed(0)
+    estimator = ConditionalDecoder(in_channels=320, out_channels=80, channels=(256, 256), dropout=0.0, attention_head_dim=64,
+                                   n_blocks=4, num_mid_blocks=12, num_heads=8, act_fn='gelu').to(device, dtype).eval()
+    print('{:>7} {:>10} {:>10} {:>8} {:>10} {:>10}'.format('frames', 'dense ms', 'keypad ms', 'speedup', 'dense MiB', 'keypad MiB'))
+    for frames in args.frames:
+        x, mu, cond = (torch.randn(2, 80, frames, device=device, dtype=dtype) for _ in range(3))
+        lengths = torch.tensor([frames, frames // 2 if args.padded else frames], device=device)
+        mask = (torch.arange(frames, device=device) < lengths.unsqueeze(1)).unsqueeze(1).to(dtype)
+        inputs = (x, mask, mu, torch.rand(2, device=device, dtype=dtype), torch.randn(2, 80, device=device, dtype=dtype), cond)
+        set_processor(estimator, DenseMaskAttnProcessor())
+        dense_ms, dense_mib = run(estimator, inputs, device, args.repeats)
+        set_processor(estimator, KeyPaddingAttnProcessor())
+        keypad_ms, keypad_mib = run(estimator, inputs, device, args.repeats)
+        print('{:>7} {:>10.1f} {:>10.1f} {:>7.2f}x {:>10.0f} {:>10.0f}'.format(
+            frames, dense_ms, keypad_ms, dense_ms / keypad_ms, dense_mib, keypad_mib))
+
+
+if __name__ == "__main__":
+    main()
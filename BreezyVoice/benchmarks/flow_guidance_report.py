@@ -0,0 +1,84 @@
+"""Quality vs latency of classifier-free guidance schedules in the flow decoder.
+
+Generates the speech tokens of every sentence once, then decodes them to
+mel spectrograms with every guidance interval and rate curve, starting from
+the same noise. Estimator calls outside the interval skip the unconditional
+half of the batch. Every configuration is compared with guidance on every
+call (interval 0:1, constant rate) by the mean absolute and root mean square
+distance of the log mel spectrograms, and timed per sentence. Interval 0:0
+is the decoder without guidance.
+
+    python benchmarks/flow_guidance_report.py --intervals 0:1 0:0.6 0:0.4 --schedules constant cosine
+"""
+import argparse
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+
+from cosyvoice.flow.flow_matching import ConditionalCFM
+from cosyvoice.utils.file_utils import load_wav
+from flow_solver_report import DEFAULT_SENTENCES, decode_mel, generate_tokens
+from single_inference import PRECISIONS, CustomCosyVoice
+
+
+def parse_interval(interval):
+    start, end = interval.split(':')
+    return float(start), float(end)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report mel distance and latency of flow guidance schedules against guidance on every step")
+    parser.add_argument("--model_path", type=str, default="MediaTek-Research/BreezyVoice-300M", help="Model directory or huggingface repo id.")
+    parser.add_argument("--speaker_prompt_audio_path", type=str, default=os.path.join(ROOT_DIR, 'data/example.wav'))
+    parser.add_argument("--speaker_prompt_text_transcription", type=str, default="親愛的，累了一天辛苦了。讓我們一起深呼吸，慢慢放鬆身心。")
+    parser.add_argument("--sentences", type=str, nargs='+', default=DEFAULT_SENTENCES, help="Sentences to synthesize.")
+    parser.add_argument("--intervals", type=parse_interval, nargs='+', default=[parse_interval(i) for i in ('0:1', '0:0.8', '0:0.6', '0:0.4', '0:0.2', '0.2:1', '0:0')],
+                        help="Guidance intervals start:end of the flow time.")
+    parser.add_argument("--schedules", type=str, nargs='+', default=['constant'], choices=list(ConditionalCFM.CFG_SCHEDULES))
+    parser.add_argument("--cfg_rate", type=float, default=None, help="Guidance rate, defaults to that of the model.")
+    parser.add_argument("--solver", type=str, default='euler', choices=list(ConditionalCFM.SOLVERS))
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the initial noise, shared by all configurations.")
+    parser.add_argument("--precision", type=str, default=None, choices=list(PRECISIONS), help="Numeric precision of the models, defaults to that of the device.")
+    args = parser.parse_args()
+
+    cosyvoice = CustomCosyVoice(args.model_path, args.precision)
+    model = cosyvoice.model
+    prompt_speech_16k = load_wav(args.speaker_prompt_audio_path, 16000)
+    prompt_input = cosyvoice.precompute_prompt(args.speaker_prompt_text_transcription, prompt_speech_16k)
+    model_inputs = [cosyvoice.frontend.frontend_zero_shot(sentence, args.speaker_prompt_text_transcription, None, prompt_input)
+                    for sentence in args.sentences]
+    tokens = [generate_tokens(model, model_input) for model_input in model_inputs]
+
+    # Count the estimator calls that run the doubled guidance batch
+    guided_calls = []
+    model.flow.decoder.estimator.register_forward_pre_hook(lambda module, inputs: guided_calls.append(inputs[0].size(0) == 2))
+
+    base = {'solver': args.solver, 'n_timesteps': args.steps, 'cfg_rate': args.cfg_rate}
+    reference_config = dict(base, cfg_interval=(0.0, 1.0), cfg_schedule='constant')
+    # The first run of each shape pays for allocator and kernel warmup
+    decode_mel(model, model_inputs[0], tokens[0], args.seed, **reference_config)
+    references = [decode_mel(model, i, t, args.seed, **reference_config) for i, t in zip(model_inputs, tokens)]
+    reference_latency = sum(elapsed for _, elapsed in references)
+
+    print('{:>12} {:>9} {:>7} {:>10} {:>10} {:>10} {:>8}'.format('interval', 'schedule', 'guided', 'mel L1', 'mel RMSE', 'ms/sent', 'speedup'))
+    for schedule in args.schedules:
+        for interval in args.intervals:
+            l1, rmse, latency = 0, 0, 0
+            guided_calls.clear()
+            for model_input, t, (reference, _) in zip(model_inputs, tokens, references):
+                mel, elapsed = decode_mel(model, model_input, t, args.seed, cfg_interval=interval, cfg_schedule=schedule, **base)
+                l1 += (mel - reference).abs().mean().item()
+                rmse += (mel - reference).pow(2).mean().sqrt().item()
+                latency += elapsed
+            n = len(model_inputs)
+            print('{:>12} {:>9} {:>7} {:>10.4f} {:>10.4f} {:>10.1f} {:>7.2f}x'.format(
+                '{:g}:{:g}'.format(*interval), schedule, '{}/{}'.format(sum(guided_calls), len(guided_calls)),
+                l1 / n, rmse / n, latency / n * 1000, reference_latency / latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Quality vs latency of the flow decoder ODE solvers and step counts.
+
+Generates the speech tokens of every sentence once, then decodes them to
+mel spectrograms with each solver, step count and schedule, starting from
+the same noise. Every configuration is compared with the 10-step euler
+cosine reference (the default of MaskedDiffWithXvec.inference) by the mean
+absolute and root mean square distance of the log mel spectrograms, and
+timed per sentence.
+
+    python benchmarks/flow_solver_report.py --steps 4 6 8 10 --solvers euler heun ab2
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+
+import torch
+
+from cosyvoice.flow.flow_matching import ConditionalCFM
+from cosyvoice.utils.file_utils import load_wav
+from single_inference import PRECISIONS, CustomCosyVoice
+
+REFERENCE = {'solver': 'euler', 'n_timesteps': 10, 't_scheduler': 'cosine'}
+
+DEFAULT_SENTENCES = [
+    '今天天氣真好，我們一起去公園散步吧。',
+    '請在下一個路口右轉，然後直走三百公尺就會看到車站。',
+    '這個週末的演唱會門票已經全部賣完了。',
+]
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def generate_tokens(model, model_input):
+    with model.autocast():
+        return model.llm.inference(text=model_input['text'].to(model.device),
+                                   text_len=model_input['text_len'].to(model.device),
+                                   prompt_text=model_input['prompt_text'].to(model.device),
+                                   prompt_text_len=model_input['prompt_text_len'].to(model.device),
+                                   prompt_speech_token=model_input['llm_prompt_speech_token'].to(model.device),
+                                   prompt_speech_token_len=model_input['llm_prompt_speech_token_len'].to(model.device),
+                                   embedding=model_input['llm_embedding'].to(model.device, model.dtype),
+                                   sampling=25,
+                                   max_token_text_ratio=30,
+                                   min_token_text_ratio=3,
+                                   prompt_cache=model_input.get('llm_prompt_cache'))
+
+
+@torch.inference_mode()
+def decode_mel(model, model_input, tokens, seed, **flow_config):
+    """Decode tokens to mel from the noise of seed, flow_config as in MaskedDiffWithXvec.inference"""
+    torch.manual_seed(seed)
+    with model.autocast():
+        synchronize(model.device)
+        start = time.perf_counter()
+        mel = model.flow.inference(token=tokens,
+                                   token_len=torch.tensor([tokens.size(1)], dtype=torch.int32, device=model.device),
+                                   prompt_token=model_input['flow_prompt_speech_token'].to(model.device),
+                                   prompt_token_len=model_input['flow_prompt_speech_token_len'].to(model.device),
+                                   prompt_feat=model_input['prompt_speech_feat'].to(model.device, model.dtype),
+                                   prompt_feat_len=model_input['prompt_speech_feat_len'].to(model.device),
+                                   embedding=model_input['flow_embedding'].to(model.device, model.dtype),
+                                   **flow_config)
+        synchronize(model.device)
+    return mel.float(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report mel distance and latency of flow decoder solvers against 10-step euler")
+    parser.add_argument("--model_path", type=str, default="MediaTek-Research/BreezyVoice-300M", help="Model directory or huggingface repo id.")
+    parser.add_argument("--speaker_prompt_audio_path", type=str, default=os.path.join(ROOT_DIR, 'data/example.wav'))
+    parser.add_argument("--speaker_prompt_text_transcription", type=str, default="親愛的，累了一天辛苦了。讓我們一起深呼吸，慢慢放鬆身心。")
+    parser.add_argument("--sentences", type=str, nargs='+', default=DEFAULT_SENTENCES, help="Sentences to synthesize.")
+    parser.add_argument("--solvers", type=str, nargs='+', default=list(ConditionalCFM.SOLVERS), choices=list(ConditionalCFM.SOLVERS))
+    parser.add_argument("--steps", type=int, nargs='+', default=[2, 3, 4, 5, 6, 8, 10])
+    parser.add_argument("--schedules", type=str, nargs='+', default=['cosine'], choices=list(ConditionalCFM.T_SCHEDULERS))
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the initial noise, shared by all configurations.")
+    parser.add_argument("--precision", type=str, default=None, choices=list(PRECISIONS), help="Numeric precision of the models, defaults to that of the device.")
+    args = parser.parse_args()
+
+    cosyvoice = CustomCosyVoice(args.model_path, args.precision)
+    model = cosyvoice.model
+    prompt_speech_16k = load_wav(args.speaker_prompt_audio_path, 16000)
+    prompt_input = cosyvoice.precompute_prompt(args.speaker_prompt_text_transcription, prompt_speech_16k)
+    model_inputs = [cosyvoice.frontend.frontend_zero_shot(sentence, args.speaker_prompt_text_transcription, None, prompt_input)
+                    for sentence in args.sentences]
+    tokens = [generate_tokens(model, model_input) for model_input in model_inputs]
+
+    # The first run of each shape pays for allocator and kernel warmup
+    decode_mel(model, model_inputs[0], tokens[0], args.seed, **REFERENCE)
+    references = [decode_mel(model, i, t, args.seed, **REFERENCE) for i, t in zip(model_inputs, tokens)]
+
+    configs = [(solver, steps, schedule) for schedule in args.schedules for solver in args.solvers for steps in args.steps]
+    print('{:>9} {:>6} {:>9} {:>6} {:>10} {:>10} {:>10}'.format('solver', 'steps', 'schedule', 'nfe', 'mel L1', 'mel RMSE', 'ms/sent'))
+    for solver, steps, schedule in configs:
+        l1, rmse, latency = 0, 0, 0
+        for model_input, t, (reference, _) in zip(model_inputs, tokens, references):
+            mel, elapsed = decode_mel(model, model_input, t, args.seed, solver=solver, n_timesteps=steps, t_scheduler=schedule)
+            l1 += (mel - reference).abs().mean().item()
+            rmse += (mel - reference).pow(2).mean().sqrt().item()
+            latency += elapsed
+        n = len(model_inputs)
+        # estimator calls per sentence, each on the doubled classifier-free guidance batch
+        nfe = steps * (2 if solver in ('midpoint', 'heun') else 1)
+        print('{:>9} {:>6} {:>9} {:>6} {:>10.4f} {:>10.4f} {:>10.1f}'.format(
+            solver, steps, schedule, nfe, l1 / n, rmse / n, latency / n * 1000))
+
+
+if __name__ == "__main__":
+    main()
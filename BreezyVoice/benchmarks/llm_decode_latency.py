@@ -0,0 +1,111 @@
+"""Per-token latency of speech-token decoding as the sequence grows.
+
+Runs the TransformerLM decoder step by step with the concatenated kv cache
+of the original decoding loop (BaseEncoder.forward_chunk) and with the
+preallocated static kv cache (BaseEncoder.forward_chunk_static) and prints the mean step latency over
+windows of generated tokens. With the static cache the latency should stay
+flat as the sequence grows.
+
+    python benchmarks/llm_decode_latency.py --num_tokens 1500
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+
+import torch
+from hyperpyyaml import load_hyperpyyaml
+from huggingface_hub import snapshot_download
+
+
+def load_llm(model_dir, device):
+    if not os.path.exists(model_dir):
+        model_dir = snapshot_download(model_dir)
+    with open('{}/cosyvoice.yaml'.format(model_dir), 'r') as f:
+        configs = load_hyperpyyaml(f)
+    llm = configs['llm']
+    llm.load_state_dict(torch.load('{}/llm.pt'.format(model_dir), map_location=device))
+    return llm.to(device).eval()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def run_concat(llm, prefix, tokens, device):
+    prefix_len = prefix.size(1)
+    att_mask = torch.tril(torch.ones((1, prefix_len, prefix_len), device=device, dtype=torch.bool))
+    att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=device), torch.zeros((0, 0, 0, 0), device=device)
+    _, att_cache, cnn_cache = llm.llm.forward_chunk(prefix, offset=0, required_cache_size=-1,
+                                                    att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
+    latencies = []
+    for token in tokens:
+        xs = llm.speech_embedding.weight[token].reshape(1, 1, -1)
+        att_mask = torch.ones((1, 1, 1), device=device, dtype=torch.bool)
+        synchronize(device)
+        start = time.perf_counter()
+        y_pred, att_cache, cnn_cache = llm.llm.forward_chunk(xs, offset=0, required_cache_size=-1,
+                                                             att_cache=att_cache, cnn_cache=cnn_cache, att_mask=att_mask)
+        llm.llm_decoder(y_pred[:, -1])
+        synchronize(device)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+@torch.inference_mode()
+def run_static(llm, prefix, tokens, device):
+    prefix_len = prefix.size(1)
+    cache = llm.llm.init_static_cache(1, prefix_len + len(tokens), device, prefix.dtype)
+    att_mask = torch.tril(torch.ones((1, prefix_len, prefix_len), device=device, dtype=torch.bool))
+    llm.llm.forward_chunk_static(prefix, cache, att_mask)
+    latencies = []
+    for token in tokens:
+        xs = llm.speech_embedding.weight[token].reshape(1, 1, -1)
+        synchronize(device)
+        start = time.perf_counter()
+        y_pred = llm.llm.forward_chunk_static(xs, cache)
+        llm.llm_decoder(y_pred[:, -1])
+        synchronize(device)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-token latency of speech-token decoding")
+    parser.add_argument("--model_path", type=str, default="MediaTek-Research/BreezyVoice-300M", help="Model directory or huggingface repo id.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--fp16", action="store_true", help="Run the model in half precision.")
+    parser.add_argument("--prefix_len", type=int, default=200, help="Length of the prompt prefix before decoding starts.")
+    parser.add_argument("--num_tokens", type=int, default=1000, help="Number of decoding steps.")
+    parser.add_argument("--window", type=int, default=100, help="Number of steps averaged per reported row.")
+    parser.add_argument("--warmup", type=int, default=20, help="Number of untimed decoding steps run first.")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    llm = load_llm(args.model_path, device)
+    if args.fp16:
+        llm.half()
+    torch.manual_seed(0)
+    prefix = torch.randn(1, args.prefix_len, llm.llm_input_size, device=device, dtype=llm.speech_embedding.weight.dtype)
+    tokens = torch.randint(0, llm.speech_token_size, (args.num_tokens,)).tolist()
+
+    results = {}
+    for name, run in [('concat', run_concat), ('static', run_static)]:
+        run(llm, prefix, tokens[:args.warmup], device)
+        results[name] = run(llm, prefix, tokens, device)
+
+    print('{:>12} {:>14} {:>14}'.format('tokens', 'concat ms/tok', 'static ms/tok'))
+    for start in range(0, args.num_tokens, args.window):
+        end = min(start + args.window, args.num_tokens)
+        row = [sum(results[name][start:end]) / (end - start) * 1000 for name in ['concat', 'static']]
+        print('{:>12} {:>14.2f} {:>14.2f}'.format('{}-{}'.format(start, end), *row))
+
+
+if __name__ == "__main__":
+    main()
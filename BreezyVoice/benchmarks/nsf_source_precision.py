@@ -0,0 +1,104 @@
+"""Phase precision and speed of the HiFT sine source on long utterances.
+
+SineGen integrates the phase of every harmonic at frame rate and ramps it
+within each frame. This compares its fundamental and harmonics with the
+sines of a float64 integration at sample rate, and does the same for the float32
+sample rate integration it replaced, on random f0 contours of growing
+duration. Errors are the largest absolute difference of the unit sines,
+times are those of the whole source, noise included.
+
+    python benchmarks/nsf_source_precision.py --seconds 5 30 120 --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import numpy as np
+import torch
+
+from cosyvoice.hifigan.generator import SineGen
+
+
+def random_f0(batch_size, num_frames, device):
+    """Smooth contours between 80 and 400 Hz with one unvoiced frame in eight"""
+    knots = torch.rand(batch_size, 1, num_frames // 20 + 2, device=device)
+    f0 = torch.nn.functional.interpolate(knots, size=num_frames, mode='linear', align_corners=False) * 320 + 80
+    return f0 * (torch.rand(batch_size, 1, num_frames, device=device) > 0.125)
+
+
+def sample_rate_phase(sine_gen, f0, dtype):
+    """Phase in cycles integrated over the upsampled f0, as SineGen did before"""
+    harmonics = torch.arange(1, sine_gen.harmonic_num + 2, device=f0.device, dtype=dtype).view(1, -1, 1)
+    f0 = f0.to(dtype).repeat_interleave(sine_gen.upsample_scale, dim=-1)
+    return torch.cumsum(f0 * harmonics / sine_gen.sampling_rate, dim=-1) % 1
+
+
+def legacy_source(sine_gen, f0):
+    """The sine source SineGen computed before, harmonic by harmonic at sample rate"""
+    f0 = f0.repeat_interleave(sine_gen.upsample_scale, dim=-1)
+    F_mat = torch.zeros((f0.size(0), sine_gen.harmonic_num + 1, f0.size(-1))).to(f0.device)
+    for i in range(sine_gen.harmonic_num + 1):
+        F_mat[:, i: i + 1, :] = f0 * (i + 1) / sine_gen.sampling_rate
+    theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
+    sine_waves = sine_gen.sine_amp * torch.sin(theta_mat + sine_gen.random_phase(f0.size(0), f0.device))
+    uv = sine_gen._f02uv(f0)
+    noise_amp = uv * sine_gen.noise_std + (1 - uv) * sine_gen.sine_amp / 3
+    return sine_waves * uv + noise_amp * torch.randn_like(sine_waves)
+
+
+def frame_rate_sine(sine_gen, f0):
+    """Unit sines of SineGen without the initial phase, noise and uv mask"""
+    unit_gen = SineGen(sine_gen.sampling_rate, sine_gen.harmonic_num, sine_amp=1.0,
+                       voiced_threshold=-1, upsample_scale=sine_gen.upsample_scale)
+    phase_vec = torch.zeros(f0.size(0), sine_gen.harmonic_num + 1, 1, device=f0.device)
+    noise = torch.zeros(f0.size(0), sine_gen.harmonic_num + 1, f0.size(-1) * sine_gen.upsample_scale, device=f0.device)
+    sine, _, _ = unit_gen(f0, phase_vec=phase_vec, noise=noise)
+    return sine
+
+
+def timed(fn, device, repeats):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+@torch.inference_mode()
+def main():
+    parser = argparse.ArgumentParser(description="Compare the sine source phase against a float64 reference")
+    parser.add_argument("--seconds", type=float, nargs='+', default=[5, 30, 120], help="Utterance durations.")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--sampling_rate", type=int, default=22050)
+    parser.add_argument("--upsample_scale", type=int, default=256)
+    parser.add_argument("--harmonic_num", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    sine_gen = SineGen(args.sampling_rate, args.harmonic_num, upsample_scale=args.upsample_scale)
+    torch.manual_seed(0)
+    print('{:>8} {:>14} {:>14} {:>10} {:>10}'.format('seconds', 'frame err', 'fp32 err', 'frame ms', 'fp32 ms'))
+    for seconds in args.seconds:
+        num_frames = int(seconds * args.sampling_rate / args.upsample_scale)
+        f0 = random_f0(args.batch_size, num_frames, device)
+        reference = torch.sin(2 * np.pi * sample_rate_phase(sine_gen, f0, torch.float64))
+        frame_err = (frame_rate_sine(sine_gen, f0).double() - reference).abs().max().item()
+        fp32_sine = torch.sin(2 * np.pi * sample_rate_phase(sine_gen, f0, torch.float32))
+        fp32_err = (fp32_sine.double() - reference).abs().max().item()
+        frame_ms = timed(lambda: sine_gen(f0), device, args.repeats)
+        fp32_ms = timed(lambda: legacy_source(sine_gen, f0), device, args.repeats)
+        print('{:>8.0f} {:>14.2e} {:>14.2e} {:>10.1f} {:>10.1f}'.format(seconds, frame_err, fp32_err, frame_ms, fp32_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Cold start time and peak memory of CustomCosyVoice.
+
+Every start runs in a fresh process: the import of single_inference, then
+the construction of CustomCosyVoice. `legacy` builds the modules with random
+weights, loads the checkpoints to the device and casts them, as before
+init_empty_weights and load_checkpoint. `fast` is the default path, its
+first start below fp32 also writes the converted weights to an empty
+cache directory, so it is timed twice. Peak memory is the resident set size of the process, plus the
+allocated device memory on cuda. Drop the page cache between runs to time
+a cold disk.
+
+    python benchmarks/startup_report.py --model_path MediaTek-Research/BreezyVoice --precision fp16
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_load(self, llm_model, flow_model, hift_model):
+    import torch
+    self.llm.load_state_dict(torch.load(llm_model, map_location=self.device))
+    self.llm.to(self.device, self.dtype).eval()
+    self.flow.load_state_dict(torch.load(flow_model, map_location=self.device))
+    self.flow.to(self.device, self.dtype).eval()
+    self.hift.load_state_dict(torch.load(hift_model, map_location=self.device))
+    self.hift.remove_weight_norm()
+    self.hift.to(self.device, self.dtype).eval()
+
+
+def start(mode, model_path, precision, converted_cache_dir):
+    """Start the model in this process and report the times and peak memory"""
+    sys.path.insert(0, ROOT_DIR)
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+    begin = time.perf_counter()
+    import torch
+    import single_inference
+    imported = time.perf_counter()
+    if mode == 'legacy':
+        from contextlib import nullcontext
+        single_inference.init_empty_weights = nullcontext
+        single_inference.CustomCosyVoiceModel.load = legacy_load
+    single_inference.CustomCosyVoice(model_path, precision, cache_converted=mode != 'legacy', converted_cache_dir=converted_cache_dir)
+    loaded = time.perf_counter()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if torch.cuda.is_available():
+        peak += torch.cuda.max_memory_allocated() / 2 ** 20
+    print(json.dumps({'import_s': imported - begin, 'load_s': loaded - imported, 'peak_mib': peak}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the start time of the legacy and fast model loading")
+    parser.add_argument("--model_path", type=str, default="MediaTek-Research/BreezyVoice")
+    parser.add_argument("--precision", type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--converted_cache_dir", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        start(args.child, args.model_path, args.precision, args.converted_cache_dir)
+        return
+    print('{:>12} {:>10} {:>10} {:>10} {:>10}'.format('start', 'import s', 'load s', 'total s', 'peak MiB'))
+    with tempfile.TemporaryDirectory() as converted_cache_dir:
+        for name, mode in (('legacy', 'legacy'), ('fast first', 'fast'), ('fast', 'fast')):
+            command = [sys.executable, os.path.abspath(__file__), '--child', mode, '--model_path', args.model_path,
+                       '--converted_cache_dir', converted_cache_dir]
+            if args.precision is not None:
+                command += ['--precision', args.precision]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            report = json.loads(output.strip().splitlines()[-1])
+            print('{:>12} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.0f}'.format(
+                name, report['import_s'], report['load_s'], report['import_s'] + report['load_s'], report['peak_mib']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Text normalization throughput of a thread pool against NormalizerPool.
+
+Normalizes the same texts from `--clients` threads, as concurrent requests
+of the API would, either each in its own thread with the normalizers of the
+API process or through NormalizerPool workers. Every text gets a distinct
+number so that the cache of the pool is never hit.
+
+    python benchmarks/text_normalize_report.py --workers 1 2 4 8 --texts 256
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from text_normalizer import NormalizerPool, TextNormalizers
+
+TEMPLATES = [
+    "今天是2024年3月{}日，氣溫攝氏25度，降雨機率30%。",
+    "會議改到下午{}點半，請帶筆電[:ㄅㄧˇ]和第3季的報表。",
+    "The order #{} ships on 5/12 and costs $3.50.",
+]
+
+
+def throughput(normalize, texts, clients):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        list(executor.map(lambda text: normalize([text]), texts))
+    return len(texts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare threaded and multi-process text normalization")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--texts", type=int, default=128)
+    parser.add_argument("--clients", type=int, default=16)
+    args = parser.parse_args()
+
+    texts = [TEMPLATES[i % len(TEMPLATES)].format(i) for i in range(args.texts)]
+    threaded = NormalizerPool(num_workers=0, cache_size=0, normalizers=TextNormalizers())
+    print('{:>8} {:>12}'.format('workers', 'texts/s'))
+    print('{:>8} {:>12.1f}'.format('threads', throughput(threaded.normalize, texts, args.clients)))
+    for workers in args.workers:
+        pool = NormalizerPool(num_workers=workers, cache_size=0)
+        # wait for every worker to load its normalizers
+        pool.normalize(['暖身{}'.format(i) for i in range(workers * 4)])
+        print('{:>8} {:>12.1f}'.format(workers, throughput(pool.normalize, texts, args.clients)))
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import re
+import threading
+from collections import OrderedDict
+
+from utils.lexicon import always_augment_chars, get_lexicon
+
+# Sentence ends of cosyvoice.utils.frontend_utils.split_segments, the
+# separators are kept so that annotating a text sentence by sentence
+# reassembles it exactly
+SENTENCE_SPLIT = re.compile(r'((?<=[？！。.?!])\s*)')
+
+
+def split_sentences(text):
+    """Sentences of text alternating with the separators after them, sentences may be empty"""
+    return SENTENCE_SPLIT.split(text)
+
+
+def join_sentences(parts, annotated):
+    """Reassemble split_sentences parts with the non-empty sentences replaced, in order, by annotated"""
+    annotated = iter(annotated)
+    return ''.join(next(annotated) if i % 2 == 0 and part else part for i, part in enumerate(parts))
+
+
+class BopomofoAnnotator:
+    """Marks the bopomofo of rare characters and of uncommon readings in a text.
+
+    A character read as `phn` by the G2PW converter is written as `char[:phn]`
+    when it is rare in the training data, or when it has several readings,
+    `phn` is not the most common one and the character is not frequent
+    enough for the model to know its readings (or is in
+    always_augment_chars). Characters the converter gives no reading, or
+    that are already followed by a '[' annotation, are left as they are.
+
+    Both rules are folded into two sets computed once from the lexicon, so
+    each sentence is annotated in one scan. Results are kept per sentence in
+    an LRU cache of `cache_size` entries. annotate_batch converts all
+    sentences it misses with one converter call, and is the batch function
+    the API scheduler runs for the sentences of concurrent requests.
+    """
+
+    def __init__(self, converter, cache_size=4096, rare_frequency=500, polyphone_frequency=10000):
+        self.converter = converter
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        # characters seen rare_frequency times or more, the others are rare
+        self.common_chars = set()
+        # polyphonic character -> its most common reading, which is not marked
+        self.polyphones = {}
+        for char, frequency, pronunciations in get_lexicon().entries():
+            if frequency >= rare_frequency:
+                self.common_chars.add(char)
+            if len(pronunciations) >= 2 and (frequency < polyphone_frequency or char in always_augment_chars):
+                self.polyphones[char] = pronunciations[0]
+
+    def annotate_sentence(self, sentence, phns):
+        """Apply the rules to a sentence and the G2PW reading of each of its characters"""
+        parts = []
+        for i, (char, phn) in enumerate(zip(sentence, phns)):
+            if phn is not None and sentence[i + 1:i + 2] != '[' and \
+                    (char not in self.common_chars or self.polyphones.get(char, phn) != phn):
+                parts.append('{}[:{}]'.format(char, phn))
+            else:
+                parts.append(char)
+        return ''.join(parts)
+
+    def annotate_batch(self, sentences):
+        """Annotate a list of sentences, converting the ones not cached in one G2PW call"""
+        with self.lock:
+            found = {s: self.cache[s] for s in sentences if s in self.cache}
+        missing = [s for s in dict.fromkeys(sentences) if s not in found]
+        if missing:
+            for sentence, phns in zip(missing, self.converter(missing)):
+                found[sentence] = self.annotate_sentence(sentence, phns)
+        with self.lock:
+            for sentence, result in found.items():
+                self.cache[sentence] = result
+                self.cache.move_to_end(sentence)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return [found[s] for s in sentences]
+
+    def annotate(self, text):
+        """Annotate a whole text, sentence by sentence"""
+        parts = split_sentences(text)
+        return join_sentences(parts, self.annotate_batch([p for p in parts[::2] if p]))
@@ -0,0 +1,71 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+
+import numpy as np
+import torch
+from hyperpyyaml import load_hyperpyyaml
+from huggingface_hub import snapshot_download
+
+from cosyvoice.hifigan.hift_onnx import HiFTOnnxRuntime, export_hift_onnx
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='export the hift vocoder to onnx')
+    parser.add_argument('--model_dir', default='MediaTek-Research/BreezyVoice-300M', help='model directory or huggingface repo id')
+    parser.add_argument('--onnx_path', default=None, help='output file, defaults to hift.onnx in the model directory')
+    parser.add_argument('--opset_version', type=int, default=17)
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    model_dir = args.model_dir if os.path.exists(args.model_dir) else snapshot_download(args.model_dir)
+    onnx_path = args.onnx_path or os.path.join(model_dir, 'hift.onnx')
+    with open('{}/cosyvoice.yaml'.format(model_dir), 'r') as f:
+        configs = load_hyperpyyaml(f)
+    hift = configs['hift']
+    hift.load_state_dict(torch.load('{}/hift.pt'.format(model_dir), map_location='cpu'))
+    hift.remove_weight_norm()
+    export_hift_onnx(hift, onnx_path, opset_version=args.opset_version)
+    logging.info('exported {}'.format(onnx_path))
+
+    # check the graph against torch on a length it was not traced with
+    runtime = HiFTOnnxRuntime(onnx_path, hift.upsample_scale, providers=['CPUExecutionProvider'])
+    mel = torch.randn(2, hift.conv_pre.in_channels, 333)
+    phase_vec = hift.m_source.l_sin_gen.random_phase(2, mel.device)
+    noise = torch.randn(2, hift.nb_harmonics + 1, mel.size(2) * hift.upsample_scale)
+    with torch.inference_mode():
+        expected = hift(mel, phase_vec, noise).numpy()
+    speech = runtime.session.run(None, {'mel': mel.numpy(), 'phase_vec': phase_vec.numpy(), 'noise': noise.numpy()})[0]
+    logging.info('max abs difference from torch {:.2e}'.format(np.abs(speech - expected).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,11 +13,77 @@
 # limitations under the License.
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import pack, rearrange, repeat
-from matcha.models.components.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample1D, TimestepEmbedding, Upsample1D
+from matcha.models.components.decoder import SinusoidalPosEmb, Block1D as _Block1D, ResnetBlock1D as _ResnetBlock1D, Downsample1D, TimestepEmbedding, Upsample1D
 from matcha.models.components.transformer import BasicTransformerBlock
 
 
+def masked_group_norm(norm: nn.GroupNorm, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """nn.GroupNorm over the frames of x (B, C, T) where mask (B, 1, T) is set"""
+    batch_size, channels, frames = x.shape
+    h = x.float().view(batch_size, norm.num_groups, -1, frames)
+    mask = mask.float().view(batch_size, 1, 1, frames)
+    count = mask.sum(dim=(2, 3), keepdim=True) * h.size(2)
+    mean = (h * mask).sum(dim=(2, 3), keepdim=True) / count
+    var = ((h - mean).pow(2) * mask).sum(dim=(2, 3), keepdim=True) / count
+    h = ((h - mean) * torch.rsqrt(var + norm.eps)).view(batch_size, channels, frames)
+    return (h * norm.weight.float().view(1, -1, 1) + norm.bias.float().view(1, -1, 1)).to(x.dtype)
+
+
+class KeyPaddingAttnProcessor:
+    """Self attention processor of the U-Net transformer blocks.
+
+    attention_mask is the key padding mask (B, 1, T) of the frames, True where
+    valid, or None when no row is padded. It is broadcast over heads and
+    queries by scaled_dot_product_attention, so no (B * heads, T, T) mask is
+    built, and without one the fused kernels run unmasked.
+    """
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None):
+        batch_size = hidden_states.size(0)
+        context = hidden_states if encoder_hidden_states is None else encoder_hidden_states
+        query = attn.to_q(hidden_states).view(batch_size, -1, attn.heads, attn.inner_dim // attn.heads).transpose(1, 2)
+        key = attn.to_k(context).view(batch_size, -1, attn.heads, attn.inner_dim // attn.heads).transpose(1, 2)
+        value = attn.to_v(context).view(batch_size, -1, attn.heads, attn.inner_dim // attn.heads).transpose(1, 2)
+        if attention_mask is not None:
+            attention_mask = attention_mask.unsqueeze(1)
+        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.inner_dim)
+        # linear proj and dropout
+        return attn.to_out[1](attn.to_out[0](hidden_states))
+
+
+class Block1D(_Block1D):
+    """Block1D whose group norm skips the padding frames of a batch, so every
+    row is normalized as it would be on its own.
+
+    norm_mask is the mask (B, 1, T) of the frames, or None when no row is
+    padded, then the plain nn.GroupNorm runs.
+    """
+
+    def forward(self, x, mask, norm_mask=None):
+        if norm_mask is None:
+            return super().forward(x, mask)
+        conv, norm, act = self.block
+        output = act(masked_group_norm(norm, conv(x * mask), norm_mask))
+        return output * mask
+
+
+class ResnetBlock1D(_ResnetBlock1D):
+    def __init__(self, dim, dim_out, time_emb_dim, groups=8):
+        super().__init__(dim, dim_out, time_emb_dim, groups=groups)
+        self.block1 = Block1D(dim, dim_out, groups=groups)
+        self.block2 = Block1D(dim_out, dim_out, groups=groups)
+
+    def forward(self, x, mask, time_emb, norm_mask=None):
+        h = self.block1(x, mask, norm_mask)
+        h += self.mlp(time_emb).unsqueeze(-1)
+        h = self.block2(h, mask, norm_mask)
+        output = h + self.res_conv(x * mask)
+        return output
+
+
 class ConditionalDecoder(nn.Module):
     def __init__(
         self,
@@ -125,6 +191,9 @@ class ConditionalDecoder(nn.Module):
         self.final_block = Block1D(channels[-1], channels[-1])
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
+        for m in self.modules():
+            if isinstance(m, BasicTransformerBlock):
+                m.attn1.set_processor(KeyPaddingAttnProcessor())
 
 
     def initialize_weights(self):
@@ -170,17 +239,21 @@ class ConditionalDecoder(nn.Module):
         if cond is not None:
             x = pack([x, cond], "b * t")[0]
 
+        # Unpadded batches (one sentence, or its guidance pair) attend and
+        # group norm without a mask; downsampling keeps every frame valid
+        padded = not bool(mask.all())
+
         hiddens = []
         masks = [mask]
         for resnet, transformer_blocks, downsample in self.down_blocks:
             mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
+            pad_mask = mask_down.bool() if padded else None
+            x = resnet(x, mask_down, t, pad_mask)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=pad_mask,
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
@@ -191,13 +264,13 @@ class ConditionalDecoder(nn.Module):
         mask_mid = masks[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
+            pad_mask = mask_mid.bool() if padded else None
+            x = resnet(x, mask_mid, t, pad_mask)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=pad_mask,
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
@@ -206,17 +279,17 @@ class ConditionalDecoder(nn.Module):
             mask_up = masks.pop()
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
+            pad_mask = mask_up.bool() if padded else None
+            x = resnet(x, mask_up, t, pad_mask)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=pad_mask,
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
             x = upsample(x * mask_up)
-        x = self.final_block(x, mask_up)
+        x = self.final_block(x, mask_up, pad_mask)
         output = self.final_proj(x * mask_up)
         return output * mask
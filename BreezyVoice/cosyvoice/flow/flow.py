@@ -17,6 +17,7 @@ from typing import Dict, Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from omegaconf import DictConfig
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -104,14 +105,57 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_token_len,
                   prompt_feat,
                   prompt_feat_len,
-                  embedding):
+                  embedding,
+                  n_timesteps=10,
+                  solver=None,
+                  t_scheduler=None,
+                  cfg_rate=None,
+                  cfg_interval=None,
+                  cfg_schedule=None):
         assert token.shape[0] == 1
+        feat, _ = self.inference_batch(token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len,
+                                       embedding, n_timesteps=n_timesteps, solver=solver, t_scheduler=t_scheduler,
+                                       cfg_rate=cfg_rate, cfg_interval=cfg_interval, cfg_schedule=cfg_schedule)
+        return feat
+
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        n_timesteps=10,
+                        solver=None,
+                        t_scheduler=None,
+                        cfg_rate=None,
+                        cfg_interval=None,
+                        cfg_schedule=None):
+        """Decode a padded batch of speech tokens to mel spectrograms
+
+        Args:
+            token, token_len: speech tokens (B, T) padded on the right, and their lengths (B,)
+            prompt_token, prompt_token_len: prompt speech tokens (B, T') padded on the right
+            prompt_feat, prompt_feat_len: prompt mel (B, T'', C) padded on the right
+            embedding: speaker embedding (B, D)
+            n_timesteps, solver, t_scheduler, cfg_rate, cfg_interval, cfg_schedule:
+                see ConditionalCFM.forward
+
+        Returns:
+            the mel spectrograms (B, C, T_mel) of the tokens, without the
+            prompt frames and zero padded, and their lengths (B,)
+        """
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
         embedding = self.spk_embed_affine_layer(embedding)
 
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        # concat text and prompt_text, every row without the padding in between
+        token_len, prompt_token_len = token_len.tolist(), prompt_token_len.tolist()
+        token = pad_sequence([torch.concat([prompt_token[i, :p], token[i, :t]])
+                              for i, (p, t) in enumerate(zip(prompt_token_len, token_len))], batch_first=True)
+        token_len = torch.tensor([p + t for p, t in zip(prompt_token_len, token_len)], dtype=torch.int32, device=token.device)
         mask = (~make_pad_mask(token_len)).float().unsqueeze(-1).to(embedding)
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
@@ -119,13 +163,13 @@ class MaskedDiffWithXvec(torch.nn.Module):
         h, h_lengths = self.encoder(token, token_len)
         h = self.encoder_proj(h)
         feat_len = (token_len / 50 * 22050 / 256).int()
-        h, h_lengths = self.length_regulator(h, feat_len)
+        h, h_lengths = self.length_regulator(h, feat_len, token_len)
 
         # get conditions
-        conds = torch.zeros([1, feat_len.max().item(), self.output_size], device=token.device)
-        if prompt_feat.shape[1] != 0:
-            for i, j in enumerate(prompt_feat_len):
-                conds[i, :j] = prompt_feat[i]
+        prompt_feat_len = prompt_feat_len.tolist() if prompt_feat.shape[1] != 0 else [0] * token.shape[0]
+        conds = torch.zeros([token.shape[0], feat_len.max().item(), self.output_size], device=token.device)
+        for i, j in enumerate(prompt_feat_len):
+            conds[i, :j] = prompt_feat[i, :j]
         conds = conds.transpose(1, 2)
 
         mask = (~make_pad_mask(feat_len)).to(h)
@@ -134,8 +178,15 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=n_timesteps,
+            solver=solver,
+            t_scheduler=t_scheduler,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval,
+            cfg_schedule=cfg_schedule
         )
-        if prompt_feat.shape[1] != 0:
-            feat = feat[:, :, prompt_feat.shape[1]:]
-        return feat
+        # crop the prompt frames of every row
+        feat_len = [j - p for j, p in zip(feat_len.tolist(), prompt_feat_len)]
+        feat = pad_sequence([feat[i, :, p:p + j].transpose(0, 1) for i, (p, j) in enumerate(zip(prompt_feat_len, feat_len))],
+                            batch_first=True).transpose(1, 2)
+        return feat, torch.tensor(feat_len, dtype=torch.int32, device=feat.device)
@@ -11,11 +11,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import math
+
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
 
 class ConditionalCFM(BASECFM):
+    # solver name -> method, the number of estimator calls per step is 1 for
+    # euler and ab2 and 2 for midpoint and heun
+    SOLVERS = {'euler': 'solve_euler', 'midpoint': 'solve_midpoint', 'heun': 'solve_heun', 'ab2': 'solve_ab2'}
+    T_SCHEDULERS = ('linear', 'cosine')
+    # guidance rate curve over t, scaling inference_cfg_rate
+    CFG_SCHEDULES = ('constant', 'linear', 'cosine')
+
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(
             n_feats=in_channels,
@@ -31,7 +40,8 @@ class ConditionalCFM(BASECFM):
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver=None, t_scheduler=None,
+                cfg_rate=None, cfg_interval=None, cfg_schedule=None):
         """Forward diffusion
 
         Args:
@@ -44,24 +54,95 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): one of SOLVERS. Defaults to cfm_params.solver.
+            t_scheduler (str, optional): one of T_SCHEDULERS. Defaults to cfm_params.t_scheduler.
+            cfg_rate (float, optional): classifier-free guidance rate. Defaults to cfm_params.inference_cfg_rate.
+            cfg_interval (tuple, optional): (start, end), guidance is applied to the
+                estimator calls at start <= t < end only, or t <= 1 for an end of 1,
+                the others skip the unconditional pass. Defaults to (0, 1), every call.
+            cfg_schedule (str, optional): one of CFG_SCHEDULES, the guidance rate
+                over t. Defaults to constant.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
+        solver = solver or self.solver
+        if solver not in self.SOLVERS:
+            raise ValueError('unknown solver {!r}, expected one of {}'.format(solver, ', '.join(self.SOLVERS)))
         z = torch.randn_like(mu) * temperature
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device)
-        if self.t_scheduler == 'cosine':
+        t_span = self.get_t_span(n_timesteps, t_scheduler or self.t_scheduler)
+        guidance = self.get_guidance(self.inference_cfg_rate if cfg_rate is None else cfg_rate,
+                                     cfg_interval or (0.0, 1.0), cfg_schedule or 'constant')
+        return getattr(self, self.SOLVERS[solver])(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond,
+                                                   guidance=guidance)
+
+    def get_t_span(self, n_timesteps, t_scheduler):
+        """Time steps (n_timesteps + 1,), on the host so the solvers can tell
+        which steps are guided without waiting for the device"""
+        if t_scheduler not in self.T_SCHEDULERS:
+            raise ValueError('unknown t_scheduler {!r}, expected one of {}'.format(t_scheduler, ', '.join(self.T_SCHEDULERS)))
+        t_span = torch.linspace(0, 1, n_timesteps + 1)
+        if t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond)
+        return t_span.tolist()
+
+    def get_guidance(self, cfg_rate, cfg_interval, cfg_schedule):
+        """Return g(t), the guidance rate of an estimator call at time t"""
+        if cfg_schedule not in self.CFG_SCHEDULES:
+            raise ValueError('unknown cfg_schedule {!r}, expected one of {}'.format(cfg_schedule, ', '.join(self.CFG_SCHEDULES)))
+        start, end = cfg_interval
+        if end >= 1:
+            # the last estimator call of midpoint and heun is at t = 1
+            end = math.inf
+
+        def guidance(t):
+            if not start <= t < end:
+                return 0.0
+            if cfg_schedule == 'linear':
+                return cfg_rate * (1 - t)
+            if cfg_schedule == 'cosine':
+                return cfg_rate * math.cos(0.5 * math.pi * t)
+            return cfg_rate
+        return guidance
+
+    def velocity_fn(self, mu, mask, spks, cond, guidance):
+        """Return f(x, t), the guided velocity field of the estimator at host time t
+
+        Classifier-Free Guidance inference introduced in VoiceBox. The
+        conditional and unconditional passes run as one estimator call on a
+        doubled batch, the first half conditional and the second half with
+        zeroed mu, spks and cond. Calls with a guidance(t) of 0 run the
+        conditional half only
+        """
+        def conditional(x, t):
+            return self.estimator(x, mask, mu, torch.full((), t, device=x.device), spks, cond)
+
+        batch_size = mu.size(0)
+        x_in = torch.concat([torch.zeros_like(mu), torch.zeros_like(mu)], dim=0)
+        mask_in = torch.concat([mask, mask], dim=0)
+        mu_in = torch.concat([mu, torch.zeros_like(mu)], dim=0)
+        spks_in = torch.concat([spks, torch.zeros_like(spks)], dim=0) if spks is not None else None
+        cond_in = torch.concat([cond, torch.zeros_like(cond)], dim=0) if cond is not None else None
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+        def velocity(x, t):
+            cfg_rate = guidance(t)
+            if cfg_rate == 0:
+                return conditional(x, t)
+            x_in[:batch_size] = x
+            x_in[batch_size:] = x
+            t_in = torch.full((), t, device=x.device)
+            dphi_dt, cfg_dphi_dt = torch.split(self.estimator(x_in, mask_in, mu_in, t_in, spks_in, cond_in),
+                                               batch_size, dim=0)
+            return (1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt
+        return velocity
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, guidance):
         """
         Fixed euler solver for ODEs.
         Args:
             x (torch.Tensor): random noise
-            t_span (torch.Tensor): n_timesteps interpolated
-                shape: (n_timesteps + 1,)
+            t_span (list): n_timesteps interpolated, n_timesteps + 1 floats
             mu (torch.Tensor): output of encoder
                 shape: (batch_size, n_feats, mel_timesteps)
             mask (torch.Tensor): output_mask
@@ -69,7 +150,9 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            guidance (callable): guidance rate over t, see get_guidance
         """
+        velocity = self.velocity_fn(mu, mask, spks, cond, guidance)
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
 
         # I am storing this because I can later plot it by putting a debugger here and saving it to a file
@@ -77,17 +160,7 @@ class ConditionalCFM(BASECFM):
         sol = []
 
         for step in range(1, len(t_span)):
-            dphi_dt = self.estimator(x, mask, mu, t, spks, cond)
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            if self.inference_cfg_rate > 0:
-                cfg_dphi_dt = self.estimator(
-                    x, mask,
-                    torch.zeros_like(mu), t,
-                    torch.zeros_like(spks) if spks is not None else None,
-                    torch.zeros_like(cond)
-                )
-                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt -
-                           self.inference_cfg_rate * cfg_dphi_dt)
+            dphi_dt = velocity(x, t)
             x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
@@ -96,6 +169,44 @@ class ConditionalCFM(BASECFM):
 
         return sol[-1]
 
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond, guidance):
+        """Explicit midpoint solver, two estimator calls per step, arguments as in solve_euler"""
+        velocity = self.velocity_fn(mu, mask, spks, cond, guidance)
+        for t, t_next in zip(t_span[:-1], t_span[1:]):
+            dt = t_next - t
+            x_mid = x + 0.5 * dt * velocity(x, t)
+            x = x + dt * velocity(x_mid, t + 0.5 * dt)
+        return x
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond, guidance):
+        """Heun's (trapezoidal) solver, two estimator calls per step, arguments as in solve_euler"""
+        velocity = self.velocity_fn(mu, mask, spks, cond, guidance)
+        for t, t_next in zip(t_span[:-1], t_span[1:]):
+            dt = t_next - t
+            dphi_dt = velocity(x, t)
+            x_euler = x + dt * dphi_dt
+            x = x + 0.5 * dt * (dphi_dt + velocity(x_euler, t_next))
+        return x
+
+    def solve_ab2(self, x, t_span, mu, mask, spks, cond, guidance):
+        """Two step Adams-Bashforth solver for non uniform steps, arguments as in solve_euler
+
+        Reuses the velocity of the previous step, so it costs one estimator
+        call per step like euler but is second order. The first step is euler.
+        """
+        velocity = self.velocity_fn(mu, mask, spks, cond, guidance)
+        prev_dphi_dt, prev_dt = None, None
+        for t, t_next in zip(t_span[:-1], t_span[1:]):
+            dt = t_next - t
+            dphi_dt = velocity(x, t)
+            if prev_dphi_dt is None:
+                x = x + dt * dphi_dt
+            else:
+                r = dt / prev_dt
+                x = x + dt * ((1 + 0.5 * r) * dphi_dt - 0.5 * r * prev_dphi_dt)
+            prev_dphi_dt, prev_dt = dphi_dt, dt
+        return x
+
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
         """Computes diffusion loss
 
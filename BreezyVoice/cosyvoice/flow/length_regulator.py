@@ -14,6 +14,7 @@
 from typing import Tuple
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from cosyvoice.utils.mask import make_pad_mask
 
 
@@ -40,8 +41,13 @@ class InterpolateRegulator(nn.Module):
         )
         self.model = nn.Sequential(*model)
 
-    def forward(self, x, ylens=None):
+    def forward(self, x, ylens=None, xlens=None):
         # x in (B, T, D)
+        if xlens is not None and x.size(0) > 1:
+            # the padding would be stretched into the rows and taken into the
+            # group norm statistics, regulate every row on its own
+            out = [self(x[i:i + 1, :j], ylens[i:i + 1])[0][0] for i, j in enumerate(xlens.tolist())]
+            return pad_sequence(out, batch_first=True), ylens
         mask = (~make_pad_mask(ylens)).to(x).unsqueeze(-1)
         x = F.interpolate(x.transpose(1, 2).contiguous(), size=ylens.max(), mode='nearest')
         out = self.model(x).transpose(1, 2).contiguous()
@@ -107,6 +107,7 @@ class SineGen(torch.nn.Module):
             voiced_threshold = 0,
             flag_for_pulse=False)
     samp_rate: sampling rate in Hz
+    upsample_scale: number of samples per f0 frame (default 1)
     harmonic_num: number of harmonic overtones (default 0)
     sine_amp: amplitude of sine-wavefrom (default 0.1)
     noise_std: std of Gaussian noise (default 0.003)
@@ -118,46 +119,68 @@ class SineGen(torch.nn.Module):
 
     def __init__(self, samp_rate, harmonic_num=0,
                  sine_amp=0.1, noise_std=0.003,
-                 voiced_threshold=0):
+                 voiced_threshold=0, upsample_scale=1):
         super(SineGen, self).__init__()
         self.sine_amp = sine_amp
         self.noise_std = noise_std
         self.harmonic_num = harmonic_num
         self.sampling_rate = samp_rate
         self.voiced_threshold = voiced_threshold
+        self.upsample_scale = upsample_scale
 
     def _f02uv(self, f0):
         # generate uv signal
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
+    def random_phase(self, batch_size, device):
+        """Draw the initial phase of each harmonic, the fundamental starts at 0"""
+        u_dist = Uniform(low=-np.pi, high=np.pi)
+        phase_vec = u_dist.sample(sample_shape=(batch_size, self.harmonic_num + 1, 1)).to(device)
+        phase_vec[:, 0, :] = 0
+        return phase_vec
+
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, cycles=None, phase_vec=None, noise=None):
         """
-        :param f0: [B, 1, sample_len], Hz
-        :return: [B, 1, sample_len]
+        :param f0: [B, 1, frame_len], Hz, constant over the upsample_scale
+            samples of each frame
+        :param cycles: [B, harmonic_num + 1, 1], cycles of each harmonic
+            elapsed before the first sample, when continuing a stream
+        :param phase_vec: [B, harmonic_num + 1, 1], initial phase of each
+            harmonic, drawn by random_phase when not given
+        :param noise: [B, harmonic_num + 1, sample_len], standard normal
+            noise, drawn when not given
+        :return: [B, 1, sample_len], sample_len = frame_len * upsample_scale
         """
-
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
-        for i in range(self.harmonic_num + 1):
-            F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
-
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        f0 = f0.float()
+        harmonics = torch.arange(1, self.harmonic_num + 2, device=f0.device, dtype=f0.dtype).view(1, -1, 1)
+        # cycles per sample of every harmonic in every frame
+        F_mat = f0 * harmonics / self.sampling_rate
+
+        # the phase is integrated at frame rate, in float64 as the sum runs
+        # over the whole utterance, then ramps linearly within each frame
+        frame_cycles = f0.double() * harmonics.double() * self.upsample_scale / self.sampling_rate
+        frame_start = ((torch.cumsum(frame_cycles, dim=-1) - frame_cycles) % 1).float()
+        if cycles is not None:
+            frame_start = frame_start + cycles
+        ramp = torch.arange(1, self.upsample_scale + 1, device=f0.device, dtype=f0.dtype)
+        theta_mat = frame_start.unsqueeze(-1) + F_mat.unsqueeze(-1) * ramp
+        theta_mat = 2 * np.pi * (theta_mat.flatten(2) % 1)
+        if phase_vec is None:
+            phase_vec = self.random_phase(f0.size(0), f0.device)
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
 
         # generate uv signal
-        uv = self._f02uv(f0)
+        uv = self._f02uv(f0).repeat_interleave(self.upsample_scale, dim=-1)
 
         # noise: for unvoiced should be similar to sine_amp
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = noise_amp * (torch.randn_like(sine_waves) if noise is None else noise)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -170,6 +193,7 @@ class SourceModuleHnNSF(torch.nn.Module):
     SourceModule(sampling_rate, harmonic_num=0, sine_amp=0.1,
                  add_noise_std=0.003, voiced_threshod=0)
     sampling_rate: sampling_rate in Hz
+    upsample_scale: number of samples per F0 frame
     harmonic_num: number of harmonic above F0 (default: 0)
     sine_amp: amplitude of sine source signal (default: 0.1)
     add_noise_std: std of additive Gaussian noise (default: 0.003)
@@ -177,10 +201,11 @@ class SourceModuleHnNSF(torch.nn.Module):
         by sine_amp
     voiced_threshold: threhold to set U/V given F0 (default: 0)
     Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
-    F0_sampled (batchsize, length, 1)
+    F0_sampled (batchsize, frames, 1)
     Sine_source (batchsize, length, 1)
     noise_source (batchsize, length 1)
     uv (batchsize, length, 1)
+    with length = frames * upsample_scale
     """
 
     def __init__(self, sampling_rate, upsample_scale, harmonic_num=0, sine_amp=0.1,
@@ -192,22 +217,23 @@ class SourceModuleHnNSF(torch.nn.Module):
 
         # to produce sine waveforms
         self.l_sin_gen = SineGen(sampling_rate, harmonic_num,
-                                 sine_amp, add_noise_std, voiced_threshod)
+                                 sine_amp, add_noise_std, voiced_threshod, upsample_scale)
 
         # to merge source harmonics into a single excitation
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, cycles=None, phase_vec=None, noise=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
-        F0_sampled (batchsize, length, 1)
+        F0_sampled (batchsize, frames, 1)
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
+        cycles, phase_vec, noise: see SineGen.forward
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), cycles, phase_vec, noise)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -241,6 +267,7 @@ class HiFTGenerator(nn.Module):
             lrelu_slope: float = 0.1,
             audio_limit: float = 0.99,
             f0_predictor: torch.nn.Module = None,
+            stream_context_len: int = 24,
     ):
         super(HiFTGenerator, self).__init__()
 
@@ -250,6 +277,10 @@ class HiFTGenerator(nn.Module):
         self.istft_params = istft_params
         self.lrelu_slope = lrelu_slope
         self.audio_limit = audio_limit
+        # mel frames on each side of a chunk that the output of the chunk
+        # depends on, through the f0 predictor and the generator convs
+        self.stream_context_len = stream_context_len
+        self.upsample_scale = int(np.prod(upsample_rates) * istft_params["hop_len"])
 
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
@@ -260,7 +291,6 @@ class HiFTGenerator(nn.Module):
             sine_amp=nsf_alpha,
             add_noise_std=nsf_sigma,
             voiced_threshod=nsf_voiced_threshold)
-        self.f0_upsamp = torch.nn.Upsample(scale_factor=np.prod(upsample_rates) * istft_params["hop_len"])
 
         self.conv_pre = weight_norm(
             Conv1d(in_channels, base_channels, 7, 1, padding=3)
@@ -314,31 +344,66 @@ class HiFTGenerator(nn.Module):
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
         self.f0_predictor = f0_predictor
 
-    def _f02source(self, f0: torch.Tensor) -> torch.Tensor:
-        f0 = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-
-        har_source, _, _ = self.m_source(f0)
+    def _f02source(self, f0: torch.Tensor, cycles: torch.Tensor = None, phase_vec: torch.Tensor = None,
+                   noise: torch.Tensor = None) -> torch.Tensor:
+        # the source module upsamples the frame rate f0 itself
+        har_source, _, _ = self.m_source(f0[:, :, None], cycles, phase_vec, noise)
         return har_source.transpose(1, 2)
 
+    def _dft_basis(self, device):
+        """Real and imaginary onesided DFT basis (n_fft // 2 + 1, n_fft)"""
+        n_fft = self.istft_params["n_fft"]
+        angle = 2 * np.pi * torch.outer(torch.arange(n_fft // 2 + 1, device=device), torch.arange(n_fft, device=device)) / n_fft
+        return torch.cos(angle), torch.sin(angle)
+
     def _stft(self, x):
+        if torch.onnx.is_in_onnx_export():
+            # onnx has no complex tensors, run the stft as strided convolutions
+            # with the windowed DFT basis instead, as torch.stft(center=True)
+            n_fft = self.istft_params["n_fft"]
+            window = self.stft_window.to(x.device)
+            cos, sin = self._dft_basis(x.device)
+            x = F.pad(x[:, None], (n_fft // 2, n_fft // 2), mode="reflect")
+            real = F.conv1d(x, (cos * window)[:, None], stride=self.istft_params["hop_len"])
+            imag = F.conv1d(x, (-sin * window)[:, None], stride=self.istft_params["hop_len"])
+            return real, imag
+        # the ffts only run in fp32 on cpu, in any precision they are cheap
         spec = torch.stft(
-            x,
+            x.float(),
             self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
             return_complex=True)
-        spec = torch.view_as_real(spec)  # [B, F, TT, 2]
+        spec = torch.view_as_real(spec).to(x.dtype)  # [B, F, TT, 2]
         return spec[..., 0], spec[..., 1]
 
     def _istft(self, magnitude, phase):
+        magnitude, phase = magnitude.float(), phase.float()
         magnitude = torch.clip(magnitude, max=1e2)
         real = magnitude * torch.cos(phase)
         img = magnitude * torch.sin(phase)
+        if torch.onnx.is_in_onnx_export():
+            # inverse DFT, overlap-add and window normalization as transposed
+            # convolutions, as torch.istft(center=True)
+            n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+            window = self.stft_window.to(magnitude.device)
+            cos, sin = self._dft_basis(magnitude.device)
+            scale = torch.full((n_fft // 2 + 1, 1), 2.0 / n_fft, device=magnitude.device)
+            scale[0], scale[-1] = 1.0 / n_fft, 1.0 / n_fft
+            x = F.conv_transpose1d(real, (scale * cos * window)[:, None], stride=hop_len) + \
+                F.conv_transpose1d(img, (-scale * sin * window)[:, None], stride=hop_len)
+            envelope = F.conv_transpose1d(torch.ones_like(real[:, :1]), (window ** 2)[None, None], stride=hop_len)
+            x = x / envelope
+            return x[:, 0, n_fft // 2:x.size(2) - n_fft // 2]
         inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
         return inverse_transform
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, phase_vec: torch.Tensor = None, noise: torch.Tensor = None) -> torch.Tensor:
+        """phase_vec and noise are the randomness of the source, see SineGen.forward"""
         f0 = self.f0_predictor(x)
-        s = self._f02source(f0)
+        s = self._f02source(f0, phase_vec=phase_vec, noise=noise)
+        return self.decode(x, s)
 
+    def decode(self, x: torch.Tensor, s: torch.Tensor) -> torch.Tensor:
+        """Generate the waveform of mel x (B, C, T) excited by source s (B, 1, T * upsample_scale)"""
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
@@ -380,12 +445,88 @@ class HiFTGenerator(nn.Module):
             l.remove_weight_norm()
         remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
-        self.source_module.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
+        # source_downs and m_source have no weight norm
         for l in self.source_resblocks:
             l.remove_weight_norm()
+        self.f0_predictor.remove_weight_norm()
 
     @torch.inference_mode()
     def inference(self, mel: torch.Tensor) -> torch.Tensor:
         return self.forward(x=mel)
+
+    @staticmethod
+    def pad_mel(mel: torch.Tensor, mel_len: torch.Tensor) -> torch.Tensor:
+        """Repeat the last frame of every row of mel (B, C, T) over its padding,
+        zero log mel would be loud and leak into the end of the shorter rows"""
+        last = (mel_len.long() - 1).clamp(min=0).view(-1, 1, 1).expand(-1, mel.size(1), 1)
+        mask = torch.arange(mel.size(2), device=mel.device).view(1, 1, -1) < mel_len.view(-1, 1, 1)
+        return torch.where(mask, mel, mel.gather(2, last))
+
+    @torch.inference_mode()
+    def inference_batch(self, mel: torch.Tensor, mel_len: torch.Tensor) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+        """Vocode a padded batch of mel spectrograms
+
+        Args:
+            mel: mel spectrograms (B, C, T) padded on the right
+            mel_len: their lengths (B,)
+
+        Returns:
+            the waveforms (B, T * upsample_scale), zero past the end of
+            every row, and their lengths (B,)
+        """
+        speech = self.forward(x=self.pad_mel(mel, mel_len))
+        speech_len = mel_len * self.upsample_scale
+        mask = torch.arange(speech.size(1), device=speech.device).view(1, -1) < speech_len.view(-1, 1)
+        return speech * mask, speech_len
+
+    @torch.inference_mode()
+    def inference_stream(self, mel: torch.Tensor, cache: tp.Optional[dict] = None,
+                         finalize: bool = False) -> tp.Tuple[torch.Tensor, dict]:
+        """Vocode a mel spectrogram chunk by chunk
+
+        Every call appends the mel chunk (B, C, T) to the frames received
+        so far and returns the waveform (B, T' * upsample_scale) of the
+        frames that have stream_context_len frames of lookahead, the rest
+        waits for the next chunk or finalize=True. Each step runs the
+        generator over the new frames plus stream_context_len frames of
+        context on both sides. The source excitation of the left context
+        and the phase of every harmonic are carried in the cache, so the
+        concatenated output matches inference on the whole mel up to
+        numeric tolerance, given the same random initial phase and apart
+        from the additive noise of the source, which is drawn per sample.
+
+        Args:
+            mel: the next mel chunk (B, C, T), T may be 0
+            cache: the cache returned by the previous call, None to start
+            finalize: the chunk is the last one
+
+        Returns:
+            the new waveform (B, T' * upsample_scale) and the cache
+        """
+        if cache is None:
+            cache = {'mel': mel[:, :, :0],
+                     'vocoded': 0,
+                     'source': torch.zeros(mel.size(0), 1, 0, device=mel.device, dtype=mel.dtype),
+                     'cycles': torch.zeros(mel.size(0), self.nb_harmonics + 1, 1, device=mel.device),
+                     'phase_vec': self.m_source.l_sin_gen.random_phase(mel.size(0), mel.device)}
+        mel = torch.concat([cache['mel'], mel], dim=2)
+        # frames [0, start) of mel are context that was vocoded before, with its
+        # source in the cache. Frames [start, end) are vocoded now
+        start = cache['vocoded']
+        end = mel.size(2) if finalize else mel.size(2) - self.stream_context_len
+        if end <= start:
+            return torch.zeros(mel.size(0), 0, device=mel.device), dict(cache, mel=mel)
+
+        f0 = self.f0_predictor(mel)[:, start:]
+        source = torch.concat([cache['source'], self._f02source(f0, cache['cycles'], cache['phase_vec'])], dim=2)
+        speech = self.decode(mel, source)[:, start * self.upsample_scale:end * self.upsample_scale]
+
+        harmonics = torch.arange(1, self.nb_harmonics + 2, device=mel.device).view(1, -1, 1)
+        cycles = f0[:, :end - start].float().sum(dim=1).view(-1, 1, 1) * self.upsample_scale / self.sampling_rate
+        keep = max(end - self.stream_context_len, 0)
+        cache = {'mel': mel[:, :, keep:],
+                 'vocoded': end - keep,
+                 'source': source[:, :, keep * self.upsample_scale:end * self.upsample_scale],
+                 'cycles': (cache['cycles'] + cycles * harmonics) % 1,
+                 'phase_vec': cache['phase_vec']}
+        return speech, cache
@@ -0,0 +1,85 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu, Kai Hu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export HiFTGenerator to ONNX and run it with onnxruntime.
+
+The graph computes HiFTGenerator.forward. Its stft and istft are traced as
+convolutions with the DFT basis, since onnx has no complex tensors. The
+randomness of the source excitation comes in as inputs:
+
+    mel (B, C, T), phase_vec (B, nb_harmonics + 1, 1),
+    noise (B, nb_harmonics + 1, T * upsample_scale) -> speech (B, T * upsample_scale)
+"""
+import inspect
+from typing import Tuple
+
+import numpy as np
+import onnxruntime
+import torch
+
+from cosyvoice.hifigan.generator import HiFTGenerator
+
+
+def export_hift_onnx(hift, onnx_path, num_frames=200, opset_version=17):
+    """Export `hift`, whose weight norm must already be removed, to `onnx_path`"""
+    hift = hift.float().cpu().eval()
+    mel = torch.randn(1, hift.conv_pre.in_channels, num_frames)
+    phase_vec = hift.m_source.l_sin_gen.random_phase(1, mel.device)
+    noise = torch.randn(1, hift.nb_harmonics + 1, num_frames * hift.upsample_scale)
+    # newer torch versions default to the dynamo exporter, the graph is traced
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(
+        hift,
+        (mel, phase_vec, noise),
+        onnx_path,
+        input_names=['mel', 'phase_vec', 'noise'],
+        output_names=['speech'],
+        dynamic_axes={'mel': {0: 'batch', 2: 'frames'},
+                      'phase_vec': {0: 'batch'},
+                      'noise': {0: 'batch', 2: 'samples'},
+                      'speech': {0: 'batch', 1: 'samples'}},
+        opset_version=opset_version,
+        do_constant_folding=True,
+        **kwargs,
+    )
+
+
+class HiFTOnnxRuntime:
+    """Stand-in for HiFTGenerator.inference that runs an exported graph with onnxruntime"""
+
+    def __init__(self, onnx_path, upsample_scale=256, providers=None):
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if providers is None:
+            providers = ["CUDAExecutionProvider" if torch.cuda.is_available() else "CPUExecutionProvider"]
+        self.session = onnxruntime.InferenceSession(onnx_path, sess_options=option, providers=providers)
+        self.upsample_scale = upsample_scale
+        self.num_harmonics = self.session.get_inputs()[1].shape[1]
+
+    def inference(self, mel: torch.Tensor) -> torch.Tensor:
+        batch_size, num_frames = mel.size(0), mel.size(2)
+        # the same distributions as SineGen draws from
+        phase_vec = np.random.uniform(-np.pi, np.pi, (batch_size, self.num_harmonics, 1)).astype(np.float32)
+        phase_vec[:, 0] = 0
+        noise = np.random.standard_normal((batch_size, self.num_harmonics, num_frames * self.upsample_scale)).astype(np.float32)
+        speech = self.session.run(None, {'mel': mel.detach().float().cpu().numpy(),
+                                         'phase_vec': phase_vec,
+                                         'noise': noise})[0]
+        return torch.from_numpy(speech).to(mel.device)
+
+    def inference_batch(self, mel: torch.Tensor, mel_len: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """See HiFTGenerator.inference_batch"""
+        speech = self.inference(HiFTGenerator.pad_mel(mel, mel_len))
+        speech_len = mel_len * self.upsample_scale
+        mask = torch.arange(speech.size(1), device=speech.device).view(1, -1) < speech_len.view(-1, 1)
+        return speech * mask, speech_len
@@ -11,11 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, Optional, Union
+from typing import Dict, Generator, List, Optional, Tuple
 import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
+from cosyvoice.llm.runaway import RunawayGuard
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
@@ -132,17 +133,128 @@ class TransformerLM(torch.nn.Module):
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            sampling: Union[bool, int, float] = True,
-            beam_size: int = 1,
-            ignore_eos: bool = True,
-    ):
-        while True:
-            prob, indices = weighted_scores.softmax(dim=-1).topk(sampling)
-            top_ids = prob.multinomial(beam_size, replacement=True)
-            top_ids = indices[top_ids]
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-        return top_ids
+            sampling: int = 25,
+            ignore_eos: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Top-k sampling of one token per row, without host syncs
+
+        Args:
+            weighted_scores: (B, V) logits or log probabilities
+            sampling: number of top candidates to sample from
+            ignore_eos: (B,) bool, rows that may not sample EOS yet
+
+        Returns:
+            (B,) sampled token ids
+        """
+        if ignore_eos is not None:
+            eos_mask = torch.zeros_like(weighted_scores, dtype=torch.bool)
+            eos_mask[:, self.speech_token_size] = ignore_eos
+            weighted_scores = weighted_scores.masked_fill(eos_mask, -float('inf'))
+        prob, indices = weighted_scores.softmax(dim=-1).topk(sampling, dim=-1)
+        # argmax of prob / Exp(1) noise is distributed as prob, like multinomial but sync free
+        top_ids = (prob / torch.empty_like(prob).exponential_()).argmax(dim=-1, keepdim=True)
+        return indices.gather(-1, top_ids).squeeze(dim=-1)
+
+    @staticmethod
+    def capture_cuda_graph(fn, state: List[torch.Tensor]):
+        """Capture `fn` in a CUDA graph and return its replay function
+
+        `fn` is run twice on a side stream first, as capturing requires, and
+        `state`, the tensors it updates in place, is restored afterwards.
+        """
+        saved = [t.clone() for t in state]
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.autocast('cuda', dtype=torch.get_autocast_gpu_dtype(), enabled=torch.is_autocast_enabled(), cache_enabled=False):
+            with torch.cuda.stream(stream):
+                for _ in range(2):
+                    fn()
+            torch.cuda.current_stream().wait_stream(stream)
+            for t, saved_t in zip(state, saved):
+                t.copy_(saved_t)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                fn()
+        return graph.replay
+
+    @staticmethod
+    def static_cache_dtype(like: torch.Tensor) -> torch.dtype:
+        if torch.is_autocast_enabled() and like.device.type == 'cuda':
+            return torch.get_autocast_gpu_dtype()
+        if torch.is_autocast_cpu_enabled() and like.device.type == 'cpu':
+            return torch.get_autocast_cpu_dtype()
+        return like.dtype
+
+    @staticmethod
+    def chunk_mask(size: int, offset: int, device: torch.device) -> torch.Tensor:
+        """Causal mask (1, size, offset + size) of a chunk after `offset` cached positions"""
+        return torch.ones((1, size, offset + size), device=device, dtype=torch.bool).tril(diagonal=offset)
+
+    def supports_prompt_cache(self) -> bool:
+        """The prompt text can only be cached if the text encoder sees no future tokens"""
+        causal = self.text_encoder.use_dynamic_chunk or self.text_encoder.static_chunk_size == 1
+        return causal and all(getattr(layer, 'conv_module', None) is None for layer in self.text_encoder.encoders)
+
+    @torch.inference_mode()
+    def prefill_prompt(
+            self,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            embedding: torch.Tensor,
+    ) -> Optional[dict]:
+        """Run the part of the input that only depends on the voice,
+        [sos_eos, embedding, prompt_text], through the text encoder and the llm,
+        so that inference_batch can start every sentence from it
+
+        Args:
+            prompt_text: (1, L')
+            prompt_text_len: (1,)
+            embedding: (1, D), or (0, D) for no speaker embedding
+
+        Returns:
+            the text encoder and llm caches, or None if the text encoder
+            can't be cached
+        """
+        if not self.supports_prompt_cache():
+            return None
+        device = prompt_text.device
+        prompt_text = prompt_text[:, :prompt_text_len[0]]
+
+        # 1. encode prompt_text
+        prompt_text = self.text_embedding(prompt_text)
+        text_cache = self.text_encoder.init_static_cache(1, prompt_text.size(1), device, self.static_cache_dtype(prompt_text))
+        if prompt_text.size(1) != 0:
+            prompt_text = self.text_encoder.forward_chunk_static(prompt_text, text_cache, self.chunk_mask(prompt_text.size(1), 0, device))
+        prompt_text = self.text_encoder_affine_layer(prompt_text)
+
+        # 2. encode embedding
+        if embedding.shape[0] != 0:
+            embedding = F.normalize(embedding, dim=1)
+            embedding = self.spk_embed_affine_layer(embedding)
+            embedding = embedding.unsqueeze(dim=1)
+        else:
+            embedding = torch.zeros(1, 0, self.llm_input_size, device=device, dtype=prompt_text.dtype)
+
+        # 3. prefill the llm
+        sos_eos_emb = self.llm_embedding.weight[self.sos_eos].reshape(1, 1, -1)
+        lm_input = torch.concat([sos_eos_emb, embedding, prompt_text], dim=1)
+        llm_cache = self.llm.init_static_cache(1, lm_input.size(1), device, self.static_cache_dtype(lm_input))
+        self.llm.forward_chunk_static(lm_input, llm_cache, self.chunk_mask(lm_input.size(1), 0, device))
+        return {'text_encoder_cache': text_cache, 'llm_cache': llm_cache}
+
+    def encode_after_prompt(
+            self,
+            text: torch.Tensor,
+            prompt_cache: dict,
+    ) -> torch.Tensor:
+        """Encode text (1, L) as the continuation of the cached prompt text, returns (L, D)"""
+        text = self.text_embedding(text)
+        text_cache = self.text_encoder.init_static_cache(1, prompt_cache['text_encoder_cache'].length + text.size(1),
+                                                         text.device, self.static_cache_dtype(text))
+        text_cache.load(prompt_cache['text_encoder_cache'])
+        text = self.text_encoder.forward_chunk_static(text, text_cache, self.chunk_mask(text.size(1), text_cache.length, text.device))
+        text = self.text_encoder_affine_layer(text)
+        return text[0]
 
     @torch.inference_mode()
     def inference(
@@ -158,49 +270,277 @@ class TransformerLM(torch.nn.Module):
             sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
+            prompt_cache: Optional[dict] = None,
+            guard: Optional[RunawayGuard] = None,
     ) -> torch.Tensor:
-        device = text.device
-        text = torch.concat([prompt_text, text], dim=1)
-        text_len += prompt_text_len
-        text = self.text_embedding(text)
+        assert beam_size == 1
+        out_tokens = self.inference_batch(text, text_len, prompt_text, prompt_text_len,
+                                          prompt_speech_token, prompt_speech_token_len, embedding,
+                                          sampling=sampling,
+                                          max_token_text_ratio=max_token_text_ratio,
+                                          min_token_text_ratio=min_token_text_ratio,
+                                          prompt_cache=None if prompt_cache is None else [prompt_cache],
+                                          guard=guard)
+        return out_tokens[0].unsqueeze(dim=0)
 
-        # 1. encode text
-        text, text_len = self.encode(text, text_len)
+    @torch.inference_mode()
+    def inference_stream(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+            eos_check_interval: int = 8,
+            use_cuda_graph: bool = False,
+            prompt_cache: Optional[dict] = None,
+            guard: Optional[RunawayGuard] = None,
+    ) -> Generator[torch.Tensor, None, None]:
+        """Same as inference, but yields the speech tokens (1, T_i) decoded
+        since the previous yield every eos_check_interval steps"""
+        emitted = 0
+        for tokens, lengths, num_steps in self.decode_batch(text, text_len, prompt_text, prompt_text_len,
+                                                            prompt_speech_token, prompt_speech_token_len, embedding,
+                                                            sampling=sampling,
+                                                            max_token_text_ratio=max_token_text_ratio,
+                                                            min_token_text_ratio=min_token_text_ratio,
+                                                            eos_check_interval=eos_check_interval,
+                                                            use_cuda_graph=use_cuda_graph,
+                                                            prompt_cache=None if prompt_cache is None else [prompt_cache],
+                                                            guard=guard):
+            end = min(num_steps, int(lengths[0]))
+            if end > emitted:
+                yield tokens[:, emitted:end].clone()
+                emitted = end
 
-        # 2. encode embedding
-        if embedding.shape[0] != 0:
-            embedding = F.normalize(embedding, dim=1)
-            embedding = self.spk_embed_affine_layer(embedding)
-            embedding = embedding.unsqueeze(dim=1)
+    @torch.inference_mode()
+    def inference_batch(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+            eos_check_interval: int = 8,
+            use_cuda_graph: bool = False,
+            prompt_cache: Optional[List[dict]] = None,
+            guard: Optional[RunawayGuard] = None,
+    ) -> List[torch.Tensor]:
+        """Decode a batch of prompts of different lengths
+
+        Args:
+            see decode_batch
+
+        Returns:
+            list of B speech token sequences, each one (T_i,) and stopped
+            at its own EOS, max length or by the guard
+        """
+        for tokens, lengths, _ in self.decode_batch(text, text_len, prompt_text, prompt_text_len,
+                                                    prompt_speech_token, prompt_speech_token_len, embedding,
+                                                    sampling=sampling,
+                                                    max_token_text_ratio=max_token_text_ratio,
+                                                    min_token_text_ratio=min_token_text_ratio,
+                                                    eos_check_interval=eos_check_interval,
+                                                    use_cuda_graph=use_cuda_graph,
+                                                    prompt_cache=prompt_cache,
+                                                    guard=guard):
+            pass
+        lengths = lengths.tolist()
+        return [tokens[i, :lengths[i]] for i in range(text.size(0))]
+
+    def decode_batch(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+            eos_check_interval: int = 8,
+            use_cuda_graph: bool = False,
+            prompt_cache: Optional[List[dict]] = None,
+            guard: Optional[RunawayGuard] = None,
+    ) -> Generator[Tuple[torch.Tensor, torch.Tensor, int], None, None]:
+        """Decode a batch of prompts of different lengths step by step
+
+        Args:
+            text: (B, L) right padded
+            text_len: (B,)
+            prompt_text: (B, L') right padded
+            prompt_text_len: (B,)
+            prompt_speech_token: (B, T') right padded
+            prompt_speech_token_len: (B,)
+            embedding: (B, D), or (0, D) for no speaker embedding
+            eos_check_interval: the host checks for finished rows every this
+                many steps, a finished row is decoded at most this many
+                extra steps and its surplus tokens are dropped
+            use_cuda_graph: decode with fixed shapes, every step after the
+                first one is captured and replayed as a CUDA graph on cuda
+                devices and run eagerly on others
+            prompt_cache: the prefill_prompt output of each row, then only
+                text and prompt_speech_token are prefilled, prompt_text and
+                embedding are not used
+            guard: stops rows that run away instead of sampling EOS, see
+                RunawayGuard, its stop reasons are set once decoding ends
+
+        Yields:
+            (tokens, lengths, num_steps) whenever the host checks for
+            finished rows and once more at the end. tokens (B, max_steps)
+            and lengths (B,) are the device buffers being decoded into, the
+            first num_steps tokens of each row are sampled and a row that
+            sampled EOS has its final length in lengths
+        """
+        device = text.device
+        batch_size = text.size(0)
+
+        # 1. encode prompt_text + text of each row, or only text after the cached prompt
+        if prompt_cache is None:
+            text = [torch.concat([prompt_text[i, :prompt_text_len[i]], text[i, :text_len[i]]], dim=0) for i in range(batch_size)]
+            text = pad_sequence(text, batch_first=True, padding_value=0)
+            text = self.text_embedding(text)
+            text, all_text_len = self.encode(text, prompt_text_len + text_len)
+            text = [text[i, :all_text_len[i]] for i in range(batch_size)]
         else:
-            embedding = torch.zeros(1, 0, self.llm_input_size).to(device)
+            text = [self.encode_after_prompt(text[i:i + 1, :text_len[i]], prompt_cache[i]) for i in range(batch_size)]
 
-        # 3. concat llm_input
-        sos_eos_emb = self.llm_embedding.weight[self.sos_eos].reshape(1, 1, -1)
-        task_id_emb = self.llm_embedding.weight[self.task_id].reshape(1, 1, -1)
-        if prompt_speech_token_len != 0:
+        # 2. concat llm_input of each row, [sos_eos, embedding, prompt_text] is already in the cached prompt
+        task_id_emb = self.llm_embedding.weight[self.task_id].reshape(1, -1)
+        if prompt_speech_token.size(1) != 0:
             prompt_speech_token_emb = self.speech_embedding(prompt_speech_token)
         else:
-            prompt_speech_token_emb = torch.zeros(1, 0, self.llm_input_size).to(device)
-        lm_input = torch.concat([sos_eos_emb, embedding, text, task_id_emb, prompt_speech_token_emb], dim=1)
-
-        # 4. cal min/max_length
-        min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
-        max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
-
-        # 5. step by step decode
-        out_tokens = []
-        offset = 0
-        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
-        for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=0, required_cache_size=-1, att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool))
-            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), sampling, beam_size, ignore_eos=True if i < min_len else False).item()
-            if top_ids == self.speech_token_size:
-                break
-            out_tokens.append(top_ids)
-            offset += lm_input.size(1)
-            lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
-
-        return torch.tensor([out_tokens], dtype=torch.int64, device=device)
+            prompt_speech_token_emb = torch.zeros(batch_size, 0, self.llm_input_size).to(device)
+        lm_input = [torch.concat([text[i], task_id_emb, prompt_speech_token_emb[i, :prompt_speech_token_len[i]]], dim=0)
+                    for i in range(batch_size)]
+        if prompt_cache is None:
+            if embedding.shape[0] != 0:
+                embedding = F.normalize(embedding, dim=1)
+                embedding = self.spk_embed_affine_layer(embedding)
+                embedding = embedding.unsqueeze(dim=1)
+            else:
+                embedding = torch.zeros(batch_size, 0, self.llm_input_size).to(device)
+            sos_eos_emb = self.llm_embedding.weight[self.sos_eos].reshape(1, -1)
+            lm_input = [torch.concat([sos_eos_emb, embedding[i], lm_input[i]], dim=0) for i in range(batch_size)]
+            lm_input_len = [i.size(0) for i in lm_input]
+        else:
+            lm_input_len = [i.size(0) + c['llm_cache'].length for i, c in zip(lm_input, prompt_cache)]
+
+        # 3. cal min/max_length of each row
+        min_len = (text_len * min_token_text_ratio).int()
+        max_len = (text_len * max_token_text_ratio).int()
+        caller_max_len = max_len
+        if guard is not None:
+            max_len = guard.limit_length(max_len, min_len, text_len, prompt_text_len, prompt_speech_token_len)
+        max_steps = int(max_len.max())
+
+        # 4. step by step decode into a preallocated kv cache. Sampled tokens and
+        # finished flags stay on device, the host only looks at them every
+        # eos_check_interval steps. Rows are left padded so that the last
+        # position of every row lines up
+        eos = self.speech_token_size
+        prefix_len = max(lm_input_len)
+        cache = self.llm.init_static_cache(batch_size, prefix_len + max_steps, device, self.static_cache_dtype(lm_input[0]))
+        padded = min(lm_input_len) != prefix_len
+        key_mask = torch.arange(cache.max_len, device=device).unsqueeze(0) >= \
+            (prefix_len - torch.tensor(lm_input_len, device=device)).unsqueeze(1)
+        tokens = torch.zeros((batch_size, max_steps), dtype=torch.int64, device=device)
+        # rows that never sample EOS stop at their max length
+        lengths = max_len.long()
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        looped = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        rows = torch.arange(batch_size, device=device)
+
+        def record(top_ids, step, rows):
+            is_eos = top_ids == eos
+            lengths[rows] = torch.where(is_eos & ~finished[rows], step, lengths[rows])
+            finished[rows] = finished[rows] | is_eos | (step + 1 >= max_len[rows])
+            tokens[rows, step] = top_ids
+
+        if prompt_cache is None:
+            lm_input = pad_sequence([i.flip(0) for i in lm_input], batch_first=True, padding_value=0).flip(1)
+            att_mask = torch.tril(torch.ones((1, prefix_len, prefix_len), device=device, dtype=torch.bool)) & key_mask[:, :prefix_len].unsqueeze(1)
+            y_pred = self.llm.forward_chunk_static(lm_input, cache, att_mask)[:, -1]
+        else:
+            # prefill row by row, each one continuing its cached prompt at its own offset
+            y_pred = []
+            for i in range(batch_size):
+                row_cache = cache.narrow(i, prefix_len - lm_input_len[i])
+                row_cache.load(prompt_cache[i]['llm_cache'])
+                att_mask = self.chunk_mask(lm_input[i].size(0), row_cache.length, device)
+                y_pred.append(self.llm.forward_chunk_static(lm_input[i].unsqueeze(dim=0), row_cache, att_mask)[:, -1])
+            y_pred = torch.concat(y_pred, dim=0)
+            cache.length = prefix_len
+        if max_steps > 0:
+            logp = self.llm_decoder(y_pred).log_softmax(dim=-1)
+            top_ids = self.sampling_ids(logp, sampling, ignore_eos=0 < min_len)
+            record(top_ids, 0, rows)
+
+        if use_cuda_graph:
+            # fixed shapes: finished rows stay in the batch and every step attends the whole cache
+            last_ids = top_ids.clone()
+            offset = torch.tensor(prefix_len, device=device)
+            step = torch.tensor(1, device=device)
+            positions = torch.arange(cache.max_len, device=device)
+
+            def decode_step():
+                xs = self.speech_embedding.weight[last_ids.clamp(max=eos - 1)].unsqueeze(dim=1)
+                step_mask = (key_mask & (positions <= offset)).unsqueeze(1)
+                y_pred = self.llm.forward_step_static(xs, cache, offset, step_mask)
+                logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                top_ids = self.sampling_ids(logp, sampling, ignore_eos=step < min_len)
+                record(top_ids, step, rows)
+                last_ids.copy_(top_ids)
+                offset.add_(1)
+                step.add_(1)
+
+            if device.type == 'cuda' and max_steps > 1:
+                decode_step = self.capture_cuda_graph(decode_step, [last_ids, offset, step, tokens, lengths, finished])
+            for i in range(1, max_steps):
+                if i % eos_check_interval == 0:
+                    if guard is not None:
+                        guard.stop_loops(tokens, lengths, finished, looped, i)
+                    yield tokens, lengths, i
+                    if bool(finished.all()):
+                        break
+                decode_step()
+        else:
+            # finished rows leave the batch whenever the host checks
+            for i in range(1, max_steps):
+                if i % eos_check_interval == 0:
+                    if guard is not None:
+                        guard.stop_loops(tokens, lengths, finished, looped, i)
+                    yield tokens, lengths, i
+                    keep = (~finished[rows]).nonzero().squeeze(dim=1)
+                    if keep.size(0) == 0:
+                        break
+                    if keep.size(0) != rows.size(0):
+                        cache.select(keep)
+                        key_mask = key_mask.index_select(0, keep)
+                        top_ids = top_ids.index_select(0, keep)
+                        rows = rows.index_select(0, keep)
+                lm_input = self.speech_embedding.weight[top_ids.clamp(max=eos - 1)].unsqueeze(dim=1)
+                if padded:
+                    att_mask = key_mask[:, :cache.length + 1].unsqueeze(1)
+                else:
+                    att_mask = torch.ones((0, 0, 0), device=device, dtype=torch.bool)
+                y_pred = self.llm.forward_chunk_static(lm_input, cache, att_mask)
+                logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                top_ids = self.sampling_ids(logp, sampling, ignore_eos=i < min_len[rows])
+                record(top_ids, i, rows)
+
+        if guard is not None:
+            guard.finish(lengths, text_len, max_len, caller_max_len, looped)
+        yield tokens, lengths, max_steps
@@ -0,0 +1,135 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu, Zhihao Du)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import Counter
+from typing import List, Optional
+
+import torch
+
+
+class RunawayGuard:
+    """Stops speech token decoding that does not converge to EOS
+
+    TransformerLM.decode_batch caps every row at max_token_text_ratio times its
+    text length. A row that never samples EOS decodes all the way to that cap,
+    and the flow and the vocoder then spend their time on garbage. The guard
+    stops such rows early:
+
+    - rate: a row is capped at rate_factor times its text length at the
+      speaking rate of its prompt, in speech tokens per text token, plus
+      rate_margin tokens. Prompts of fewer than min_prompt_tokens speech
+      tokens give no reliable rate, max_token_text_ratio alone caps them.
+    - loop: whenever the host checks for finished rows, the last loop_window
+      tokens of each row are compared with themselves shifted by 1 to
+      loop_max_period tokens. If a shift matches in at least loop_match of
+      the positions, the row is cut after the first period of the window.
+
+    Both run on the device; the host only reads the stop reasons once a
+    batch is decoded. They are kept in last_stop_reasons, and counters counts
+    them over all batches together with what the caller adds, like resampled
+    rows. Counters also sums the speech and text tokens of every row, see
+    token_text_ratio for the speaking rate actually decoded.
+
+    The last_* attributes and counters are shared by every decode with the
+    guard, they are only consistent while one thread decodes at a time, like
+    the single worker of the api BatchScheduler.
+
+    Args:
+        max_token_text_ratio: cap on speech tokens per text token, tighter
+            than that of the caller, None for no extra cap
+        rate_factor: allowed multiple of the prompt speaking rate, None to
+            disable the rate cap
+        rate_margin: speech tokens allowed on top of the rate cap, so that
+            short texts are not cut
+        min_prompt_tokens: shortest prompt whose speaking rate is trusted
+        loop_window: tokens compared by the loop check, 0 to disable it
+        loop_max_period: longest repeated unit, in tokens
+        loop_match: fraction of matching tokens that counts as a loop
+    """
+    # stop reason code -> name, max_len is the cap of the caller
+    STOP_REASONS = ('eos', 'loop', 'rate', 'max_len')
+    # reasons a row did not end by itself
+    RUNAWAY = ('loop', 'rate', 'max_len')
+
+    def __init__(self,
+                 max_token_text_ratio: Optional[float] = None,
+                 rate_factor: Optional[float] = 2.0,
+                 rate_margin: int = 25,
+                 min_prompt_tokens: int = 50,
+                 loop_window: int = 100,
+                 loop_max_period: int = 25,
+                 loop_match: float = 0.9):
+        self.max_token_text_ratio = max_token_text_ratio
+        self.rate_factor = rate_factor
+        self.rate_margin = rate_margin
+        self.min_prompt_tokens = min_prompt_tokens
+        self.loop_window = loop_window
+        self.loop_max_period = loop_max_period
+        self.loop_match = loop_match
+        self.last_stop_reasons: List[str] = []
+        self.last_token_text_ratios: List[float] = []
+        self.counters = Counter()
+
+    def limit_length(self, max_len: torch.Tensor, min_len: torch.Tensor, text_len: torch.Tensor,
+                     prompt_text_len: torch.Tensor, prompt_speech_token_len: torch.Tensor) -> torch.Tensor:
+        """(B,) max_len of the caller lowered by the rate and ratio caps, never below min_len"""
+        cap = max_len
+        if self.max_token_text_ratio is not None:
+            cap = torch.minimum(cap, (text_len * self.max_token_text_ratio).int())
+        if self.rate_factor is not None:
+            rate = prompt_speech_token_len / prompt_text_len.clamp(min=1)
+            rate_len = (text_len * rate * self.rate_factor).ceil().int() + self.rate_margin
+            reliable = (prompt_speech_token_len >= self.min_prompt_tokens) & (prompt_text_len > 0)
+            cap = torch.where(reliable, torch.minimum(cap, rate_len), cap)
+        return torch.minimum(max_len, torch.maximum(cap, min_len))
+
+    def stop_loops(self, tokens: torch.Tensor, lengths: torch.Tensor, finished: torch.Tensor,
+                   looped: torch.Tensor, step: int):
+        """Stop the unfinished rows whose first `step` tokens end in a loop
+
+        tokens (B, max_steps), lengths, finished and looped (B,) are the
+        decode_batch buffers and are updated in place.
+        """
+        span = self.loop_window + self.loop_max_period
+        if self.loop_window <= 0 or step < span:
+            return
+        # windows (B, loop_max_period + 1, loop_window), the last one ends at step
+        windows = tokens[:, step - span:step].unfold(1, self.loop_window, 1)
+        # match[:, p - 1] compares the last window with the one p tokens earlier
+        match = (windows[:, :-1] == windows[:, -1:]).float().mean(dim=-1).flip(-1)
+        score, period = match.max(dim=-1)
+        stop = (score >= self.loop_match) & ~finished
+        lengths.copy_(torch.where(stop, step - self.loop_window + period + 1, lengths))
+        looped |= stop
+        finished |= stop
+
+    def finish(self, lengths: torch.Tensor, text_len: torch.Tensor, max_len: torch.Tensor,
+               caller_max_len: torch.Tensor, looped: torch.Tensor) -> List[str]:
+        """Record and return why each row of a decoded batch stopped, and its
+        measured speech tokens per text token"""
+        reason = torch.where(max_len < caller_max_len, 2, 3)
+        reason = torch.where(lengths < max_len, 0, reason)
+        reason = torch.where(looped, 1, reason)
+        self.last_stop_reasons = [self.STOP_REASONS[r] for r in reason.tolist()]
+        lengths, text_len = lengths.tolist(), text_len.tolist()
+        self.last_token_text_ratios = [length / max(n, 1) for length, n in zip(lengths, text_len)]
+        self.counters.update(self.last_stop_reasons)
+        self.counters['speech_tokens'] += sum(lengths)
+        self.counters['text_tokens'] += sum(text_len)
+        return self.last_stop_reasons
+
+    def token_text_ratio(self) -> Optional[float]:
+        """Speech tokens per text token over all the decoded rows, None before the first"""
+        if not self.counters['text_tokens']:
+            return None
+        return self.counters['speech_tokens'] / self.counters['text_tokens']
@@ -16,11 +16,18 @@
 # limitations under the License.
 """Multi-Head Attention layer definition."""
 
+import copy
 import math
-from typing import Tuple
+from typing import Optional, Tuple, Union
 
 import torch
 from torch import nn
+import torch.nn.functional as F
+
+# "math" computes the scores, softmax and context explicitly, "sdpa" calls
+# torch.nn.functional.scaled_dot_product_attention, which picks a fused
+# kernel for the device and doesn't keep the softmax of the scores
+ATTENTION_BACKENDS = ("math", "sdpa")
 
 
 class MultiHeadedAttention(nn.Module):
@@ -30,6 +37,8 @@ class MultiHeadedAttention(nn.Module):
         n_head (int): The number of heads.
         n_feat (int): The number of features.
         dropout_rate (float): Dropout rate.
+        key_bias (bool): Whether use bias in linear_k.
+        backend (str): One of ATTENTION_BACKENDS.
 
     """
 
@@ -37,10 +46,13 @@ class MultiHeadedAttention(nn.Module):
                  n_head: int,
                  n_feat: int,
                  dropout_rate: float,
-                 key_bias: bool = True):
+                 key_bias: bool = True,
+                 backend: str = "math"):
         """Construct an MultiHeadedAttention object."""
         super().__init__()
         assert n_feat % n_head == 0
+        assert backend in ATTENTION_BACKENDS, backend
+        self.backend = backend
         # We assume d_v always equals d_k
         self.d_k = n_feat // n_head
         self.h = n_head
@@ -126,6 +138,52 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    def forward_sdpa(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        bias: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Compute attention context vector with scaled_dot_product_attention.
+
+        Same as scoring query against key and calling forward_attention,
+        without materializing the attention weights.
+
+        Args:
+            query (torch.Tensor): Transformed query, size
+                (#batch, n_head, time1, d_k).
+            key (torch.Tensor): Transformed key, size
+                (#batch, n_head, time2, d_k).
+            value (torch.Tensor): Transformed value, size
+                (#batch, n_head, time2, d_k).
+            mask (torch.Tensor): Mask, size (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            bias (torch.Tensor): Scaled score bias added to the scaled
+                dot products, size (#batch, n_head, time1, time2).
+
+        Returns:
+            torch.Tensor: Transformed value (#batch, time1, d_model).
+
+        """
+        n_batch = value.size(0)
+        attn_mask, keep = bias, None
+        if mask.size(2) > 0:  # time2 > 0
+            keep = mask.unsqueeze(1).ne(0)[:, :, :, :key.size(2)]  # (batch, 1, *, time2)
+            attn_mask = keep if bias is None else bias.masked_fill(~keep, -float('inf'))
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask,
+                                           dropout_p=self.dropout.p if self.training else 0.0)
+        if keep is not None:
+            # queries that see no key at all get nan from the softmax,
+            # forward_attention zeroes their weights
+            x = x.masked_fill(~keep.any(dim=-1, keepdim=True), 0.0)
+        x = (x.transpose(1, 2).contiguous().view(n_batch, -1,
+                                                 self.h * self.d_k)
+             )  # (batch, time1, d_model)
+
+        return self.linear_out(x)  # (batch, time1, d_model)
+
     def forward(
         self,
         query: torch.Tensor,
@@ -193,9 +251,88 @@ class MultiHeadedAttention(nn.Module):
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
 
+        if self.backend == "sdpa":
+            return self.forward_sdpa(q, k, v, mask), new_cache
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
+    def update_static_cache(
+        self,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+        offset: Union[int, torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write the keys and values of a chunk into preallocated buffers.
+
+        Args:
+            k (torch.Tensor): Transformed key (#batch, head, time1, d_k).
+            v (torch.Tensor): Transformed value (#batch, head, time1, d_k).
+            key_cache (torch.Tensor): Key buffer (#batch, head, max_len, d_k).
+            value_cache (torch.Tensor): Value buffer
+                (#batch, head, max_len, d_k).
+            offset (int or torch.Tensor): Number of positions already in
+                the buffers. An int returns views of the filled positions.
+                A 0-dim tensor (time1 must be 1) returns the whole buffers,
+                so shapes don't depend on the position and the step can be
+                captured in a CUDA graph; the caller masks the unfilled
+                positions.
+
+        Returns:
+            torch.Tensor: Keys to attend (#batch, head, time2, d_k).
+            torch.Tensor: Values to attend (#batch, head, time2, d_k).
+
+        """
+        if isinstance(offset, int):
+            end = offset + k.size(2)
+            key_cache[:, :, offset:end] = k
+            value_cache[:, :, offset:end] = v
+            return key_cache[:, :, :end], value_cache[:, :, :end]
+        key_cache.index_copy_(2, offset.reshape(1), k)
+        value_cache.index_copy_(2, offset.reshape(1), v)
+        return key_cache, value_cache
+
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+        offset: Union[int, torch.Tensor],
+    ) -> torch.Tensor:
+        """Self attention over preallocated key/value buffers.
+
+        The keys and values of `x` are written in place at
+        [offset, offset + time1) and the queries attend to the buffers
+        up to there, so nothing is concatenated or reallocated per call.
+
+        Args:
+            x (torch.Tensor): Input tensor (#batch, time1, size).
+            mask (torch.Tensor): Mask tensor (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            pos_emb (torch.Tensor): Positional embedding tensor, unused here,
+                it's for interface compatibility to
+                RelPositionMultiHeadedAttention.
+            key_cache (torch.Tensor): Key buffer (#batch, head, max_len, d_k).
+            value_cache (torch.Tensor): Value buffer
+                (#batch, head, max_len, d_k).
+            offset (int or torch.Tensor): Number of positions already in
+                the buffers, see update_static_cache.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+
+        """
+        q, k, v = self.forward_qkv(x, x, x)
+        k, v = self.update_static_cache(k, v, key_cache, value_cache, offset)
+
+        if self.backend == "sdpa":
+            return self.forward_sdpa(q, k, v, mask)
+        scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
+        return self.forward_attention(v, scores, mask)
+
 
 class RelPositionMultiHeadedAttention(MultiHeadedAttention):
     """Multi-Head Attention layer with relative position encoding.
@@ -210,9 +347,10 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
                  n_head: int,
                  n_feat: int,
                  dropout_rate: float,
-                 key_bias: bool = True):
+                 key_bias: bool = True,
+                 backend: str = "math"):
         """Construct an RelPositionMultiHeadedAttention object."""
-        super().__init__(n_head, n_feat, dropout_rate, key_bias)
+        super().__init__(n_head, n_feat, dropout_rate, key_bias, backend)
         # linear transformation for positional encoding
         self.linear_pos = nn.Linear(n_feat, n_feat, bias=False)
         # these two learnable bias are used in matrix c and matrix d
@@ -242,6 +380,28 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         ]  # only keep the positions from 0 to time2
         return x
 
+    def rel_shift_chunk(self, x, time2: int):
+        """Compute relative positional encoding of a chunk after a cache.
+
+        Generalizes rel_shift to queries that are the last time1 of time2
+        positions.
+
+        Args:
+            x (torch.Tensor): Input tensor (batch, head, time1, time2+time1-1),
+                relative positions from time2 - 1 down to -(time1 - 1).
+            time2 (int): The length of key vector.
+
+        Returns:
+            torch.Tensor: Output tensor (batch, head, time1, time2).
+
+        """
+        zero_pad = torch.zeros((*x.size()[:3], 1), device=x.device, dtype=x.dtype)
+        x_padded = torch.cat([zero_pad, x], dim=-1)
+
+        x_padded = x_padded.view(*x.size()[:2], -1)
+        x = x_padded[:, :, x.size(2):].view_as(x)[:, :, :, :time2]
+        return x
+
     def forward(
         self,
         query: torch.Tensor,
@@ -307,20 +467,158 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # (batch, head, time1, d_k)
         q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
 
-        # compute attention score
-        # first compute matrix a and matrix c
-        # as described in https://arxiv.org/abs/1901.02860 Section 3.3
-        # (batch, head, time1, time2)
-        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
-
         # compute matrix b and matrix d
         # (batch, head, time1, time2)
         matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
         # NOTE(Xiang Lyu): Keep rel_shift since espnet rel_pos_emb is used
-        if matrix_ac.shape != matrix_bd.shape:
+        if matrix_bd.size(-1) != k.size(2):
             matrix_bd = self.rel_shift(matrix_bd)
 
+        if self.backend == "sdpa":
+            # matrix a and c are the dot products of q_with_bias_u and k
+            return self.forward_sdpa(q_with_bias_u, k, v, mask,
+                                     matrix_bd / math.sqrt(self.d_k)), new_cache
+
+        # compute attention score
+        # first compute matrix a and matrix c
+        # as described in https://arxiv.org/abs/1901.02860 Section 3.3
+        # (batch, head, time1, time2)
+        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
+
         scores = (matrix_ac + matrix_bd) / math.sqrt(
             self.d_k)  # (batch, head, time1, time2)
 
         return self.forward_attention(v, scores, mask), new_cache
+
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+        offset: Union[int, torch.Tensor],
+    ) -> torch.Tensor:
+        """Self attention with rel. positional encoding over preallocated
+        key/value buffers.
+
+        Args:
+            x (torch.Tensor): Input tensor (#batch, time1, size).
+            mask (torch.Tensor): Mask tensor (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            pos_emb (torch.Tensor): Positional embedding tensor. For a
+                single query (time1 == 1) it holds one embedding per
+                attended key (1, time2, size), otherwise it is the usual
+                embedding of the whole attended length (1, 2*time2-1, size).
+            key_cache (torch.Tensor): Key buffer (#batch, head, max_len, d_k).
+            value_cache (torch.Tensor): Value buffer
+                (#batch, head, max_len, d_k).
+            offset (int or torch.Tensor): Number of positions already in
+                the buffers, see update_static_cache.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+
+        """
+        q, k, v = self.forward_qkv(x, x, x)
+        time1 = q.size(2)
+        k, v = self.update_static_cache(k, v, key_cache, value_cache, offset)
+
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
+        q_with_bias_u = (q + self.pos_bias_u).transpose(1, 2)
+        q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
+
+        if time1 == 1 and pos_emb.size(1) == k.size(2):
+            # NOTE: with a single query it is cheaper to project the query
+            #   into the embedding space than to project `end` positional
+            #   embeddings, which keeps the cost of a decoding step from
+            #   growing with linear_pos as the sequence gets longer.
+            # (head, d_k, size)
+            weight_pos = self.linear_pos.weight.view(self.h, self.d_k, -1)
+            # (batch, head, 1, size) x (1, 1, size, time2)
+            matrix_bd = torch.matmul(torch.matmul(q_with_bias_v, weight_pos),
+                                     pos_emb.transpose(1, 2).unsqueeze(1))
+        else:
+            time2 = k.size(2)
+            if pos_emb.size(1) != time2:
+                # only relative positions from time2 - 1 down to -(time1 - 1)
+                # occur between the chunk and the keys
+                pos_emb = pos_emb[:, :time2 + time1 - 1]
+            n_batch_pos = pos_emb.size(0)
+            p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
+            p = p.transpose(1, 2)  # (batch, head, time1, d_k)
+            matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
+            if matrix_bd.size(-1) != time2:
+                matrix_bd = self.rel_shift_chunk(matrix_bd, time2)
+
+        if self.backend == "sdpa":
+            return self.forward_sdpa(q_with_bias_u, k, v, mask,
+                                     matrix_bd / math.sqrt(self.d_k))
+
+        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
+        scores = (matrix_ac + matrix_bd) / math.sqrt(
+            self.d_k)  # (batch, head, time1, time2)
+
+        return self.forward_attention(v, scores, mask)
+
+
+def set_attention_backend(module: nn.Module, backend: str):
+    """Switch every attention layer under `module` to one of ATTENTION_BACKENDS."""
+    assert backend in ATTENTION_BACKENDS, backend
+    for m in module.modules():
+        if isinstance(m, MultiHeadedAttention):
+            m.backend = backend
+
+
+class StaticKVCache:
+    """Preallocated key/value buffers of all attention layers of an encoder.
+
+    Used for autoregressive decoding: every step writes its keys and values
+    in place at `length`, instead of concatenating the whole history into
+    a new cache tensor in every layer.
+
+    Args:
+        num_layers (int): The number of attention layers.
+        batch_size (int): The number of streams decoded together.
+        n_head (int): The number of heads.
+        max_len (int): The maximum number of positions.
+        d_k (int): The dimension of each head.
+
+    """
+
+    def __init__(self,
+                 num_layers: int,
+                 batch_size: int,
+                 n_head: int,
+                 max_len: int,
+                 d_k: int,
+                 device: torch.device,
+                 dtype: torch.dtype):
+        self.key = torch.zeros((num_layers, batch_size, n_head, max_len, d_k),
+                               device=device, dtype=dtype)
+        self.value = torch.zeros_like(self.key)
+        self.length = 0
+
+    @property
+    def max_len(self) -> int:
+        return self.key.size(3)
+
+    def narrow(self, row: int, start: int) -> 'StaticKVCache':
+        """A cache of stream `row` alone whose position 0 is `start` of this
+        one. It shares the buffers, so writing to it fills this cache."""
+        cache = copy.copy(self)
+        cache.key = self.key[:, row:row + 1, :, start:]
+        cache.value = self.value[:, row:row + 1, :, start:]
+        cache.length = 0
+        return cache
+
+    def load(self, prefix: 'StaticKVCache'):
+        """Continue from the filled positions of `prefix`."""
+        self.key[:, :, :, :prefix.length] = prefix.key[:, :, :, :prefix.length]
+        self.value[:, :, :, :prefix.length] = prefix.value[:, :, :, :prefix.length]
+        self.length = prefix.length
+
+    def select(self, index: torch.Tensor):
+        """Keep only the streams in `index` (1-D tensor of batch indices)."""
+        self.key = self.key.index_select(1, index)
+        self.value = self.value.index_select(1, index)
@@ -291,3 +291,20 @@ class EspnetRelPositionalEncoding(torch.nn.Module):
             self.pe.size(1) // 2 - size + 1 : self.pe.size(1) // 2 + size,
         ]
         return pos_emb
+
+    def relative_position_encoding(self,
+                                   offset: torch.Tensor,
+                                   size: int) -> torch.Tensor:
+        """ Encoding of the relative positions between the query at `offset`
+        and keys [0, size), gathered on device so that no host sync is
+        needed for a tensor offset.
+
+        Args:
+            offset (torch.Tensor): position of the query, 0-dim tensor
+            size (int): number of keys
+
+        Returns:
+            torch.Tensor: Corresponding encoding (1, size, d_model)
+        """
+        index = self.pe.size(1) // 2 - offset + torch.arange(size, device=offset.device)
+        return self.pe.index_select(1, index)
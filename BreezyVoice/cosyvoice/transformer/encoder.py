@@ -20,6 +20,7 @@ from typing import Tuple
 import torch
 import torch.utils.checkpoint as ckpt
 
+from cosyvoice.transformer.attention import StaticKVCache
 from cosyvoice.transformer.convolution import ConvolutionModule
 from cosyvoice.transformer.encoder_layer import TransformerEncoderLayer
 from cosyvoice.transformer.encoder_layer import ConformerEncoderLayer
@@ -270,6 +271,104 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    def init_static_cache(
+        self,
+        batch_size: int,
+        max_len: int,
+        device: torch.device,
+        dtype: torch.dtype,
+    ) -> StaticKVCache:
+        """ Allocate the attention buffers used by forward_chunk_static """
+        self_attn = self.encoders[0].self_attn
+        return StaticKVCache(len(self.encoders), batch_size, self_attn.h,
+                             max_len, self_attn.d_k, device, dtype)
+
+    def forward_chunk_static(
+        self,
+        xs: torch.Tensor,
+        cache: StaticKVCache,
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> torch.Tensor:
+        """ Forward one chunk of a batch of streams with a static cache
+
+        Unlike forward_chunk, the batch size may be larger than 1, which is
+        what batched autoregressive decoding needs. Keys and values are
+        written in place into `cache`, preallocated with init_static_cache,
+        and `cache.length` is advanced by the chunk size. Layers with a conv
+        module are not supported.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b, time, dim)
+            cache (StaticKVCache): attention buffers of all layers
+            att_mask (torch.Tensor): mask of the keys each query may attend,
+                with shape (b, time, cache.length + time) or
+                (b, 1, cache.length + time), False for padding and future
+                positions. (0, 0, 0) means every key is attended, which is
+                what a single frame without padding needs.
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b, time, hidden-dim).
+
+        """
+        offset = cache.length
+        end = offset + xs.size(1)
+        assert end <= cache.max_len
+        tmp_masks = torch.ones(xs.size(0), 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, offset)
+        pos_emb = self.embed.position_encoding(offset=0, size=end)
+        if xs.size(1) == 1:
+            # one embedding per key, from relative position end - 1 down to 0
+            pos_emb = pos_emb[:, :end]
+        for i, layer in enumerate(self.encoders):
+            xs = layer.forward_static(xs, att_mask, pos_emb, cache.key[i], cache.value[i], offset)
+        cache.length = end
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
+    def forward_step_static(
+        self,
+        xs: torch.Tensor,
+        cache: StaticKVCache,
+        offset: torch.Tensor,
+        att_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """ Forward a single frame of a batch of streams at a device-side
+        position
+
+        Unlike forward_chunk_static, the position is a tensor and the frame
+        attends to the whole cache, so every shape is fixed for a given
+        cache and the step runs without host syncs, e.g. inside a CUDA
+        graph. `cache.length` is not used nor advanced.
+        Only the rel_pos_espnet positional encoding is supported.
+
+        Args:
+            xs (torch.Tensor): frame input, with shape (b, 1, dim)
+            cache (StaticKVCache): attention buffers of all layers
+            offset (torch.Tensor): position of the frame, 0-dim tensor
+            att_mask (torch.Tensor): mask of the keys the frame may attend,
+                with shape (b, 1, cache.max_len), False for padding and
+                positions after `offset`
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b, 1, hidden-dim).
+
+        """
+        tmp_masks = torch.ones(xs.size(0), 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, 0)
+        pos_emb = self.embed.pos_enc.relative_position_encoding(offset, cache.max_len)
+        for i, layer in enumerate(self.encoders):
+            xs = layer.forward_static(xs, att_mask, pos_emb, cache.key[i], cache.value[i], offset)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
     def forward_chunk_by_chunk(
         self,
         xs: torch.Tensor,
@@ -357,10 +456,13 @@ class TransformerEncoder(BaseEncoder):
         selfattention_layer_type: str = "selfattn",
         activation_type: str = "relu",
         gradient_checkpointing: bool = False,
+        attention_backend: str = "math",
     ):
         """ Construct TransformerEncoder
 
         See Encoder for the meaning of each parameter.
+        attention_backend (str): attention implementation, "math" or
+            "sdpa", see cosyvoice.transformer.attention.
         """
         super().__init__(input_size, output_size, attention_heads,
                          linear_units, num_blocks, dropout_rate,
@@ -375,7 +477,8 @@ class TransformerEncoder(BaseEncoder):
                 COSYVOICE_ATTENTION_CLASSES[selfattention_layer_type](attention_heads,
                                                                       output_size,
                                                                       attention_dropout_rate,
-                                                                      key_bias),
+                                                                      key_bias,
+                                                                      attention_backend),
                 PositionwiseFeedForward(output_size, linear_units,
                                         dropout_rate, activation),
                 dropout_rate, normalize_before) for _ in range(num_blocks)
@@ -412,6 +515,7 @@ class ConformerEncoder(BaseEncoder):
         cnn_module_norm: str = "batch_norm",
         key_bias: bool = True,
         gradient_checkpointing: bool = False,
+        attention_backend: str = "math",
     ):
         """Construct ConformerEncoder
 
@@ -429,6 +533,8 @@ class ConformerEncoder(BaseEncoder):
             cnn_module_kernel (int): Kernel size of convolution module.
             causal (bool): whether to use causal convolution or not.
             key_bias: whether use bias in attention.linear_k, False for whisper models.
+            attention_backend (str): attention implementation, "math" or
+                "sdpa", see cosyvoice.transformer.attention.
         """
         super().__init__(input_size, output_size, attention_heads,
                          linear_units, num_blocks, dropout_rate,
@@ -444,6 +550,7 @@ class ConformerEncoder(BaseEncoder):
             output_size,
             attention_dropout_rate,
             key_bias,
+            attention_backend,
         )
         # feed-forward module definition
         positionwise_layer_args = (
@@ -15,7 +15,7 @@
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder self-attention layer definition."""
 
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 
 import torch
 from torch import nn
@@ -105,6 +105,50 @@ class TransformerEncoderLayer(nn.Module):
         fake_cnn_cache = torch.zeros((0, 0, 0), dtype=x.dtype, device=x.device)
         return x, mask, new_att_cache, fake_cnn_cache
 
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+        offset: Union[int, torch.Tensor],
+    ) -> torch.Tensor:
+        """Compute encoded features with preallocated attention buffers.
+
+        Args:
+            x (torch.Tensor): (#batch, time, size)
+            mask (torch.Tensor): Mask tensor for the attended keys
+                (#batch, time, time2) or (#batch, 1, time2),
+                (0, 0, 0) means fake mask.
+            pos_emb (torch.Tensor): positional encoding, see
+                RelPositionMultiHeadedAttention.forward_static
+            key_cache (torch.Tensor): (#batch, head, max_len, d_k), updated
+                in place
+            value_cache (torch.Tensor): (#batch, head, max_len, d_k), updated
+                in place
+            offset (int or torch.Tensor): number of positions already in
+                the buffers, see MultiHeadedAttention.update_static_cache
+        Returns:
+            torch.Tensor: Output tensor (#batch, time, size).
+
+        """
+        residual = x
+        if self.normalize_before:
+            x = self.norm1(x)
+        x_att = self.self_attn.forward_static(x, mask, pos_emb, key_cache, value_cache, offset)
+        x = residual + self.dropout(x_att)
+        if not self.normalize_before:
+            x = self.norm1(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm2(x)
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm2(x)
+        return x
+
 
 class ConformerEncoderLayer(nn.Module):
     """Encoder layer module.
@@ -234,3 +278,44 @@ class ConformerEncoderLayer(nn.Module):
             x = self.norm_final(x)
 
         return x, mask, new_att_cache, new_cnn_cache
+
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+        offset: Union[int, torch.Tensor],
+    ) -> torch.Tensor:
+        """Compute encoded features with preallocated attention buffers.
+
+        Only layers without conv module are supported, there is no cnn
+        cache. See TransformerEncoderLayer.forward_static for the args.
+        """
+        assert self.conv_module is None
+
+        if self.feed_forward_macaron is not None:
+            residual = x
+            if self.normalize_before:
+                x = self.norm_ff_macaron(x)
+            x = residual + self.ff_scale * self.dropout(
+                self.feed_forward_macaron(x))
+            if not self.normalize_before:
+                x = self.norm_ff_macaron(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm_mha(x)
+        x_att = self.self_attn.forward_static(x, mask, pos_emb, key_cache, value_cache, offset)
+        x = residual + self.dropout(x_att)
+        if not self.normalize_before:
+            x = self.norm_mha(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm_ff(x)
+        x = residual + self.ff_scale * self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm_ff(x)
+        return x
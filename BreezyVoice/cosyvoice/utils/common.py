@@ -101,3 +101,17 @@ def init_weights(m, mean=0.0, std=0.01):
     classname = m.__class__.__name__
     if classname.find("Conv") != -1:
         m.weight.data.normal_(mean, std)
+
+
+def fade_in_out(fade_in_feat: torch.Tensor, fade_out_feat: torch.Tensor) -> torch.Tensor:
+    """Crossfade the start of fade_in_feat (B, C, T) with fade_out_feat (B, C, T')
+
+    Both inputs start at the same time, they overlap for min(T, T') frames
+    which are blended with complementary raised cosine gains.
+    """
+    overlap = min(fade_in_feat.size(-1), fade_out_feat.size(-1))
+    t = (torch.arange(overlap, device=fade_in_feat.device, dtype=torch.float32) + 0.5) / overlap
+    window = (0.5 - 0.5 * torch.cos(torch.pi * t)).to(fade_in_feat.dtype)
+    fade_in_feat = fade_in_feat.clone()
+    fade_in_feat[..., :overlap] = fade_in_feat[..., :overlap] * window + fade_out_feat[..., :overlap] * (1 - window)
+    return fade_in_feat
@@ -0,0 +1,62 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu, Zhihao Du)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import threading
+from contextlib import contextmanager
+
+import torch
+from torch.nn.modules.module import register_module_parameter_registration_hook
+
+
+@contextmanager
+def init_empty_weights():
+    """Put the parameters of the modules built in this context on the meta device
+
+    Randomly initializing a model only for its checkpoint to overwrite it
+    takes seconds and a second copy of the weights. Meta parameters hold no
+    memory and their initialization does nothing, load them with
+    load_state_dict(..., assign=True). Buffers and plain tensors, like the
+    positional encodings computed at construction, are still created, the
+    checkpoints do not hold all of them. Only the modules built by the
+    calling thread are affected.
+    """
+    thread = threading.get_ident()
+
+    def to_meta(module, name, param):
+        # the hook is global, leave alone the modules built by other threads
+        if threading.get_ident() == thread and param is not None and not param.is_meta:
+            return torch.nn.Parameter(param.to('meta'), requires_grad=param.requires_grad)
+
+    handle = register_module_parameter_registration_hook(to_meta)
+    try:
+        yield
+    finally:
+        handle.remove()
+
+
+def load_checkpoint(path: str):
+    """State dict at path on cpu, memory-mapped so that tensors are only read
+    from disk when used and the page cache is shared between processes"""
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # files saved without the zip format cannot be mapped
+        return torch.load(path, map_location='cpu')
+
+
+def save_checkpoint(state_dict, path: str):
+    """torch.save through a temporary file, a concurrent reader never sees a partial file"""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, path)
@@ -112,6 +112,56 @@ def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=
     return final_utts
 
 
+def split_segments(text: str, tokenize, first_max_n=0, token_max_n=0, merge_len=0, comma_split=False):
+    """Split text into the segments synthesized one after the other
+
+    Like split_paragraph, text is cut after each sentence end, and after each
+    comma with comma_split, then the pieces are merged back as long as a
+    segment stays within token_max_n text tokens. The first segment only
+    gets first_max_n tokens, the shorter it is the sooner the first audio is
+    ready. A segment of fewer than merge_len tokens takes the next piece
+    whatever its budget, and a last one that short joins the previous one.
+    Nothing is cut inside [] annotations. With the default budgets of 0,
+    every sentence is a segment of its own.
+    """
+    ends = ['。', '？', '！', '.', '?', '!']
+    if comma_split:
+        ends.extend(['，', ',', '、', '；', ';', '：', ':'])
+    pieces = []
+    st = 0
+    depth = 0
+    for i, c in enumerate(text):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth = max(depth - 1, 0)
+        elif c in ends and depth == 0:
+            # a run of punctuation stays with the piece it ends
+            if text[st: i].strip() or not pieces:
+                pieces.append(text[st: i + 1])
+            else:
+                pieces[-1] += text[st: i + 1]
+            st = i + 1
+    if text[st:].strip():
+        pieces.append(text[st:])
+
+    segments = []
+    cur_utt, cur_len, max_n = "", 0, first_max_n
+    for piece in pieces:
+        piece_len = len(tokenize(piece))
+        if cur_utt and cur_len + piece_len > max_n and cur_len >= merge_len:
+            segments.append(cur_utt.strip())
+            cur_utt, cur_len, max_n = "", 0, token_max_n
+        cur_utt += piece
+        cur_len += piece_len
+    if cur_utt.strip():
+        if segments and cur_len < merge_len:
+            segments[-1] = (segments[-1] + cur_utt).strip()
+        else:
+            segments.append(cur_utt.strip())
+    return segments
+
+
 # remove blank between chinese character
 def replace_blank(text: str):
     out_str = []
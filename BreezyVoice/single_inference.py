@@ -1,4 +1,6 @@
 import argparse
+import hashlib
+import logging
 import os
 import sys
 import re
@@ -7,121 +9,52 @@ import time
 
 import torch
 torch.set_num_threads(1)
+from torch.nn.utils.rnn import pad_sequence
 import torchaudio
-import torchaudio.functional as F
-import whisper
-import opencc
 from hyperpyyaml import load_hyperpyyaml
-from huggingface_hub import snapshot_download
-from g2pw import G2PWConverter
 
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel
-from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.flow.flow_matching import ConditionalCFM
+from cosyvoice.hifigan.hift_onnx import HiFTOnnxRuntime
+from cosyvoice.llm.runaway import RunawayGuard
+from cosyvoice.transformer.attention import ATTENTION_BACKENDS, set_attention_backend
+from cosyvoice.utils.common import fade_in_out
+from cosyvoice.utils.fast_load import init_empty_weights, load_checkpoint, save_checkpoint
 from cosyvoice.utils.file_utils import load_wav
-from cosyvoice.utils.frontend_utils import (contains_chinese, replace_blank, replace_corner_mark,remove_bracket, spell_out_number, split_paragraph)
-from utils.word_utils import word_to_dataset_frequency, char2phn, always_augment_chars
+from cosyvoice.utils.frontend_utils import split_segments
+from bopomofo_annotator import BopomofoAnnotator
+from text_normalizer import normalize_text
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/third_party/Matcha-TTS'.format(ROOT_DIR))
 
 ####new normalize
 class CustomCosyVoiceFrontEnd(CosyVoiceFrontEnd):
-    def text_normalize_new(self,text, split=False):
-        text = text.strip()
-        def split_by_brackets(input_string):
-            # Use regex to find text inside and outside the brackets
-            inside_brackets = re.findall(r'\[(.*?)\]', input_string)
-            outside_brackets = re.split(r'\[.*?\]', input_string)
-            
-            # Filter out empty strings from the outside list (result of consecutive brackets)
-            outside_brackets = [part for part in outside_brackets if part]
-            
-            return inside_brackets, outside_brackets
-        
-        def text_normalize_no_split(text, is_last=False):
-            text = text.strip()
-            text_is_terminated = text[-1] == "。"
-            if contains_chinese(text):
-                #print(text)
-                if self.use_ttsfrd:
-                    text = self.frd.get_frd_extra_info(text, 'input')
-                else:
-                    text = self.zh_tn_model.normalize(text)
-                if not text_is_terminated and not is_last:
-                    text = text[:-1]
-                #print(text)
-                text = text.replace("\n", "")
-                text = replace_blank(text)
-                text = replace_corner_mark(text)
-                text = text.replace(".", "、")
-                #print(text)
-                text = text.replace(" - ", "，")
-                #print(text)
-                text = remove_bracket(text)
-                #print(text)
-                text = re.sub(r'[，,]+$', '。', text)
-                #print(text)
-            else:
-                if self.use_ttsfrd:
-                    text = self.frd.get_frd_extra_info(text, 'input')
-                else:
-                    text = self.en_tn_model.normalize(text)
-                text = spell_out_number(text, self.inflect_parser)
-            return text
-        
-        def join_interleaved(outside, inside):
-            # Ensure the number of parts match between outside and inside
-            result = []
-            
-            # Iterate and combine alternating parts
-            for o, i in zip(outside, inside):
-                result.append(o + '[' + i + ']')
-            
-            # Append any remaining part (if outside is longer than inside)
-            if len(outside) > len(inside):
-                result.append(outside[-1])
-            
-            return ''.join(result)
-        inside_brackets, outside_brackets = split_by_brackets(text)
-        #print("io",inside_brackets, outside_brackets)
-        #text = re.sub(r'(\[[^\]]*\])(.*?)', normalize_outside_brackets, text)
-        #print(text)
-        for n in range(len(outside_brackets)):
-            e_out = text_normalize_no_split(outside_brackets[n],is_last = n == len(outside_brackets) - 1)
-            outside_brackets[n] = e_out
-            
-        text = join_interleaved(outside_brackets, inside_brackets)
-        #print()
-            
-        # if contains_chinese(text):
-        #     texts = [i for i in split_paragraph(
-        #         text, partial(self.tokenizer.encode, allowed_special=self.allowed_special),
-        #         "zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False
-        #     )]
-        # else:
-        #     texts = [i for i in split_paragraph(
-        #         text, partial(self.tokenizer.encode, allowed_special=self.allowed_special),
-        #         "en", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False
-        #     )]
-
-        if split is False:
-            return text
-        return texts
-    
-    def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k):
-        tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
+    def text_normalize_new(self, text):
+        # See text_normalizer.NormalizerPool to normalize in worker processes
+        return normalize_text(self, text)
+
+    def frontend_prompt(self, prompt_text, prompt_speech_16k):
+        """Extract everything derived from the speaker prompt once, so it can be reused for every sentence"""
         prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
         prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
         speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
         speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
         embedding = self._extract_spk_embedding(prompt_speech_16k)
-        model_input = {'text': tts_text_token, 'text_len': tts_text_token_len,
-                       'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                       'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                       'llm_embedding': embedding, 'flow_embedding': embedding}
+        prompt_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                        'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
+                        'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
+                        'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
+                        'llm_embedding': embedding, 'flow_embedding': embedding}
+        return prompt_input
+
+    def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, prompt_input=None):
+        if prompt_input is None:
+            prompt_input = self.frontend_prompt(prompt_text, prompt_speech_16k)
+        tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
+        model_input = {'text': tts_text_token, 'text_len': tts_text_token_len}
+        model_input.update(prompt_input)
         return model_input
     
     def frontend_zero_shot_dual(self, tts_text, prompt_text, prompt_speech_16k, flow_prompt_text, flow_prompt_speech_16k):
@@ -147,47 +80,133 @@ class CustomCosyVoiceFrontEnd(CosyVoiceFrontEnd):
         return model_input
 
 ####model
+# precision name -> dtype of the model weights and of the autocast region
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def default_precision(device):
+    # fp16 matmuls are slow on x86 CPUs, see benchmarks/cpu_precision.py
+    return 'fp16' if device.type == 'cuda' else 'fp32'
+
+
 class CustomCosyVoiceModel(CosyVoiceModel):
 
     def __init__(self,
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
-                 hift: torch.nn.Module):
+                 hift: torch.nn.Module,
+                 precision: str = None,
+                 attention_backend: str = None):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.precision = precision or default_precision(self.device)
+        if self.precision not in PRECISIONS:
+            raise ValueError('unknown precision {!r}, expected one of {}'.format(self.precision, ', '.join(PRECISIONS)))
+        # the modules, embeddings and prompt features are all cast to dtype
+        self.dtype = PRECISIONS[self.precision]
         self.llm = llm
         self.flow = flow
         self.hift = hift
+        if attention_backend is not None:
+            # overrides the backend of the model config, see benchmarks/attention_backend_report.py
+            set_attention_backend(self.llm, attention_backend)
+            set_attention_backend(self.flow, attention_backend)
+        # onnxruntime stand-in for hift.inference, see load_hift_onnx
+        self.hift_onnx = None
+        # Deployment default of the flow ODE solve, see ConditionalCFM.forward.
+        # A model input may override any of these with its own 'flow_config'
+        self.flow_config = {'n_timesteps': 10, 'solver': None, 't_scheduler': None,
+                            'cfg_rate': None, 'cfg_interval': None, 'cfg_schedule': None}
+        # Chunked flow decoding of inference_stream, in speech tokens (50 per
+        # second). The first chunk is decoded after token_min_hop_len tokens,
+        # every later hop doubles up to token_max_hop_len. Each chunk also
+        # decodes the next token_overlap_len tokens, whose mel is crossfaded
+        # with the start of the following chunk
+        self.token_min_hop_len = 25
+        self.token_max_hop_len = 100
+        self.token_overlap_len = 20
+        self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
+        # Stops speech token decoding that runs away instead of reaching EOS,
+        # None to decode every row up to max_token_text_ratio. Stopped rows are
+        # decoded again up to max_resamples times, except when streaming
+        self.runaway_guard = RunawayGuard()
+        self.max_resamples = 1
+        # Replays the llm decode steps as a CUDA graph, see TransformerLM.decode_batch.
+        # Off by default, every batch captures a graph of its own; on other
+        # devices the same fixed shape steps run eagerly
+        self.use_cuda_graph = False
+
+    def get_flow_config(self, flow_config=None):
+        config = dict(self.flow_config)
+        if flow_config:
+            config.update({k: v for k, v in flow_config.items() if v is not None})
+        if config['cfg_interval'] is not None:
+            # hashable, inference_batch groups the inputs by config
+            config['cfg_interval'] = tuple(config['cfg_interval'])
+        return config
 
     def load(self, llm_model, flow_model, hift_model):
-        self.llm.load_state_dict(torch.load(llm_model, map_location=self.device))
-        self.llm.to(self.device).half().eval()
-        self.flow.load_state_dict(torch.load(flow_model, map_location=self.device))
-        self.flow.to(self.device).half().eval()
-        self.hift.load_state_dict(torch.load(hift_model, map_location=self.device))
-        self.hift.to(self.device).half().eval()
+        """Load the checkpoints, or those written by save_converted
+
+        The memory-mapped checkpoint tensors become the parameters, so the
+        modules may be built by init_empty_weights and the weights are never
+        held twice. Converted checkpoints are already in self.dtype and
+        without the hift weight norm, on cpu they are used as they are mapped.
+        """
+        self.llm.load_state_dict(load_checkpoint(llm_model), assign=True)
+        self.llm.to(self.device, self.dtype).eval()
+        self.flow.load_state_dict(load_checkpoint(flow_model), assign=True)
+        self.flow.to(self.device, self.dtype).eval()
+        hift_state_dict = load_checkpoint(hift_model)
+        # inference only needs the normalized weights, compute them once
+        if any(k.endswith('weight_g') for k in hift_state_dict):
+            self.hift.load_state_dict(hift_state_dict, assign=True)
+            self.hift.remove_weight_norm()
+        else:
+            self.hift.remove_weight_norm()
+            self.hift.load_state_dict(hift_state_dict, assign=True)
+        self.hift.to(self.device, self.dtype).eval()
+
+    def save_converted(self, llm_model, flow_model, hift_model):
+        """Write the loaded weights, in self.dtype and with the hift weight norm removed, for load"""
+        for module, path in ((self.llm, llm_model), (self.flow, flow_model), (self.hift, hift_model)):
+            save_checkpoint({k: v.cpu() for k, v in module.state_dict().items()}, path)
+
+    def load_hift_onnx(self, hift_onnx_model):
+        """Vocode with a graph exported by cosyvoice/bin/export_hift_onnx.py, streaming still uses torch"""
+        self.hift_onnx = HiFTOnnxRuntime(hift_onnx_model, self.hift.upsample_scale)
+
+    def vocode(self, mel):
+        return (self.hift_onnx or self.hift).inference(mel=mel).float().cpu()
+
+    def vocode_batch(self, mels):
+        """Vocode mel spectrograms (1, C, T_i) of different lengths as one batch"""
+        mel = pad_sequence([m[0].transpose(0, 1) for m in mels], batch_first=True).transpose(1, 2)
+        mel_len = torch.tensor([m.size(2) for m in mels], dtype=torch.int32, device=mel.device)
+        speech, speech_len = (self.hift_onnx or self.hift).inference_batch(mel=mel, mel_len=mel_len)
+        speech = speech.float().cpu()
+        return [speech[i:i + 1, :j] for i, j in enumerate(speech_len.tolist())]
+
+    def autocast(self):
+        """Run the ops that need it in fp32 while the rest stays in the reduced precision"""
+        return torch.autocast(self.device.type, dtype=self.dtype, enabled=self.dtype != torch.float32)
 
     def inference(self, text, text_len, flow_embedding, llm_embedding=torch.zeros(0, 192),
                   prompt_text=torch.zeros(1, 0, dtype=torch.int32), prompt_text_len=torch.zeros(1, dtype=torch.int32),
                   llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32), llm_prompt_speech_token_len=torch.zeros(1, dtype=torch.int32),
                   flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32), flow_prompt_speech_token_len=torch.zeros(1, dtype=torch.int32),
-                  prompt_speech_feat=torch.zeros(1, 0, 80), prompt_speech_feat_len=torch.zeros(1, dtype=torch.int32)):
-        # Convert embeddings to float16
-        flow_embedding = flow_embedding.half()
-        llm_embedding = llm_embedding.half()
-        prompt_speech_feat = prompt_speech_feat.half()
-        
-        with torch.cuda.amp.autocast():
-            tts_speech_token = self.llm.inference(text=text.to(self.device),
-                                                text_len=text_len.to(self.device),
-                                                prompt_text=prompt_text.to(self.device),
-                                                prompt_text_len=prompt_text_len.to(self.device),
-                                                prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                prompt_speech_token_len=llm_prompt_speech_token_len.to(self.device),
-                                                embedding=llm_embedding.to(self.device),
-                                                beam_size=1,
-                                                sampling=25,
-                                                max_token_text_ratio=30,
-                                                min_token_text_ratio=3)
+                  prompt_speech_feat=torch.zeros(1, 0, 80), prompt_speech_feat_len=torch.zeros(1, dtype=torch.int32),
+                  llm_prompt_cache=None, flow_config=None):
+        flow_embedding = flow_embedding.to(self.dtype)
+        llm_embedding = llm_embedding.to(self.dtype)
+        prompt_speech_feat = prompt_speech_feat.to(self.dtype)
+
+        with self.autocast():
+            tts_speech_token = self.generate_tokens([{'text': text, 'text_len': text_len,
+                                                      'prompt_text': prompt_text, 'prompt_text_len': prompt_text_len,
+                                                      'llm_prompt_speech_token': llm_prompt_speech_token,
+                                                      'llm_prompt_speech_token_len': llm_prompt_speech_token_len,
+                                                      'llm_embedding': llm_embedding,
+                                                      'llm_prompt_cache': llm_prompt_cache}])[0].unsqueeze(dim=0)
 
             tts_mel = self.flow.inference(token=tts_speech_token,
                                         token_len=torch.tensor([tts_speech_token.size(1)], dtype=torch.int32).to(self.device),
@@ -195,24 +214,165 @@ class CustomCosyVoiceModel(CosyVoiceModel):
                                         prompt_token_len=flow_prompt_speech_token_len.to(self.device),
                                         prompt_feat=prompt_speech_feat.to(self.device),
                                         prompt_feat_len=prompt_speech_feat_len.to(self.device),
-                                        embedding=flow_embedding.to(self.device))
-            tts_speech = self.hift.inference(mel=tts_mel).float().cpu()  # Only convert to float32 at final output
+                                        embedding=flow_embedding.to(self.device),
+                                        **self.get_flow_config(flow_config))
+            tts_speech = self.vocode(tts_mel)
         torch.cuda.empty_cache()
         return {'tts_speech': tts_speech}
+
+    def inference_stream(self, text, text_len, flow_embedding, llm_embedding=torch.zeros(0, 192),
+                         prompt_text=torch.zeros(1, 0, dtype=torch.int32), prompt_text_len=torch.zeros(1, dtype=torch.int32),
+                         llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32), llm_prompt_speech_token_len=torch.zeros(1, dtype=torch.int32),
+                         flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32), flow_prompt_speech_token_len=torch.zeros(1, dtype=torch.int32),
+                         prompt_speech_feat=torch.zeros(1, 0, 80), prompt_speech_feat_len=torch.zeros(1, dtype=torch.int32),
+                         llm_prompt_cache=None, flow_config=None):
+        """Same as inference, but yields the audio in chunks while the llm is still decoding"""
+        flow_embedding = flow_embedding.to(self.device, self.dtype)
+        llm_embedding = llm_embedding.to(self.dtype)
+        prompt_speech_feat = prompt_speech_feat.to(self.device, self.dtype)
+        flow_config = self.get_flow_config(flow_config)
+
+        def token2mel(token):
+            return self.flow.inference(token=token,
+                                       token_len=torch.tensor([token.size(1)], dtype=torch.int32).to(self.device),
+                                       prompt_token=flow_prompt_speech_token.to(self.device),
+                                       prompt_token_len=flow_prompt_speech_token_len.to(self.device),
+                                       prompt_feat=prompt_speech_feat,
+                                       prompt_feat_len=prompt_speech_feat_len.to(self.device),
+                                       embedding=flow_embedding,
+                                       **flow_config)
+
+        mel_overlap, hift_cache = None, None
+
+        def mel2speech(tts_mel, finalize):
+            nonlocal mel_overlap, hift_cache
+            if mel_overlap is not None:
+                tts_mel = fade_in_out(tts_mel, mel_overlap)
+            if not finalize:
+                mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
+                tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
+            tts_speech, hift_cache = self.hift.inference_stream(mel=tts_mel, cache=hift_cache, finalize=finalize)
+            return {'tts_speech': tts_speech.float().cpu()}
+
+        with self.autocast():
+            tokens = torch.zeros(1, 0, dtype=torch.int64, device=self.device)
+            start, hop_len = 0, self.token_min_hop_len
+            for new_tokens in self.llm.inference_stream(text=text.to(self.device),
+                                                        text_len=text_len.to(self.device),
+                                                        prompt_text=prompt_text.to(self.device),
+                                                        prompt_text_len=prompt_text_len.to(self.device),
+                                                        prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                        prompt_speech_token_len=llm_prompt_speech_token_len.to(self.device),
+                                                        embedding=llm_embedding.to(self.device),
+                                                        sampling=25,
+                                                        max_token_text_ratio=30,
+                                                        min_token_text_ratio=3,
+                                                        use_cuda_graph=self.use_cuda_graph,
+                                                        prompt_cache=llm_prompt_cache,
+                                                        guard=self.runaway_guard):
+                tokens = torch.concat([tokens, new_tokens], dim=1)
+                while tokens.size(1) - start >= hop_len + self.token_overlap_len:
+                    yield mel2speech(token2mel(tokens[:, start:start + hop_len + self.token_overlap_len]), finalize=False)
+                    start += hop_len
+                    hop_len = min(2 * hop_len, self.token_max_hop_len)
+            yield mel2speech(token2mel(tokens[:, start:]), finalize=True)
+        torch.cuda.empty_cache()
+
+    def prefill_prompt(self, prompt_input):
+        """Cache the llm state of the voice dependent input prefix, see TransformerLM.prefill_prompt"""
+        with self.autocast():
+            return self.llm.prefill_prompt(prompt_text=prompt_input['prompt_text'].to(self.device),
+                                           prompt_text_len=prompt_input['prompt_text_len'].to(self.device),
+                                           embedding=prompt_input['llm_embedding'].to(self.device, self.dtype))
+
+    def decode_tokens(self, model_inputs):
+        """Decode the speech tokens of several model inputs as one llm batch"""
+        def pad(key):
+            return pad_sequence([i[key][0] for i in model_inputs], batch_first=True).to(self.device)
+
+        def concat(key):
+            return torch.concat([i[key] for i in model_inputs], dim=0).to(self.device)
+
+        prompt_cache = [i.get('llm_prompt_cache') for i in model_inputs]
+        if any(c is None for c in prompt_cache):
+            prompt_cache = None
+        return self.llm.inference_batch(text=pad('text'),
+                                        text_len=concat('text_len'),
+                                        prompt_text=pad('prompt_text'),
+                                        prompt_text_len=concat('prompt_text_len'),
+                                        prompt_speech_token=pad('llm_prompt_speech_token'),
+                                        prompt_speech_token_len=concat('llm_prompt_speech_token_len'),
+                                        embedding=concat('llm_embedding').to(self.dtype),
+                                        sampling=25,
+                                        max_token_text_ratio=30,
+                                        min_token_text_ratio=3,
+                                        use_cuda_graph=self.use_cuda_graph,
+                                        prompt_cache=prompt_cache,
+                                        guard=self.runaway_guard)
+
+    def generate_tokens(self, model_inputs):
+        """decode_tokens, then decode the rows stopped by the runaway guard again.
+        The sampler draws on from the global generator, so each retry is a new sample"""
+        tts_speech_tokens = self.decode_tokens(model_inputs)
+        if self.runaway_guard is None:
+            return tts_speech_tokens
+        stop_reasons = list(self.runaway_guard.last_stop_reasons)
+        for _ in range(self.max_resamples):
+            retry = [index for index, reason in enumerate(stop_reasons) if reason in RunawayGuard.RUNAWAY]
+            if not retry:
+                break
+            self.runaway_guard.counters['resampled'] += len(retry)
+            retried = self.decode_tokens([model_inputs[index] for index in retry])
+            for index, tokens, reason in zip(retry, retried, self.runaway_guard.last_stop_reasons):
+                tts_speech_tokens[index], stop_reasons[index] = tokens, reason
+        return tts_speech_tokens
+
+    def inference_batch(self, model_inputs):
+        """Run several sentences, possibly from different requests, through the llm, flow and hift stages together"""
+        flow_embeddings = [i['flow_embedding'].to(self.device, self.dtype) for i in model_inputs]
+        with self.autocast():
+            tts_speech_tokens = self.generate_tokens(model_inputs)
+            # one flow batch per solver configuration, then one vocoder batch
+            flow_configs = [self.get_flow_config(i.get('flow_config')) for i in model_inputs]
+            groups = {}
+            for index, flow_config in enumerate(flow_configs):
+                groups.setdefault(tuple(sorted(flow_config.items())), []).append(index)
+            tts_mels = [None] * len(model_inputs)
+            for indices in groups.values():
+                inputs = [model_inputs[index] for index in indices]
+                tts_mel, tts_mel_len = self.flow.inference_batch(
+                    token=pad_sequence([tts_speech_tokens[index] for index in indices], batch_first=True),
+                    token_len=torch.tensor([tts_speech_tokens[index].size(0) for index in indices], dtype=torch.int32).to(self.device),
+                    prompt_token=pad_sequence([i['flow_prompt_speech_token'][0] for i in inputs], batch_first=True).to(self.device),
+                    prompt_token_len=torch.concat([i['flow_prompt_speech_token_len'] for i in inputs]).to(self.device),
+                    prompt_feat=pad_sequence([i['prompt_speech_feat'][0] for i in inputs], batch_first=True).to(self.device, self.dtype),
+                    prompt_feat_len=torch.concat([i['prompt_speech_feat_len'] for i in inputs]).to(self.device),
+                    embedding=torch.concat([flow_embeddings[index] for index in indices]),
+                    **flow_configs[indices[0]])
+                for index, mel, mel_len in zip(indices, tts_mel, tts_mel_len.tolist()):
+                    tts_mels[index] = mel[None, :, :mel_len]
+            tts_speeches = self.vocode_batch(tts_mels)
+        return [{'tts_speech': tts_speech} for tts_speech in tts_speeches]
      
+# Where the weights converted below fp32 are kept, one subdirectory per model
+DEFAULT_CONVERTED_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'breezyvoice', 'converted')
+
+
 ###CosyVoice
 class CustomCosyVoice:
 
-    def __init__(self, model_dir):
+    def __init__(self, model_dir, precision=None, hift_onnx_model=None, attention_backend=None, cache_converted=True, converted_cache_dir=None):
         #assert os.path.exists(model_dir), f"model path '{model_dir}' not exist, please check the path: pretrained_models/CosyVoice-300M-zhtw"
         instruct = False
         
         if not os.path.exists(model_dir):
+            from huggingface_hub import snapshot_download
             model_dir = snapshot_download(model_dir)
         print("model", model_dir)
         self.model_dir = model_dir
         
-        with open('{}/cosyvoice.yaml'.format(model_dir), 'r') as f:
+        # The checkpoints replace the parameters, do not initialize them
+        with open('{}/cosyvoice.yaml'.format(model_dir), 'r') as f, init_empty_weights():
             configs = load_hyperpyyaml(f)
         self.frontend = CustomCosyVoiceFrontEnd(configs['get_tokenizer'],
                                           configs['feat_extractor'],
@@ -222,24 +382,42 @@ class CustomCosyVoice:
                                           '{}/spk2info.pt'.format(model_dir),
                                           instruct,
                                           configs['allowed_special'])
-        self.model = CustomCosyVoiceModel(configs['llm'], configs['flow'], configs['hift'])
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        self.model = CustomCosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], precision, attention_backend)
+        # Below fp32 the weights are converted once and kept in the cache
+        # directory, later starts map them without converting
+        converted_dir = os.path.join(converted_cache_dir or DEFAULT_CONVERTED_CACHE_DIR,
+                                     hashlib.sha1(os.path.realpath(model_dir).encode()).hexdigest()[:16])
+        converted = ['{}/{}.{}.pt'.format(converted_dir, name, self.model.precision) for name in ('llm', 'flow', 'hift')]
+        if self.model.precision != 'fp32' and all(os.path.exists(path) for path in converted):
+            self.model.load(*converted)
+        else:
+            self.model.load('{}/llm.pt'.format(model_dir),
+                            '{}/flow.pt'.format(model_dir),
+                            '{}/hift.pt'.format(model_dir))
+            if self.model.precision != 'fp32' and cache_converted:
+                try:
+                    os.makedirs(converted_dir, exist_ok=True)
+                    self.model.save_converted(*converted)
+                except OSError as e:
+                    logging.warning('failed to cache the converted weights: {}'.format(e))
+        if hift_onnx_model:
+            self.model.load_hift_onnx(hift_onnx_model)
         del configs
-        self.cached_prompt_embedding = None
-        self.cached_prompt_speech_token = None
-        self.cached_prompt_speech_token_len = None
-
-    def precompute_prompt_embeddings(self, prompt_speech_16k):
-        """Precompute and cache prompt embeddings and tokens for faster inference"""
-        self.cached_prompt_embedding = self.frontend._extract_spk_embedding(prompt_speech_16k)
-        self.cached_prompt_speech_token, self.cached_prompt_speech_token_len = self.frontend._extract_speech_token(prompt_speech_16k)
-        return {
-            'embedding': self.cached_prompt_embedding,
-            'speech_token': self.cached_prompt_speech_token,
-            'speech_token_len': self.cached_prompt_speech_token_len
-        }
+        # Deployment default of how a text is cut into model inputs, see
+        # split_segments. The default synthesizes every sentence on its own
+        self.segment_config = {'first_max_n': 0, 'token_max_n': 0, 'merge_len': 0, 'comma_split': False}
+
+    def get_segment_config(self, segment_config=None):
+        config = dict(self.segment_config)
+        if segment_config:
+            config.update({k: v for k, v in segment_config.items() if v is not None})
+        return config
+
+    def precompute_prompt(self, prompt_text, prompt_speech_16k):
+        """Precompute the prompt conditioning (text tokens, speech tokens, mel feat, embedding, llm prefix cache) for faster inference"""
+        prompt_input = self.frontend.frontend_prompt(prompt_text, prompt_speech_16k)
+        prompt_input['llm_prompt_cache'] = self.model.prefill_prompt(prompt_input)
+        return prompt_input
 
     def list_avaliable_spks(self):
         spks = list(self.frontend.spk2info.keys())
@@ -255,9 +433,10 @@ class CustomCosyVoice:
 
     def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k):
         prompt_text = self.frontend.text_normalize(prompt_text, split=False)
+        prompt_input = self.precompute_prompt(prompt_text, prompt_speech_16k)
         tts_speeches = []
         for i in self.frontend.text_normalize(tts_text, split=True):
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k)
+            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, prompt_input)
             model_output = self.model.inference(**model_input)
             tts_speeches.append(model_output['tts_speech'])
         return {'tts_speech': torch.concat(tts_speeches, dim=1)}
@@ -280,26 +459,34 @@ class CustomCosyVoice:
             tts_speeches.append(model_output['tts_speech'])
         return {'tts_speech': torch.concat(tts_speeches, dim=1)}
         
-    def inference_zero_shot_no_normalize(self, tts_text, prompt_text, prompt_speech_16k):
-        prompt_text = prompt_text
-        tts_speeches = []
-        for i in re.split(r'(?<=[？！。.?!])\s*', tts_text):
-            if not len(i):
-                continue
+    def inference_zero_shot_no_normalize(self, tts_text, prompt_text, prompt_speech_16k, prompt_input=None):
+        # every sentence is needed before returning, decode them all together
+        model_inputs = self.frontend_zero_shot_no_normalize(tts_text, prompt_text, prompt_speech_16k, prompt_input)
+        model_outputs = self.model.inference_batch(model_inputs)
+        return {'tts_speech': torch.concat([model_output['tts_speech'] for model_output in model_outputs], dim=1)}
+
+    def inference_zero_shot_no_normalize_stream(self, tts_text, prompt_text, prompt_speech_16k, prompt_input=None, chunked=False):
+        """Same as inference_zero_shot_no_normalize, but yields each sentence's audio as soon as it is ready,
+        or with chunked=True each chunk of a sentence while the rest of it is still being generated"""
+        for model_input in self.frontend_zero_shot_no_normalize(tts_text, prompt_text, prompt_speech_16k, prompt_input):
+            if chunked:
+                yield from self.model.inference_stream(**model_input)
+            else:
+                yield self.model.inference(**model_input)
+
+    def frontend_zero_shot_no_normalize(self, tts_text, prompt_text, prompt_speech_16k, prompt_input=None, segment_config=None):
+        """Split tts_text into segments and build the model input of each one,
+        segment_config overrides any of self.segment_config"""
+        # The prompt conditioning is the same for every sentence, extract it only once
+        if prompt_input is None:
+            prompt_input = self.precompute_prompt(prompt_text, prompt_speech_16k)
+        tokenize = partial(self.frontend.tokenizer.encode, allowed_special=self.frontend.allowed_special)
+        model_inputs = []
+        for i in split_segments(tts_text, tokenize, **self.get_segment_config(segment_config)):
             print("Synthesizing:",i)
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k)
-            # Use cached embeddings if available
-            if self.cached_prompt_embedding is not None:
-                model_input['llm_embedding'] = self.cached_prompt_embedding
-                model_input['flow_embedding'] = self.cached_prompt_embedding
-                model_input['llm_prompt_speech_token'] = self.cached_prompt_speech_token
-                model_input['llm_prompt_speech_token_len'] = self.cached_prompt_speech_token_len
-                model_input['flow_prompt_speech_token'] = self.cached_prompt_speech_token
-                model_input['flow_prompt_speech_token_len'] = self.cached_prompt_speech_token_len
-            model_output = self.model.inference(**model_input)
-            tts_speeches.append(model_output['tts_speech'])
-        return {'tts_speech': torch.concat(tts_speeches, dim=1)}
-        
+            model_inputs.append(self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, prompt_input))
+        return model_inputs
+
 ####wav2text
 def transcribe_audio(audio_file):
     #model = whisper.load_model("base")
@@ -312,40 +499,17 @@ def transcribe_audio(audio_file):
     # Perform ASR on an audio file
     result = whisper_asr(audio_file)
 
+    import opencc
     converter = opencc.OpenCC('s2t')
     traditional_text = converter.convert(result["text"])
     return traditional_text
 
 def get_bopomofo_rare(text, converter):
-    res = converter(text)
-    text_w_bopomofo = [x for x in zip(list(text), res[0])]
-    reconstructed_text = ""
-    
-    for i in range(len(text_w_bopomofo)):
-        t = text_w_bopomofo[i]
-        try:
-            next_t_char = text_w_bopomofo[i+1][0]
-        except:
-            next_t_char = None
-        #print(t[0], word_to_dataset_frequency[t[0]], t[1])
-        
-        if word_to_dataset_frequency[t[0]] < 500 and t[1] != None and next_t_char != '[':
-            # Add the char and the pronunciation
-            reconstructed_text += t[0] + f"[:{t[1]}]"
-        
-        elif len(char2phn[t[0]]) >= 2:
-            if t[1] != char2phn[t[0]][0] and (word_to_dataset_frequency[t[0]] < 10000 or t[0] in always_augment_chars) and next_t_char != '[':  # Not most common pronunciation
-                # Add the char and the pronunciation
-                reconstructed_text += t[0] + f"[:{t[1]}]"
-            else:
-                reconstructed_text += t[0]
-            #print("DEBUG, multiphone char", t[0], char2phn[t[0]])
-        else:
-            # Add only the char
-            reconstructed_text += t[0]
-    
-    #print("Reconstructed:", reconstructed_text)
-    return reconstructed_text
+    """Mark the bopomofo of rare characters and uncommon readings in text, see BopomofoAnnotator.
+    converter is a BopomofoAnnotator, or a G2PWConverter to annotate this text only"""
+    if not isinstance(converter, BopomofoAnnotator):
+        converter = BopomofoAnnotator(converter)
+    return converter.annotate(text)
 
 import re
 
@@ -391,14 +555,8 @@ def single_inference(speaker_prompt_audio_path, content_to_synthesize, output_pa
     
     
     ###normalization
-    speaker_prompt_text_transcription = cosyvoice.frontend.text_normalize_new(
-        speaker_prompt_text_transcription, 
-        split=False
-    )
-    content_to_synthesize = cosyvoice.frontend.text_normalize_new(
-        content_to_synthesize, 
-        split=False
-    )
+    speaker_prompt_text_transcription = cosyvoice.frontend.text_normalize_new(speaker_prompt_text_transcription)
+    content_to_synthesize = cosyvoice.frontend.text_normalize_new(content_to_synthesize)
     speaker_prompt_text_transcription_bopomo = get_bopomofo_rare(speaker_prompt_text_transcription, bopomofo_converter)
     print("Speaker prompt audio transcription:",speaker_prompt_text_transcription_bopomo)
     
@@ -423,12 +581,30 @@ def main():
     parser.add_argument("--output_path", type=str, required=False, default="results/output.wav", help="Specifies the name and path for the output .wav file.")
     
     parser.add_argument("--model_path", type=str, required=False, default = "MediaTek-Research/BreezyVoice-300M",help="Specifies the model used for speech synthesis.")
+    parser.add_argument("--flow_steps", type=int, required=False, default=10, help="Specifies the number of ODE steps of the flow decoder.")
+    parser.add_argument("--flow_solver", type=str, required=False, default="euler", choices=list(ConditionalCFM.SOLVERS), help="Specifies the ODE solver of the flow decoder.")
+    parser.add_argument("--flow_schedule", type=str, required=False, default="cosine", choices=list(ConditionalCFM.T_SCHEDULERS), help="Specifies how the flow decoder steps are spaced in time.")
+    parser.add_argument("--flow_cfg_rate", type=float, required=False, default=None, help="Specifies the classifier-free guidance rate of the flow decoder, defaults to that of the model.")
+    parser.add_argument("--flow_cfg_interval", type=float, nargs=2, required=False, default=[0.0, 1.0], metavar=("START", "END"), help="Specifies the flow time interval in which guidance is applied, the other steps skip the unconditional pass.")
+    parser.add_argument("--flow_cfg_schedule", type=str, required=False, default="constant", choices=list(ConditionalCFM.CFG_SCHEDULES), help="Specifies the guidance rate curve over the flow time.")
+    parser.add_argument("--precision", type=str, required=False, default=None, choices=list(PRECISIONS), help="Specifies the numeric precision of the models, defaults to fp16 on GPU and fp32 on CPU.")
+    parser.add_argument("--hift_onnx_path", type=str, required=False, default=None, help="Specifies a vocoder exported by cosyvoice/bin/export_hift_onnx.py to run with onnxruntime.")
+    parser.add_argument("--attention_backend", type=str, required=False, default=None, choices=list(ATTENTION_BACKENDS), help="Specifies the attention implementation of the llm and the flow encoder, defaults to that of the model config.")
+    parser.add_argument("--converted_cache_dir", type=str, required=False, default=None, help="Specifies where the weights converted below fp32 are cached, defaults to ~/.cache/breezyvoice/converted.")
+    parser.add_argument("--max_token_text_ratio", type=float, required=False, default=None, help="Specifies a cap on speech tokens per text token, tighter than the default of 30.")
+    parser.add_argument("--runaway_resamples", type=int, required=False, default=1, help="Specifies how many times a sentence stopped by the runaway guard is decoded again.")
     args = parser.parse_args()
     
     
-    cosyvoice = CustomCosyVoice(args.model_path)
+    cosyvoice = CustomCosyVoice(args.model_path, args.precision, args.hift_onnx_path, args.attention_backend,
+                                converted_cache_dir=args.converted_cache_dir)
+    cosyvoice.model.runaway_guard.max_token_text_ratio = args.max_token_text_ratio
+    cosyvoice.model.max_resamples = args.runaway_resamples
+    cosyvoice.model.flow_config = {'n_timesteps': args.flow_steps, 'solver': args.flow_solver, 't_scheduler': args.flow_schedule,
+                                   'cfg_rate': args.flow_cfg_rate, 'cfg_interval': args.flow_cfg_interval, 'cfg_schedule': args.flow_cfg_schedule}
 
-    bopomofo_converter = G2PWConverter()
+    from g2pw import G2PWConverter
+    bopomofo_converter = BopomofoAnnotator(G2PWConverter())
 
     speaker_prompt_audio_path = args.speaker_prompt_audio_path
     content_to_synthesize = args.content_to_synthesize
@@ -0,0 +1,57 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+
+import torch  # noqa: E402
+from torch.nn.utils.rnn import pad_sequence  # noqa: E402
+
+from cosyvoice.llm.llm import TransformerLM  # noqa: E402
+from cosyvoice.transformer.encoder import ConformerEncoder, TransformerEncoder  # noqa: E402
+
+
+def build_lm():
+    """A small TransformerLM with random weights, in eval mode"""
+    torch.manual_seed(0)
+    text_encoder = ConformerEncoder(input_size=64, output_size=64, attention_heads=4, linear_units=128, num_blocks=2,
+                                    dropout_rate=0.1, positional_dropout_rate=0.1, attention_dropout_rate=0.0,
+                                    normalize_before=True, input_layer='linear', pos_enc_layer_type='rel_pos_espnet',
+                                    selfattention_layer_type='rel_selfattn', use_cnn_module=False, macaron_style=False,
+                                    use_dynamic_chunk=False, use_dynamic_left_chunk=False, static_chunk_size=1)
+    llm = TransformerEncoder(input_size=64, output_size=64, attention_heads=4, linear_units=128, num_blocks=3,
+                             dropout_rate=0.1, positional_dropout_rate=0.1, attention_dropout_rate=0.0,
+                             input_layer='linear_legacy', pos_enc_layer_type='rel_pos_espnet',
+                             selfattention_layer_type='rel_selfattn', static_chunk_size=1)
+    lm = TransformerLM(text_encoder_input_size=64, llm_input_size=64, llm_output_size=64, text_token_size=100,
+                       speech_token_size=50, text_encoder=text_encoder, llm=llm, spk_embed_dim=16)
+    for param in lm.parameters():
+        torch.nn.init.normal_(param, std=0.3)
+    with torch.no_grad():
+        # make EOS likely enough that rows stop at different steps
+        lm.llm_decoder.bias[50] = 1.0
+    return lm.eval()
+
+
+def lm_rows():
+    """TransformerLM inputs of three sentences, each a batch of one"""
+    torch.manual_seed(1)
+    return [dict(text=torch.randint(0, 100, (1, text_len)), text_len=torch.tensor([text_len]),
+                 prompt_text=torch.randint(0, 100, (1, prompt_len)), prompt_text_len=torch.tensor([prompt_len]),
+                 prompt_speech_token=torch.randint(0, 50, (1, speech_len)), prompt_speech_token_len=torch.tensor([speech_len]),
+                 embedding=torch.randn(1, 16))
+            for text_len, prompt_len, speech_len in [(5, 4, 6), (9, 3, 0), (3, 7, 10)]]
+
+
+def lm_batch(rows):
+    """The rows as one right padded batch"""
+    def pad(key):
+        return pad_sequence([row[key][0] for row in rows], batch_first=True)
+
+    def concat(key):
+        return torch.concat([row[key] for row in rows])
+
+    return dict(text=pad('text'), text_len=concat('text_len'), prompt_text=pad('prompt_text'), prompt_text_len=concat('prompt_text_len'),
+                prompt_speech_token=pad('prompt_speech_token'), prompt_speech_token_len=concat('prompt_speech_token_len'),
+                embedding=concat('embedding'))
@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from conftest import build_lm
+from cosyvoice.transformer.attention import MultiHeadedAttention, RelPositionMultiHeadedAttention, set_attention_backend
+from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding
+
+
+def masks(lengths, frames):
+    causal = torch.tril(torch.ones(frames, frames, dtype=torch.bool))
+    right_padded = (torch.arange(frames)[None] < lengths[:, None]).unsqueeze(1)
+    left_padded = (torch.arange(frames)[None] >= (frames - lengths)[:, None]).unsqueeze(1)
+    return {'none': torch.ones(0, 0, 0, dtype=torch.bool),
+            'padding': right_padded,
+            'causal padding': right_padded & causal,
+            'causal left padding': left_padded & causal}
+
+
+@pytest.mark.parametrize('cls', [MultiHeadedAttention, RelPositionMultiHeadedAttention])
+@pytest.mark.parametrize('mask_name', ['none', 'padding', 'causal padding', 'causal left padding'])
+@torch.inference_mode()
+def test_sdpa_matches_math(cls, mask_name):
+    torch.manual_seed(0)
+    attention = cls(4, 64, 0.0).eval()
+    x = torch.randn(3, 20, 64)
+    mask = masks(torch.tensor([20, 13, 1]), 20)[mask_name]
+    _, pos_emb = EspnetRelPositionalEncoding(64, 0.0)(x)
+    attention.backend = 'math'
+    expected, expected_cache = attention(x, x, x, mask, pos_emb)
+    attention.backend = 'sdpa'
+    output, cache = attention(x, x, x, mask, pos_emb)
+    # queries without any key to attend may differ
+    valid = mask.any(dim=-1).unsqueeze(-1) if mask.size(0) else torch.ones(3, 20, 1, dtype=torch.bool)
+    torch.testing.assert_close(output * valid, expected * valid, atol=1e-5, rtol=1e-4)
+    torch.testing.assert_close(cache, expected_cache)
+    assert not output.isnan().any()
+
+
+@torch.inference_mode()
+def test_sdpa_llm_matches_math():
+    lm = build_lm()
+    x = torch.randn(2, 30, 64)
+    lengths = torch.tensor([30, 17])
+    set_attention_backend(lm, 'math')
+    expected, _ = lm.llm(x, lengths)
+    set_attention_backend(lm, 'sdpa')
+    output, _ = lm.llm(x, lengths)
+    torch.testing.assert_close(output[0], expected[0], atol=1e-5, rtol=1e-4)
+    torch.testing.assert_close(output[1, :17], expected[1, :17], atol=1e-5, rtol=1e-4)
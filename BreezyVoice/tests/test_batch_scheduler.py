@@ -0,0 +1,71 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_scheduler import BatchScheduler
+
+
+def run(coroutine_fn, max_batch_size=8):
+    batches = []
+
+    def batch_fn(items):
+        batches.append(list(items))
+        if 'fail' in items:
+            raise ValueError('fail')
+        return [item * 2 for item in items]
+
+    async def main():
+        scheduler = BatchScheduler(batch_fn, ThreadPoolExecutor(max_workers=1), max_batch_size, max_wait_ms=20)
+        scheduler.start()
+        try:
+            return await coroutine_fn(scheduler)
+        finally:
+            await scheduler.stop()
+            scheduler.executor.shutdown()
+
+    return asyncio.run(main()), batches
+
+
+def test_concurrent_items_are_batched_and_routed_back():
+    outputs, batches = run(lambda scheduler: asyncio.gather(*[scheduler.submit(i) for i in range(5)]))
+    assert outputs == [0, 2, 4, 6, 8]
+    assert batches == [[0, 1, 2, 3, 4]]
+
+
+def test_batches_are_capped():
+    outputs, batches = run(lambda scheduler: asyncio.gather(*[scheduler.submit(i) for i in range(5)]), max_batch_size=2)
+    assert outputs == [0, 2, 4, 6, 8]
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_errors_only_reach_the_failing_item():
+    async def submit(scheduler):
+        return await asyncio.gather(scheduler.submit('fail'), scheduler.submit(1), return_exceptions=True)
+
+    outputs, batches = run(submit)
+    assert isinstance(outputs[0], ValueError) and outputs[1] == 2
+    assert batches == [['fail', 1], ['fail'], [1]]
+
+
+def test_items_submitted_after_started_form_a_later_batch():
+    async def submit(scheduler):
+        started = asyncio.Event()
+        first = asyncio.ensure_future(scheduler.submit(0, started))
+        await started.wait()
+        rest = [asyncio.ensure_future(scheduler.submit(i)) for i in range(1, 4)]
+        return await asyncio.gather(first, *rest)
+
+    outputs, batches = run(submit)
+    assert outputs == [0, 2, 4, 6]
+    assert batches == [[0], [1, 2, 3]]
+
+
+def test_cancelled_items_are_dropped():
+    async def submit(scheduler):
+        tasks = [asyncio.ensure_future(scheduler.submit(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks[1].cancel()
+        return await asyncio.gather(tasks[0], tasks[2])
+
+    outputs, batches = run(submit)
+    assert outputs == [0, 4]
+    assert batches == [[0, 2]]
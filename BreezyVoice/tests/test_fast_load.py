@@ -0,0 +1,42 @@
+import threading
+
+import torch
+
+from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding
+from cosyvoice.utils.fast_load import init_empty_weights, load_checkpoint, save_checkpoint
+
+
+def test_parameters_are_meta_and_computed_tensors_are_not():
+    with init_empty_weights():
+        linear = torch.nn.Linear(4, 4)
+        pos_enc = EspnetRelPositionalEncoding(8, 0.0)
+    assert linear.weight.is_meta and linear.bias.is_meta
+    assert not pos_enc.pe.is_meta
+    assert not torch.nn.Linear(4, 4).weight.is_meta
+
+
+def test_other_threads_are_not_affected():
+    built, entered = {}, threading.Event()
+
+    def build():
+        entered.wait()
+        built['other'] = torch.nn.Linear(4, 4)
+
+    thread = threading.Thread(target=build)
+    thread.start()
+    with init_empty_weights():
+        entered.set()
+        thread.join()
+        built['own'] = torch.nn.Linear(4, 4)
+    assert built['own'].weight.is_meta and not built['other'].weight.is_meta
+
+
+def test_checkpoint_round_trip(tmp_path):
+    path = str(tmp_path / 'linear.pt')
+    expected = torch.nn.Linear(4, 4).state_dict()
+    save_checkpoint(expected, path)
+    with init_empty_weights():
+        linear = torch.nn.Linear(4, 4)
+    linear.load_state_dict(load_checkpoint(path), assign=True)
+    for key, value in expected.items():
+        assert torch.equal(getattr(linear, key), value)
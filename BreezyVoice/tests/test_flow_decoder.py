@@ -0,0 +1,43 @@
+import torch
+
+from cosyvoice.flow import decoder
+from cosyvoice.flow.decoder import ConditionalDecoder
+
+
+def build_decoder():
+    torch.manual_seed(0)
+    return ConditionalDecoder(in_channels=80 * 4, out_channels=80, channels=[32, 32], dropout=0.0, attention_head_dim=16,
+                              n_blocks=1, num_mid_blocks=1, num_heads=2, act_fn='gelu').eval()
+
+
+def inputs(lengths):
+    torch.manual_seed(1)
+    batch_size, frames = len(lengths), max(lengths)
+    mask = (torch.arange(frames)[None] < torch.tensor(lengths)[:, None]).float().unsqueeze(1)
+    return (torch.randn(batch_size, 80, frames), mask, torch.randn(batch_size, 80, frames), torch.rand(batch_size),
+            torch.randn(batch_size, 80), torch.randn(batch_size, 80, frames))
+
+
+@torch.inference_mode()
+def test_padded_batch_matches_single_rows():
+    estimator = build_decoder()
+    lengths = [37, 22, 30]
+    x, mask, mu, t, spks, cond = inputs(lengths)
+    output = estimator(x, mask, mu, t, spks, cond)
+    for i, length in enumerate(lengths):
+        single = estimator(x[i:i + 1, :, :length], mask[i:i + 1, :, :length], mu[i:i + 1, :, :length], t[i:i + 1],
+                           spks[i:i + 1], cond[i:i + 1, :, :length])
+        torch.testing.assert_close(output[i:i + 1, :, :length], single, atol=1e-4, rtol=1e-4)
+        assert not output[i, :, length:].any()
+
+
+@torch.inference_mode()
+def test_unpadded_batch_skips_the_masked_group_norm(monkeypatch):
+    estimator = build_decoder()
+    calls = []
+    masked_group_norm = decoder.masked_group_norm
+    monkeypatch.setattr(decoder, 'masked_group_norm', lambda *args: calls.append(1) or masked_group_norm(*args))
+    estimator(*inputs([30, 30]))
+    assert not calls
+    estimator(*inputs([30, 24]))
+    assert calls
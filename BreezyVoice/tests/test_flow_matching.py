@@ -0,0 +1,114 @@
+import math
+
+import pytest
+import torch
+from omegaconf import DictConfig
+
+from cosyvoice.flow.decoder import ConditionalDecoder
+from cosyvoice.flow.flow_matching import ConditionalCFM
+
+
+def build_cfm():
+    torch.manual_seed(0)
+    estimator = ConditionalDecoder(in_channels=80 * 4, out_channels=80, channels=[32, 32], dropout=0.0, attention_head_dim=16,
+                                   n_blocks=1, num_mid_blocks=1, num_heads=2, act_fn='gelu')
+    cfm_params = DictConfig(dict(sigma_min=1e-6, solver='euler', t_scheduler='cosine', training_cfg_rate=0.2,
+                                 inference_cfg_rate=0.7, reg_loss_type='l1'))
+    return ConditionalCFM(in_channels=240, cfm_params=cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator).eval()
+
+
+def inputs(batch_size=2, length=24):
+    torch.manual_seed(1)
+    mu = torch.randn(batch_size, 80, length)
+    mask = torch.ones(batch_size, 1, length)
+    mask[1:, :, length - 6:] = 0
+    return mu, mask, torch.randn(batch_size, 80), torch.randn(batch_size, 80, length)
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+@torch.inference_mode()
+def test_cfg_runs_as_one_estimator_call_per_step(batch_size):
+    cfm = build_cfm()
+    mu, mask, spks, cond = inputs(batch_size)
+    batch_sizes = []
+    cfm.estimator.register_forward_pre_hook(lambda module, args: batch_sizes.append(args[0].size(0)))
+    # the initial noise is drawn from the global generator
+    torch.manual_seed(3)
+    output = cfm(mu, mask, 4, spks=spks, cond=cond)
+    assert batch_sizes == [2 * batch_size] * 4
+
+    # the conditional and unconditional passes as separate calls
+    torch.manual_seed(3)
+    x = torch.randn_like(mu)
+    t_span = 1 - torch.cos(torch.linspace(0, 1, 5) * 0.5 * torch.pi)
+    for t, dt in zip(t_span[:-1], t_span.diff()):
+        dphi_dt = cfm.estimator(x, mask, mu, t, spks, cond)
+        cfg_dphi_dt = cfm.estimator(x, mask, torch.zeros_like(mu), t, torch.zeros_like(spks), torch.zeros_like(cond))
+        x = x + dt * (1.7 * dphi_dt - 0.7 * cfg_dphi_dt)
+    torch.testing.assert_close(output, x, atol=1e-5, rtol=1e-4)
+
+
+def test_guidance_interval():
+    cfm = build_cfm()
+    guidance = cfm.get_guidance(0.7, (0.0, 1.0), 'constant')
+    assert guidance(0.0) == guidance(0.5) == guidance(1.0) == 0.7
+    guidance = cfm.get_guidance(0.7, (0.2, 0.6), 'constant')
+    assert guidance(0.1) == guidance(0.6) == guidance(1.0) == 0.0
+    assert guidance(0.2) == 0.7
+    assert cfm.get_guidance(0.7, (0.0, 0.0), 'constant')(0.0) == 0.0
+    with pytest.raises(ValueError):
+        cfm.get_guidance(0.7, (0.0, 1.0), 'square')
+
+
+@pytest.mark.parametrize('solver', ['midpoint', 'heun'])
+def test_default_interval_guides_every_call(solver):
+    cfm = build_cfm()
+    mu, mask, spks, cond = inputs()
+    batch_sizes = []
+    cfm.estimator.register_forward_pre_hook(lambda module, args: batch_sizes.append(args[0].size(0)))
+    cfm(mu, mask, 4, spks=spks, cond=cond, solver=solver)
+    assert batch_sizes and set(batch_sizes) == {2 * mu.size(0)}
+
+
+class RelaxToMu(torch.nn.Module):
+    """Estimator of dx/dt = mu - x, guided with a constant rate g it solves to
+    x(1) = (1 + g) mu + (x(0) - (1 + g) mu) / e"""
+
+    def forward(self, x, mask, mu, t, spks, cond):
+        return (mu - x) * mask
+
+
+def solve(cfm, solver, n_timesteps, **kwargs):
+    mu, mask, spks, cond = inputs()
+    # the initial noise is drawn from the global generator
+    torch.manual_seed(3)
+    return cfm(mu, mask, n_timesteps, spks=spks, cond=cond, solver=solver, **kwargs)
+
+
+@pytest.mark.parametrize('t_scheduler', ['cosine', 'linear'])
+@pytest.mark.parametrize('cfg_rate', [0.0, 0.7])
+def test_solvers_converge_to_the_exact_solution(t_scheduler, cfg_rate):
+    cfm = build_cfm()
+    cfm.estimator = RelaxToMu()
+    mu, mask, _, _ = inputs()
+    torch.manual_seed(3)
+    x0 = torch.randn_like(mu)
+    exact = ((1 + cfg_rate) * mu + (x0 - (1 + cfg_rate) * mu) * math.exp(-1)) * mask
+    errors = {}
+    for solver in cfm.SOLVERS:
+        errors[solver] = [float(((solve(cfm, solver, n, t_scheduler=t_scheduler, cfg_rate=cfg_rate) - exact) * mask).abs().max())
+                          for n in (4, 8, 16)]
+        assert errors[solver][0] > errors[solver][1] > errors[solver][2], solver
+    # halving the step divides the error of euler by 2, that of the second order solvers by about 4
+    assert errors['euler'][1] / errors['euler'][2] < 2.5
+    for solver in ('midpoint', 'heun', 'ab2'):
+        assert errors[solver][1] / errors[solver][2] > 3, solver
+        assert errors[solver][2] < errors['euler'][2], solver
+
+
+def test_unknown_solver():
+    cfm = build_cfm()
+    with pytest.raises(ValueError):
+        solve(cfm, 'rk4', 4)
+    with pytest.raises(ValueError):
+        solve(cfm, 'euler', 4, t_scheduler='square')
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+import torch
+
+from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
+from cosyvoice.hifigan.generator import HiFTGenerator, SineGen
+
+
+def build_hift(stream_context_len=24):
+    torch.manual_seed(0)
+    hift = HiFTGenerator(in_channels=80, base_channels=32, f0_predictor=ConvRNNF0Predictor(cond_channels=32),
+                         stream_context_len=stream_context_len).eval()
+    with torch.no_grad():
+        for param in hift.parameters():
+            param.add_(torch.randn_like(param) * 0.05)
+    return hift
+
+
+def seeded(fn, *args, **kwargs):
+    # the source draws its initial phase and its noise from the global generator
+    torch.manual_seed(7)
+    return fn(*args, **kwargs)
+
+
+def test_sine_gen_matches_sample_rate_integration():
+    sine_gen = SineGen(22050, harmonic_num=8, sine_amp=1.0, voiced_threshold=-1, upsample_scale=256)
+    torch.manual_seed(0)
+    f0 = torch.rand(2, 1, 90) * 320 + 80
+    harmonics = torch.arange(1, 10, dtype=torch.float64).view(1, -1, 1)
+    phase = torch.cumsum(f0.double().repeat_interleave(256, dim=-1) * harmonics / 22050, dim=-1) % 1
+    phase_vec = torch.zeros(2, 9, 1)
+    sine, uv, _ = sine_gen(f0, phase_vec=phase_vec, noise=torch.zeros(2, 9, 90 * 256))
+    assert sine.shape == (2, 9, 90 * 256) and bool(uv.all())
+    assert (sine.double() - torch.sin(2 * np.pi * phase)).abs().max() < 1e-3
+
+
+def test_sine_gen_continues_from_cycles():
+    sine_gen = SineGen(22050, harmonic_num=8, upsample_scale=256)
+    torch.manual_seed(0)
+    f0 = (torch.rand(2, 1, 40) * 320 + 80) * (torch.rand(2, 1, 40) > 0.2)
+    phase_vec = sine_gen.random_phase(2, f0.device)
+    noise = torch.randn(2, 9, 40 * 256)
+    whole, _, _ = sine_gen(f0, phase_vec=phase_vec, noise=noise)
+    harmonics = torch.arange(1, 10).view(1, -1, 1)
+    cycles = (f0[:, :, :25].double() * harmonics * 256 / 22050).sum(dim=-1, keepdim=True) % 1
+    head, _, _ = sine_gen(f0[:, :, :25], phase_vec=phase_vec, noise=noise[:, :, :25 * 256])
+    tail, _, _ = sine_gen(f0[:, :, 25:], cycles=cycles.float(), phase_vec=phase_vec, noise=noise[:, :, 25 * 256:])
+    torch.testing.assert_close(torch.concat([head, tail], dim=-1), whole, atol=1e-4, rtol=0)
+
+
+def test_remove_weight_norm_keeps_the_output():
+    hift = build_hift()
+    mel = torch.randn(1, 80, 40)
+    expected = seeded(hift.inference, mel)
+    hift.remove_weight_norm()
+    assert not any(name.endswith('weight_g') for name in hift.state_dict())
+    torch.testing.assert_close(seeded(hift.inference, mel), expected, atol=1e-5, rtol=1e-4)
+
+
+def test_converted_checkpoint_loads_into_a_folded_generator():
+    # CustomCosyVoiceModel.load removes the weight norm before loading a converted checkpoint
+    hift = build_hift()
+    hift.remove_weight_norm()
+    mel = torch.randn(1, 80, 40)
+    expected = seeded(hift.inference, mel)
+    loaded = build_hift()
+    loaded.remove_weight_norm()
+    loaded.load_state_dict({k: v.clone() for k, v in hift.state_dict().items()}, assign=True)
+    torch.testing.assert_close(seeded(loaded.inference, mel), expected)
+
+
+def without_noise(monkeypatch, hift):
+    """The source noise is drawn per sample and its initial phase per row,
+    give every row the same phase and no noise so that outputs can be compared"""
+    monkeypatch.setattr(torch, 'randn_like', lambda x, **kwargs: torch.zeros_like(x))
+    torch.manual_seed(7)
+    phase_vec = hift.m_source.l_sin_gen.random_phase(1, 'cpu')
+    monkeypatch.setattr(hift.m_source.l_sin_gen, 'random_phase', lambda batch_size, device: phase_vec.expand(batch_size, -1, -1).clone())
+
+
+def test_batch_matches_single_rows(monkeypatch):
+    hift = build_hift()
+    hift.remove_weight_norm()
+    without_noise(monkeypatch, hift)
+    lengths = [40, 23]
+    mel = torch.randn(2, 80, 40)
+    speech, speech_len = hift.inference_batch(mel, torch.tensor(lengths))
+    assert speech_len.tolist() == [length * hift.upsample_scale for length in lengths]
+    for i, length in enumerate(lengths):
+        single = hift.inference(mel[i:i + 1, :, :length])
+        assert single.size(1) == speech_len[i]
+        # the last frames of a padded row see its repeated last frame instead of the end of the input
+        end = single.size(1) - (0 if length == max(lengths) else 8 * hift.upsample_scale)
+        torch.testing.assert_close(speech[i:i + 1, :end], single[:, :end], atol=1e-4, rtol=0)
+        assert not speech[i, single.size(1):].any()
+
+
+@pytest.mark.parametrize('sizes', [[10] * 12, [50, 3, 67], [120]])
+def test_stream_matches_inference(monkeypatch, sizes):
+    hift = build_hift()
+    hift.remove_weight_norm()
+    without_noise(monkeypatch, hift)
+    mel = torch.randn(1, 80, sum(sizes))
+    expected = hift.inference(mel)
+    cache, chunks, start = None, [], 0
+    for i, size in enumerate(sizes):
+        chunk, cache = hift.inference_stream(mel[:, :, start:start + size], cache, finalize=i == len(sizes) - 1)
+        chunks.append(chunk)
+        start += size
+    speech = torch.concat(chunks, dim=1)
+    assert speech.shape == expected.shape
+    torch.testing.assert_close(speech, expected, atol=2e-3, rtol=0)
@@ -0,0 +1,24 @@
+from utils.lexicon import Lexicon, build_lexicon
+
+
+def test_lexicon_round_trips_word_utils(tmp_path):
+    from utils.word_utils import char2phn, word_to_dataset_frequency
+    path = str(tmp_path / 'lexicon.bin')
+    build_lexicon(char2phn, word_to_dataset_frequency, path)
+    lexicon = Lexicon(path)
+    chars = set(char2phn) | set(word_to_dataset_frequency)
+    assert len(lexicon) == len(chars)
+    for char in chars:
+        assert lexicon.frequency(char) == word_to_dataset_frequency.get(char, 0), char
+        assert lexicon.pronunciations(char) == char2phn.get(char, []), char
+    assert [char for char, _, _ in lexicon.entries()] == sorted(chars)
+
+
+def test_lexicon_unknown_characters(tmp_path):
+    path = str(tmp_path / 'lexicon.bin')
+    build_lexicon({'長': ['ㄓㄤˇ', 'ㄔㄤˊ']}, {'長': 3, '的': 7}, path)
+    lexicon = Lexicon(path)
+    assert lexicon.pronunciations('長') == ['ㄓㄤˇ', 'ㄔㄤˊ']
+    assert lexicon.pronunciations('的') == []
+    assert lexicon.frequency('無') == 0 and lexicon.pronunciations('無') == []
+    assert lexicon.index('長長') == -1
@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from conftest import build_lm, lm_batch, lm_rows
+
+# sampling=1 keeps the top token only, so decoding is deterministic
+DECODE = dict(sampling=1, max_token_text_ratio=6, min_token_text_ratio=1)
+
+
+def single(lm, row, **kwargs):
+    return lm.inference(**row, **DECODE, **kwargs)[0]
+
+
+@pytest.mark.parametrize('use_cuda_graph', [False, True])
+@pytest.mark.parametrize('eos_check_interval', [1, 8])
+def test_batch_matches_single_rows(use_cuda_graph, eos_check_interval):
+    lm = build_lm()
+    expected = [single(lm, row) for row in lm_rows()]
+    assert len(set(len(tokens) for tokens in expected)) > 1
+    tokens = lm.inference_batch(**lm_batch(lm_rows()), **DECODE, use_cuda_graph=use_cuda_graph, eos_check_interval=eos_check_interval)
+    for actual, want in zip(tokens, expected):
+        assert torch.equal(actual, want)
+
+
+@torch.inference_mode()
+def test_static_cache_matches_concat_cache():
+    lm = build_lm()
+    prefix = torch.randn(1, 12, 64)
+    tokens = torch.randint(0, 50, (20,)).tolist()
+    att_mask = torch.tril(torch.ones((1, 12, 12), dtype=torch.bool))
+    expected, att_cache, cnn_cache = lm.llm.forward_chunk(prefix, offset=0, required_cache_size=-1, att_mask=att_mask)
+    cache = lm.llm.init_static_cache(1, 12 + len(tokens), prefix.device, prefix.dtype)
+    torch.testing.assert_close(lm.llm.forward_chunk_static(prefix, cache, att_mask), expected, atol=1e-5, rtol=1e-4)
+    for token in tokens:
+        xs = lm.speech_embedding.weight[token].reshape(1, 1, -1)
+        expected, att_cache, cnn_cache = lm.llm.forward_chunk(xs, offset=0, required_cache_size=-1, att_cache=att_cache,
+                                                              cnn_cache=cnn_cache, att_mask=torch.ones((1, 1, 1), dtype=torch.bool))
+        torch.testing.assert_close(lm.llm.forward_chunk_static(xs, cache), expected, atol=1e-5, rtol=1e-4)
+    assert cache.length == 12 + len(tokens)
+
+
+def test_prompt_cache_matches_full_prefill():
+    lm = build_lm()
+    assert lm.supports_prompt_cache()
+    expected = lm.inference_batch(**lm_batch(lm_rows()), **DECODE)
+    caches = [lm.prefill_prompt(row['prompt_text'], row['prompt_text_len'], row['embedding']) for row in lm_rows()]
+    tokens = lm.inference_batch(**lm_batch(lm_rows()), **DECODE, prompt_cache=caches)
+    for actual, want in zip(tokens, expected):
+        assert torch.equal(actual, want)
+    for row, cache, want in zip(lm_rows(), caches, expected):
+        assert torch.equal(single(lm, row, prompt_cache=cache), want)
+
+
+def test_stream_yields_the_batch_tokens():
+    lm = build_lm()
+    for row, want in zip(lm_rows(), lm.inference_batch(**lm_batch(lm_rows()), **DECODE)):
+        chunks = list(lm.inference_stream(**row, **DECODE))
+        assert torch.equal(torch.concat(chunks, dim=1)[0], want)
@@ -0,0 +1,24 @@
+import torch
+
+from cosyvoice.llm.runaway import RunawayGuard
+
+
+def test_finish_reports_the_measured_rate():
+    guard = RunawayGuard()
+    assert guard.token_text_ratio() is None
+    caller_max_len = torch.tensor([60, 60, 60, 60])
+    max_len = torch.tensor([60, 40, 60, 60])
+    lengths = torch.tensor([12, 40, 60, 30])
+    looped = torch.tensor([False, False, False, True])
+    reasons = guard.finish(lengths, torch.tensor([4, 5, 2, 0]), max_len, caller_max_len, looped)
+    assert reasons == ['eos', 'rate', 'max_len', 'loop']
+    assert guard.last_token_text_ratios == [3.0, 8.0, 30.0, 30.0]
+    assert guard.counters['rate'] == 1 and guard.token_text_ratio() == 142 / 11
+
+
+def test_stop_loops_cuts_after_one_period():
+    guard = RunawayGuard(loop_window=12, loop_max_period=4)
+    tokens = torch.tensor([list(range(10)) + [7, 8, 9] * 6 + [0] * 12])
+    lengths, finished, looped = torch.tensor([40]), torch.tensor([False]), torch.tensor([False])
+    guard.stop_loops(tokens, lengths, finished, looped, 28)
+    assert bool(finished) and bool(looped) and int(lengths) == 28 - 12 + 3
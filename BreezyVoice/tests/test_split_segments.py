@@ -0,0 +1,34 @@
+import re
+
+from cosyvoice.utils.frontend_utils import split_segments
+
+
+def tokenize(text):
+    return [c for c in text if c != ' ']
+
+
+def test_default_splits_sentences_like_the_sentence_regex():
+    for text in ['今天天氣真好。明天會下雨！你呢？', 'Hello there. How are you? Fine', '長[:ㄓㄤ4]大了。']:
+        assert split_segments(text, tokenize) == [s for s in re.split(r'(?<=[？！。.?!])\s*', text) if s]
+
+
+def test_first_segment_is_short_and_text_is_kept():
+    text = '嗨，我是你的助理，今天想聊什麼呢，我們可以談談天氣，也可以聊聊最近的新聞，或者你想聽個故事，我都很樂意，'
+    segments = split_segments(text, tokenize, first_max_n=10, token_max_n=20, merge_len=4, comma_split=True)
+    assert ''.join(segments) == text
+    assert len(tokenize(segments[0])) <= 10
+    assert all(len(tokenize(s)) <= 20 for s in segments)
+    assert len(segments) > 2
+
+
+def test_tiny_fragments_are_merged():
+    # '好，' is too short to end the first segment, '走。' too short to be the last one
+    segments = split_segments('好，那就這樣吧，走。', tokenize, first_max_n=3, token_max_n=5, merge_len=3, comma_split=True)
+    assert segments == ['好，那就這樣吧，走。']
+    segments = split_segments('好，那就這樣吧，走吧走吧。', tokenize, first_max_n=3, token_max_n=5, merge_len=3, comma_split=True)
+    assert segments == ['好，那就這樣吧，', '走吧走吧。']
+    assert split_segments('好！？那就這樣。', tokenize) == ['好！？', '那就這樣。']
+
+
+def test_annotations_are_not_cut():
+    assert split_segments('a[x,y]b，c', tokenize, comma_split=True) == ['a[x,y]b，', 'c']
@@ -0,0 +1,90 @@
+import pytest
+import torch
+
+from voice_registry import VoiceRegistry
+
+
+def prompt_input(seed):
+    torch.manual_seed(seed)
+    prompt_text = torch.randint(0, 100, (1, 7), dtype=torch.int32)
+    speech_token = torch.randint(0, 4096, (1, 12), dtype=torch.int32)
+    speech_feat = torch.randn(1, 20, 80)
+    embedding = torch.randn(1, 192)
+    return {'prompt_text': prompt_text, 'prompt_text_len': torch.tensor([7], dtype=torch.int32),
+            'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': torch.tensor([12], dtype=torch.int32),
+            'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': torch.tensor([12], dtype=torch.int32),
+            'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': torch.tensor([20], dtype=torch.int32),
+            'llm_embedding': embedding, 'flow_embedding': embedding}
+
+
+class CountingPrefill:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, prompt_input):
+        self.calls += 1
+        return {'prefix': prompt_input['prompt_text'].sum()}
+
+
+def assert_same_prompt(actual, expected):
+    for key, value in expected.items():
+        if key != 'llm_prompt_cache':
+            assert torch.equal(actual[key], value), key
+
+
+def test_round_trip_through_disk(tmp_path):
+    registry = VoiceRegistry(str(tmp_path), 'cpu')
+    expected = prompt_input(0)
+    meta = registry.enroll('alice', '你好', '你好。', '你[:ㄋㄧˇ]好[:ㄏㄠˇ]', expected)
+    assert meta['prompt_text_bopomo'] == '你[:ㄋㄧˇ]好[:ㄏㄠˇ]'
+
+    reloaded = VoiceRegistry(str(tmp_path), 'cpu')
+    assert reloaded.load_all() == ['alice']
+    prompt_text_bopomo, actual = reloaded.get('alice')
+    assert prompt_text_bopomo == meta['prompt_text_bopomo']
+    assert_same_prompt(actual, expected)
+    assert 'llm_prompt_cache' not in actual
+
+
+def test_enrolment_prefill_is_reused(tmp_path):
+    prefill = CountingPrefill()
+    registry = VoiceRegistry(str(tmp_path), 'cpu', prefill_prompt=prefill)
+    voice = prompt_input(0)
+    voice['llm_prompt_cache'] = {'prefix': torch.tensor(-1)}
+    registry.enroll('alice', 'a', 'a', 'a', voice)
+    assert registry.get('alice')[1]['llm_prompt_cache'] is voice['llm_prompt_cache']
+    assert prefill.calls == 0
+
+    registry.enroll('bob', 'b', 'b', 'b', prompt_input(1))
+    _, bob = registry.get('bob')
+    assert prefill.calls == 1 and int(bob['llm_prompt_cache']['prefix']) == int(bob['prompt_text'].sum())
+    registry.get('bob')
+    assert prefill.calls == 1
+
+
+def test_device_tier_is_bounded(tmp_path):
+    prefill = CountingPrefill()
+    registry = VoiceRegistry(str(tmp_path), 'cpu', max_device_voices=2, prefill_prompt=prefill)
+    for i, voice_id in enumerate(['a', 'b', 'c']):
+        registry.enroll(voice_id, voice_id, voice_id, voice_id, prompt_input(i))
+        registry.get(voice_id)
+    assert list(registry.device_cache) == ['b', 'c']
+    _, voice = registry.get('a')
+    assert_same_prompt(voice, prompt_input(0))
+    assert list(registry.device_cache) == ['c', 'a'] and prefill.calls == 4
+
+
+def test_get_cached_never_prefills(tmp_path):
+    prefill = CountingPrefill()
+    registry = VoiceRegistry(str(tmp_path), 'cpu', prefill_prompt=prefill)
+    registry.enroll('alice', 'a', 'a', 'a', prompt_input(0))
+    assert registry.get_cached('alice') is None and prefill.calls == 0
+    _, voice = registry.get('alice')
+    assert registry.get_cached('alice')[1] is voice and prefill.calls == 1
+
+
+def test_invalid_voice_id(tmp_path):
+    registry = VoiceRegistry(str(tmp_path), 'cpu')
+    with pytest.raises(ValueError):
+        registry.enroll('../alice', 'a', 'a', 'a', prompt_input(0))
+    assert registry.list_voices() == []
@@ -0,0 +1,173 @@
+import multiprocessing
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from cosyvoice.utils.frontend_utils import contains_chinese, remove_bracket, replace_blank, replace_corner_mark, spell_out_number
+
+
+def split_by_brackets(text):
+    """Phonetic annotations inside [] and the non-empty text between them"""
+    inside_brackets = re.findall(r'\[(.*?)\]', text)
+    # Filter out empty strings from the outside list (result of consecutive brackets)
+    outside_brackets = [part for part in re.split(r'\[.*?\]', text) if part]
+    return inside_brackets, outside_brackets
+
+
+def join_interleaved(outside, inside):
+    """Inverse of split_by_brackets, with the text between brackets replaced by outside"""
+    result = [o + '[' + i + ']' for o, i in zip(outside, inside)]
+    # Append any remaining part (if outside is longer than inside)
+    if len(outside) > len(inside):
+        result.append(outside[-1])
+    return ''.join(result)
+
+
+def normalize_segment(normalizers, text, is_last=False):
+    """Normalize text between brackets with the engines of a CosyVoiceFrontEnd or TextNormalizers"""
+    text = text.strip()
+    text_is_terminated = text[-1] == "。"
+    if contains_chinese(text):
+        if normalizers.use_ttsfrd:
+            text = normalizers.frd.get_frd_extra_info(text, 'input')
+        else:
+            text = normalizers.zh_tn_model.normalize(text)
+        if not text_is_terminated and not is_last:
+            text = text[:-1]
+        text = text.replace("\n", "")
+        text = replace_blank(text)
+        text = replace_corner_mark(text)
+        text = text.replace(".", "、")
+        text = text.replace(" - ", "，")
+        text = remove_bracket(text)
+        text = re.sub(r'[，,]+$', '。', text)
+    else:
+        if normalizers.use_ttsfrd:
+            text = normalizers.frd.get_frd_extra_info(text, 'input')
+        else:
+            text = normalizers.en_tn_model.normalize(text)
+        text = spell_out_number(text, normalizers.inflect_parser)
+    return text
+
+
+def bracket_segments(text):
+    """Phonetic annotations of text and the (segment, is_last) keys of the text between them"""
+    inside_brackets, outside_brackets = split_by_brackets(text.strip())
+    return inside_brackets, [(o, n == len(outside_brackets) - 1) for n, o in enumerate(outside_brackets)]
+
+
+def normalize_text(normalizers, text):
+    """Normalize the text outside the phonetic annotations of text, keeping the annotations"""
+    inside_brackets, segments = bracket_segments(text)
+    return join_interleaved([normalize_segment(normalizers, o, is_last) for o, is_last in segments], inside_brackets)
+
+
+class TextNormalizers:
+    """The text normalization engines of CosyVoiceFrontEnd, without its models"""
+
+    def __init__(self, model_dir=None):
+        import inflect
+        self.inflect_parser = inflect.engine()
+        try:
+            import ttsfrd
+            self.use_ttsfrd = True
+        except ImportError:
+            from tn.chinese.normalizer import Normalizer as ZhNormalizer
+            from tn.english.normalizer import Normalizer as EnNormalizer
+            self.use_ttsfrd = False
+        if self.use_ttsfrd:
+            self.frd = ttsfrd.TtsFrontendEngine()
+            assert self.frd.initialize('{}/CosyVoice-ttsfrd/resource'.format(model_dir)) is True, 'failed to initialize ttsfrd resource'
+            self.frd.set_lang_type('pinyin')
+            self.frd.enable_pinyin_mix(True)
+            self.frd.set_breakmodel_index(1)
+        else:
+            self.zh_tn_model = ZhNormalizer(remove_erhua=False, full_to_half=False)
+            self.en_tn_model = EnNormalizer()
+
+
+# The engines of a worker process, built once by _init_worker
+_worker_normalizers = None
+
+
+def _init_worker(model_dir):
+    global _worker_normalizers
+    _worker_normalizers = TextNormalizers(model_dir)
+
+
+def _normalize_in_worker(segment, is_last):
+    return normalize_segment(_worker_normalizers, segment, is_last)
+
+
+def _ready():
+    return os.getpid()
+
+
+class NormalizerPool:
+    """Normalizes texts in worker processes, segment by segment.
+
+    The WeTextProcessing normalizers are pure Python and hold the GIL, so
+    threads normalize one segment at a time whatever the number of cores.
+    The pool runs `num_workers` processes that build the normalizers once,
+    when they start, and sends each segment between phonetic annotations to
+    whichever worker is free, so the segments of one text and of concurrent
+    texts are normalized in parallel. Workers are forked from a forkserver
+    where the platform has one, else spawned, never from the calling process:
+    once torch, onnxruntime or CUDA are loaded it holds threads and locks a
+    fork would copy in whatever state they are. With num_workers=0, segments are normalized in the calling thread with
+    `normalizers`, like CustomCosyVoiceFrontEnd.text_normalize_new does.
+
+    Results are kept per (segment, is_last) in an LRU cache of `cache_size`
+    entries, the same sentences tend to come back across requests.
+    """
+
+    def __init__(self, model_dir=None, num_workers=None, cache_size=4096, normalizers=None):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.normalizers = normalizers
+        self.executor = None
+        if num_workers != 0:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.executor = ProcessPoolExecutor(
+                num_workers,
+                mp_context=multiprocessing.get_context(method),
+                initializer=_init_worker,
+                initargs=(model_dir,),
+            )
+            # start the workers now, they load their normalizers while the models load
+            self.executor.submit(_ready)
+        elif normalizers is None:
+            self.normalizers = TextNormalizers(model_dir)
+
+    def normalize_segments(self, segments):
+        """Normalize a list of (segment, is_last), the segments not cached in parallel"""
+        with self.lock:
+            found = {s: self.cache[s] for s in segments if s in self.cache}
+        missing = [s for s in dict.fromkeys(segments) if s not in found]
+        if self.executor is None:
+            for segment, is_last in missing:
+                found[segment, is_last] = normalize_segment(self.normalizers, segment, is_last)
+        elif missing:
+            futures = [self.executor.submit(_normalize_in_worker, segment, is_last) for segment, is_last in missing]
+            for key, future in zip(missing, futures):
+                found[key] = future.result()
+        with self.lock:
+            for key, result in found.items():
+                self.cache[key] = result
+                self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return [found[s] for s in segments]
+
+    def normalize(self, texts):
+        """Normalize a list of texts like normalize_text, all their segments at once"""
+        split = [bracket_segments(text) for text in texts]
+        results = iter(self.normalize_segments([s for _, segments in split for s in segments]))
+        return [join_interleaved([next(results) for _ in segments], inside) for inside, segments in split]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,147 @@
+"""Character lexicon of get_bopomofo_rare: how often each character occurs in
+the training data and its pronunciations, the most common one first.
+
+utils/word_utils.py holds the lexicon as Python literals, 2 MB of source that
+every process used to compile or unmarshal into dicts at import, peaking at
+about 150 MB. `python -m utils.lexicon` compiles it once into
+utils/lexicon.bin, 1.2 MB of arrays sorted by code point that Lexicon
+memory-maps and binary searches without parsing. get_lexicon() builds the
+file on first use if it is missing.
+
+    python -m utils.lexicon --output utils/lexicon.bin
+"""
+import argparse
+import bisect
+import json
+import mmap
+import os
+import struct
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lexicon.bin')
+MAGIC = b'BVLEX001'
+# numpy dtype of an array -> its memoryview format
+FORMATS = {'<i4': 'i', '<i8': 'q', '|u1': 'B'}
+# frequent characters whose uncommon pronunciations are still marked
+always_augment_chars = {"長"}
+
+
+def build_lexicon(char2phn, word_to_dataset_frequency, path: str = DEFAULT_PATH):
+    """Write the lexicon of one character keys to path
+
+    The file is MAGIC, the length of a JSON header and the header, which maps
+    each array to its dtype, length and offset after the header:
+    codes (N,) int32 sorted code points, frequency (N,) int64,
+    phn_offsets (N + 1,) int64 and phn_data, the newline joined
+    pronunciations of character i at phn_data[phn_offsets[i]:phn_offsets[i + 1]].
+    """
+    chars = sorted(set(char2phn) | set(word_to_dataset_frequency))
+    phns = ['\n'.join(char2phn.get(c, [])).encode('utf-8') for c in chars]
+    phn_offsets = np.zeros(len(chars) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in phns], out=phn_offsets[1:])
+    arrays = {
+        'codes': np.array([ord(c) for c in chars], dtype=np.int32),
+        'frequency': np.array([word_to_dataset_frequency.get(c, 0) for c in chars], dtype=np.int64),
+        'phn_offsets': phn_offsets,
+        'phn_data': np.frombuffer(b''.join(phns), dtype=np.uint8),
+    }
+    header, offset = {}, 0
+    for name, array in arrays.items():
+        header[name] = [array.dtype.str, len(array), offset]
+        # keep every array 8 byte aligned
+        offset += -(-array.nbytes // 8) * 8
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+    # write next to the target and rename, a concurrent reader never sees a partial file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        for array in arrays.values():
+            f.write(array.tobytes() + b'\0' * (-array.nbytes % 8))
+    os.replace(tmp_path, path)
+
+
+class Lexicon:
+    """Read only view of a file written by build_lexicon, lookups bisect the
+    memory-mapped code points, O(log n) without numpy scalar overhead"""
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a lexicon file, rebuild it with python -m utils.lexicon'.format(path))
+        header_len, = struct.unpack_from('<I', self._mmap, len(MAGIC))
+        base = len(MAGIC) + 4 + header_len
+        header = json.loads(self._mmap[len(MAGIC) + 4:base])
+        buffer = memoryview(self._mmap)
+        arrays = {}
+        for name, (dtype, count, offset) in header.items():
+            start = base + offset
+            arrays[name] = buffer[start:start + count * np.dtype(dtype).itemsize].cast(FORMATS[dtype])
+        self.codes = arrays['codes']
+        self.frequencies = arrays['frequency']
+        self.phn_offsets = arrays['phn_offsets']
+        self.phn_data = arrays['phn_data']
+
+    def __len__(self):
+        return len(self.codes)
+
+    def entries(self) -> Iterator[Tuple[str, int, List[str]]]:
+        """(character, frequency, pronunciations) of every row, in code point order"""
+        for i, code in enumerate(self.codes):
+            yield chr(code), self.frequencies[i], self.row_pronunciations(i)
+
+    def index(self, char: str) -> int:
+        """Row of char, -1 if it is not in the lexicon"""
+        if len(char) != 1:
+            return -1
+        code = ord(char)
+        i = bisect.bisect_left(self.codes, code)
+        return i if i < len(self.codes) and self.codes[i] == code else -1
+
+    def frequency(self, char: str) -> int:
+        """Occurrences of char in the training data, 0 if unseen"""
+        i = self.index(char)
+        return self.frequencies[i] if i >= 0 else 0
+
+    def pronunciations(self, char: str) -> List[str]:
+        """Bopomofo pronunciations of char, the most common first, empty if unknown"""
+        i = self.index(char)
+        return self.row_pronunciations(i) if i >= 0 else []
+
+    def row_pronunciations(self, i: int) -> List[str]:
+        """Pronunciations of the character in row i"""
+        if self.phn_offsets[i] == self.phn_offsets[i + 1]:
+            return []
+        return bytes(self.phn_data[self.phn_offsets[i]:self.phn_offsets[i + 1]]).decode('utf-8').split('\n')
+
+
+@lru_cache(maxsize=None)
+def get_lexicon(path: str = DEFAULT_PATH) -> Lexicon:
+    """The lexicon at path, built from utils/word_utils.py the first time"""
+    if not os.path.exists(path):
+        from utils.word_utils import char2phn, word_to_dataset_frequency
+        build_lexicon(char2phn, word_to_dataset_frequency, path)
+    return Lexicon(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile utils/word_utils.py into a memory-mapped lexicon")
+    parser.add_argument("--output", type=str, default=DEFAULT_PATH)
+    args = parser.parse_args()
+
+    from utils.word_utils import char2phn, word_to_dataset_frequency
+    build_lexicon(char2phn, word_to_dataset_frequency, args.output)
+    lexicon = Lexicon(args.output)
+    # check the file against the literals it was built from
+    for char in set(char2phn) | set(word_to_dataset_frequency):
+        assert lexicon.frequency(char) == word_to_dataset_frequency.get(char, 0), char
+        assert lexicon.pronunciations(char) == char2phn.get(char, []), char
+    print('wrote {} characters to {} ({} kB)'.format(len(lexicon), args.output, os.path.getsize(args.output) // 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import json
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+VOICE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_\-]{1,64}$')
+
+# prompt_input key -> (artifact file, dtype on disk); the matching *_len
+# entries are derived from the array shapes when a voice is loaded
+VOICE_ARTIFACTS = {
+    'prompt_text': ('prompt_text_token.npy', np.int32),
+    'llm_prompt_speech_token': ('speech_token.npy', np.int32),
+    'prompt_speech_feat': ('speech_feat.npy', np.float32),
+    'llm_embedding': ('embedding.npy', np.float32),
+}
+
+
+class VoiceRegistry:
+    """On-disk store of per-voice prompt artifacts with an LRU-bounded device tier.
+
+    Every voice lives in its own directory under `root_dir` holding one .npy
+    file per prompt tensor plus a meta.json with the prompt transcriptions.
+    The .npy files are memory-mapped on load, so reloading hundreds of voices
+    only reads their headers. The most recently used `max_device_voices`
+    voices are kept as ready-to-use tensors on `device`, together with the
+    result of `prefill_prompt(prompt_input)` (stored as 'llm_prompt_cache')
+    when it is given. A voice enrolled with its 'llm_prompt_cache' already
+    computed goes to the device tier with it, so it is not prefilled again.
+    """
+
+    def __init__(self, root_dir, device, max_device_voices=32, prefill_prompt=None):
+        self.root_dir = root_dir
+        self.device = device
+        self.max_device_voices = max_device_voices
+        self.prefill_prompt = prefill_prompt
+        self.voices = {}
+        self.device_cache = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def __contains__(self, voice_id):
+        return voice_id in self.voices
+
+    def list_voices(self):
+        return sorted(self.voices.keys())
+
+    def load_all(self):
+        for voice_id in os.listdir(self.root_dir):
+            if VOICE_ID_PATTERN.match(voice_id) and os.path.exists(os.path.join(self.root_dir, voice_id, 'meta.json')):
+                self.voices[voice_id] = self._load(voice_id)
+        return self.list_voices()
+
+    def _load(self, voice_id):
+        voice_dir = os.path.join(self.root_dir, voice_id)
+        with open(os.path.join(voice_dir, 'meta.json'), 'r', encoding='utf8') as f:
+            voice = json.load(f)
+        voice['arrays'] = {key: np.load(os.path.join(voice_dir, filename), mmap_mode='r')
+                           for key, (filename, _) in VOICE_ARTIFACTS.items()}
+        return voice
+
+    def enroll(self, voice_id, prompt_text, prompt_text_normalized, prompt_text_bopomo, prompt_input):
+        """Persist the prompt conditioning computed by CustomCosyVoice.precompute_prompt"""
+        if not VOICE_ID_PATTERN.match(voice_id):
+            raise ValueError('voice id must be 1-64 characters of letters, digits, "_" or "-", got {!r}'.format(voice_id))
+        tmp_dir = os.path.join(self.root_dir, '.{}.tmp-{}'.format(voice_id, os.getpid()))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for key, (filename, dtype) in VOICE_ARTIFACTS.items():
+            np.save(os.path.join(tmp_dir, filename), prompt_input[key].detach().cpu().numpy().astype(dtype))
+        meta = {'voice_id': voice_id,
+                'prompt_text': prompt_text,
+                'prompt_text_normalized': prompt_text_normalized,
+                'prompt_text_bopomo': prompt_text_bopomo}
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        # Swap the directories so readers never see a half-written voice
+        voice_dir = os.path.join(self.root_dir, voice_id)
+        with self.lock:
+            if os.path.exists(voice_dir):
+                old_dir = tmp_dir + '.old'
+                os.rename(voice_dir, old_dir)
+                os.rename(tmp_dir, voice_dir)
+                shutil.rmtree(old_dir, ignore_errors=True)
+            else:
+                os.rename(tmp_dir, voice_dir)
+            self.voices[voice_id] = self._load(voice_id)
+            self.device_cache.pop(voice_id, None)
+            if prompt_input.get('llm_prompt_cache') is not None:
+                self._to_device(voice_id, prompt_input['llm_prompt_cache'])
+        return meta
+
+    def get(self, voice_id):
+        """Return (prompt_text_bopomo, prompt_input) with the prompt tensors on the device"""
+        with self.lock:
+            cached = self._get_cached(voice_id)
+            if cached is not None:
+                return cached
+            return self.voices[voice_id]['prompt_text_bopomo'], self._to_device(voice_id)
+
+    def get_cached(self, voice_id):
+        """Same as get for a voice on the device tier, None for the others.
+        Does not touch the device, unlike get for a voice not on it"""
+        with self.lock:
+            return self._get_cached(voice_id)
+
+    def _get_cached(self, voice_id):
+        voice = self.voices[voice_id]
+        prompt_input = self.device_cache.get(voice_id)
+        if prompt_input is None:
+            return None
+        self.device_cache.move_to_end(voice_id)
+        return voice['prompt_text_bopomo'], prompt_input
+
+    def _to_device(self, voice_id, llm_prompt_cache=None):
+        """Put the prompt tensors of a voice on the device tier, called with the lock held"""
+        voice = self.voices[voice_id]
+        tensors = {key: torch.from_numpy(np.array(array)).to(self.device) for key, array in voice['arrays'].items()}
+        prompt_text_len = torch.tensor([tensors['prompt_text'].shape[1]], dtype=torch.int32, device=self.device)
+        speech_token_len = torch.tensor([tensors['llm_prompt_speech_token'].shape[1]], dtype=torch.int32, device=self.device)
+        speech_feat_len = torch.tensor([tensors['prompt_speech_feat'].shape[1]], dtype=torch.int32, device=self.device)
+        prompt_input = {'prompt_text': tensors['prompt_text'], 'prompt_text_len': prompt_text_len,
+                        'llm_prompt_speech_token': tensors['llm_prompt_speech_token'], 'llm_prompt_speech_token_len': speech_token_len,
+                        'flow_prompt_speech_token': tensors['llm_prompt_speech_token'], 'flow_prompt_speech_token_len': speech_token_len,
+                        'prompt_speech_feat': tensors['prompt_speech_feat'], 'prompt_speech_feat_len': speech_feat_len,
+                        'llm_embedding': tensors['llm_embedding'], 'flow_embedding': tensors['llm_embedding']}
+        if llm_prompt_cache is None and self.prefill_prompt is not None:
+            llm_prompt_cache = self.prefill_prompt(prompt_input)
+        if llm_prompt_cache is not None:
+            prompt_input['llm_prompt_cache'] = llm_prompt_cache
+        self.device_cache[voice_id] = prompt_input
+        while len(self.device_cache) > self.max_device_voices:
+            self.device_cache.popitem(last=False)
+        return prompt_input